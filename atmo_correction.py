@@ -27,7 +27,6 @@ import envi2
 from envi2.resample import resample
 
 ##from pylab import *
-from scipy.optimize import *
 import numpy
 
 def message(s):
@@ -76,9 +75,96 @@ def transmission(a, atmo_res):
     return atmo_res**a
 
 def spec_busyness(a, spec, atmo_res, i1, i2):
-    spec2 = spec / transmission(a, atmo_res)
-    spec2 = spec2[i1:i2]
-    return numpy.add.reduce(numpy.fabs(spec2[:-1] - spec2[1:]))
+    """Busyness of the corrected spectrum between bands i1 and i2.
+
+Also works on a 2-D array of spectra (pixels, bands) with an array
+of exponents a (pixels), returning the busyness per pixel."""
+    a = numpy.asarray(a)[..., numpy.newaxis]
+    spec2 = spec[..., i1:i2] / transmission(a, atmo_res[i1:i2])
+    return numpy.add.reduce(numpy.fabs(spec2[..., :-1] - spec2[..., 1:]), axis=-1)
+
+GOLDEN = (1 + 5**0.5) / 2
+R = 1 / GOLDEN
+
+def minimize_busyness(spec, atmo_res, i1, i2, a0=0.9, step=0.05,
+                      xtol=1e-5, maxiter=100, bounds=(-10.0, 10.0),
+                      max_expand=30):
+    """Exponent a minimizing spec_busyness for every spectrum of the
+2-D array spec (pixels, bands).
+
+All spectra are searched at the same time: first a downhill bracket of
+the minimum is made starting at a0, then the bracket is narrowed by a
+golden section search until it is smaller than xtol.
+
+The bracket stays within bounds and is expanded at most max_expand
+times. Where the busyness still decreases after that (a monotone curve),
+the lowest point found, usually a bound, is returned.
+"""
+    N = len(spec)
+
+    def f(a, idx):
+        return spec_busyness(a, spec[idx], atmo_res, i1, i2)
+
+    everything = numpy.arange(N)
+
+    # bracket the minimum, b is always the lowest point so far
+    a = numpy.full(N, a0, dtype='d')
+    b = a + step
+    fa = f(a, everything)
+    fb = f(b, everything)
+
+    swap = fb > fa
+    a[swap], b[swap] = b[swap], a[swap]
+    fa[swap], fb[swap] = fb[swap], fa[swap]
+
+    amin, amax = bounds
+    c = numpy.clip(b + GOLDEN * (b - a), amin, amax)
+    fc = f(c, everything)
+
+    active = numpy.where((fc < fb) & (c != b))[0]
+    for iteration in range(max_expand):
+        if not len(active):
+            break
+        a[active], fa[active] = b[active], fb[active]
+        b[active], fb[active] = c[active], fc[active]
+        c[active] = numpy.clip(b[active] + GOLDEN * (b[active] - a[active]), amin, amax)
+        fc[active] = f(c[active], active)
+        active = active[(fc[active] < fb[active]) & (c[active] != b[active])]
+
+    # no minimum bracketed, still going downhill at c
+    downhill = fc < fb
+
+    # golden section search within the bracket
+    lo = numpy.minimum(a, c)
+    hi = numpy.maximum(a, c)
+    x1 = hi - R * (hi - lo)
+    x2 = lo + R * (hi - lo)
+    f1 = f(x1, everything)
+    f2 = f(x2, everything)
+
+    active = numpy.where(hi - lo > xtol)[0]
+    for iteration in range(maxiter):
+        if not len(active):
+            break
+        left = f1[active] < f2[active]
+
+        # minimum in [lo, x2]
+        idx = active[left]
+        hi[idx] = x2[idx]
+        x2[idx], f2[idx] = x1[idx], f1[idx]
+        x1[idx] = hi[idx] - R * (hi[idx] - lo[idx])
+        f1[idx] = f(x1[idx], idx)
+
+        # minimum in [x1, hi]
+        idx = active[~left]
+        lo[idx] = x1[idx]
+        x1[idx], f1[idx] = x2[idx], f2[idx]
+        x2[idx] = lo[idx] + R * (hi[idx] - lo[idx])
+        f2[idx] = f(x2[idx], idx)
+
+        active = active[hi[active] - lo[active] > xtol]
+
+    return numpy.where(downhill, c, numpy.where(f1 < f2, x1, x2))
 
 ##def _fit_and_plot():
 ##    im = envi2.Open('ORB0422_4_jdat',
@@ -143,40 +229,38 @@ def atmo_correction(fin, fatmos, fout, falpha, sort_wavelengths=True, use_bbl=Fa
 
     wav = im.wavelength
 
-    atmo_res = resample(atmo_spec, atmo_wav, wav)
+    atmo_res = numpy.asarray(resample(atmo_spec, atmo_wav, wav), dtype='d')
 
     i1 = im.wavelength2index(1.8)
     i2 = im.wavelength2index(2.2)
 
+    cutoff = im.wavelength2index(3.5)
+
     if progress:
         progress(0.0)
 
-    for j in range(im.lines):
+    for top, bottom in im.strips():
         if progress:
-            progress(j / float(im.lines))
-            
-        for i in range(im.samples):
-            spec = im[j, i]
-
-            # check if the spectrum is valid
-            if numpy.isnan(spec_busyness(0.9, spec, atmo_res, i1, i2)):
-                im2[j,i,:] = numpy.nan
-                alpha[j, i] = numpy.nan
-            else:
-                xopt, fopt, iters, funcalls, warnflag = fmin(spec_busyness,
-                            0.9, (spec, atmo_res, i1, i2), ftol=0.0001,
-                            disp=False, full_output=True)
-                a = xopt[0]
-
-                T = transmission(a, atmo_res)
-                
-                cutoff = im.wavelength2index(3.5)
-                T[cutoff:] = 1.0  # cut off the transimission model above 3.5 micron
-
-                spec2 = spec / T
-
-                im2[j,i,:] = spec2
-                alpha[j, i] = a
+            progress(top / float(im.lines))
+
+        spec = numpy.asarray(im[top:bottom, :, :], dtype='d').reshape((-1, im.bands))
+
+        spec2 = numpy.full(spec.shape, numpy.nan)
+        a = numpy.full(len(spec), numpy.nan)
+
+        # check if the spectra are valid
+        valid = ~numpy.isnan(spec_busyness(numpy.full(len(spec), 0.9), spec, atmo_res, i1, i2))
+
+        if valid.any():
+            a[valid] = minimize_busyness(spec[valid], atmo_res, i1, i2)
+
+            T = transmission(a[valid][:, numpy.newaxis], atmo_res)
+            T[:, cutoff:] = 1.0  # cut off the transimission model above 3.5 micron
+
+            spec2[valid] = spec[valid] / T
+
+        im2[top:bottom, :, :] = spec2.reshape((bottom - top, im.samples, im.bands))
+        alpha[top:bottom, :, :] = a.reshape((bottom - top, im.samples, 1))
 
     if progress:
         progress(1.0)
@@ -41,21 +41,23 @@ def banddepths(fin, fout, delta=1, sort_wavelengths=False, use_bbl=True, progres
                           wavelength=wavelength,
                           data_type='d', band_names=None, fwhm=None)
 
+    bands = im.bands - 2 * delta
+
     if progress:
         progress(0.0)
-    for i in range(delta, im.bands-delta):
+    # all band depths of a strip of lines at once
+    for top, bottom in im.strips():
         if progress:
-            progress(i / float(im.bands))
-
-        b_left   = im.get_band(i-delta)
-        b_middle = im.get_band(i)
-        b_right  = im.get_band(i+delta)
+            progress(top / float(im.lines))
+        strip = im.get_strip(top, bottom, copy=False).astype('float64')
 
-        top = (b_left+b_right)/2.0
+        b_left   = strip[:, :, :bands]
+        b_middle = strip[:, :, delta:delta+bands]
+        b_right  = strip[:, :, 2*delta:]
 
-        data = (top - b_middle) / top
+        shoulder = (b_left+b_right)/2.0
 
-        im2[:,:,i-delta] = data[:,:]
+        im2[top:bottom, :, :] = (shoulder - b_middle) / shoulder
 
     if progress:
         progress(1.0)
@@ -38,3 +38,14 @@ def MidpointCircle(i, j, radius, writepix=WritePixel):
             y = y - 1
         CirclePoints(x, y, i, j, radius, writepix)
         
+
+def CircleOffsets(radius):
+    # Offsets (xs, ys) of the pixels of a circle around 0, 0.
+    # The octants share pixels on the diagonals and axes,
+    # every pixel is listed only once.
+    points = set()
+    def addpix(x, y, r):
+        points.add((x, y))
+    MidpointCircle(0, 0, radius, writepix=addpix)
+    points = sorted(points)
+    return [x for x, y in points], [y for x, y in points]
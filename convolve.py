@@ -25,8 +25,13 @@
 
 # load support for ENVI images
 import envi2
+from envi2.constants import STRIP_BYTES
+
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import numpy
+from scipy.signal import fftconvolve
 
 # kernels are:  j, i, weight!
 smoothing = ((0, 0, 1), (0, 1, 1), (0, 2, 1),
@@ -37,23 +42,187 @@ laplace   = ((0, 0,  0),  (0, 1, -1),  (0, 2,  0),
              (1, 0, -1),  (1, 1,  4),  (1, 2, -1),
              (2, 0,  0),  (2, 1, -1),  (2, 2,  0))
 
+# kernels with up to this many weights are applied directly,
+# larger ones that are not separable go through the FFT
+DIRECT_WEIGHTS = 49
+
 def str2kernel(s):
+    """Kernel from a string of n*n weights (n odd), row by row."""
     try:
         result = []
         k = list(map(float, s.split()))
-        for j in range(3):
-            for i in range(3):
-                result.append((j, i, k[3*j+i]))
+        n = int(round(len(k)**0.5))
+        if n * n != len(k) or n % 2 == 0:
+            return None
+        for j in range(n):
+            for i in range(n):
+                result.append((j, i, k[n*j+i]))
         return result
     except:
         return None
 
+def kernel2array(kernel):
+    """Weights of a kernel of (j, i, weight) tuples as a 2-D array."""
+    if isinstance(kernel, numpy.ndarray):
+        return kernel.astype('d')
+    rows = max(j for j, i, weight in kernel) + 1
+    cols = max(i for j, i, weight in kernel) + 1
+    weights = numpy.zeros((rows, cols))
+    for j, i, weight in kernel:
+        weights[j, i] = weight
+    return weights
+
+def separate(weights):
+    """Returns (column, row) such that weights is their outer product, or
+None if the kernel is not separable."""
+    u, sv, vt = numpy.linalg.svd(weights)
+    if len(sv) > 1 and sv[1] > 1e-12 * sv[0]:
+        return None
+    column = u[:, 0] * numpy.sqrt(sv[0])
+    row = vt[0] * numpy.sqrt(sv[0])
+    return column, row
+
+def neighbours(data, offsets):
+    """Stack of shifted views of data, one per offset. An offset is a tuple
+with an index into the window for every axis of data. Element [k] is the
+data under offset k for every position where the whole window fits."""
+    size = numpy.max(numpy.array(offsets), axis=0) + 1
+    shape = [n - m + 1 for n, m in zip(data.shape, size)]
+    return numpy.stack([data[tuple(slice(o, o + n) for o, n in zip(offset, shape))]
+                        for offset in offsets])
+
+def _direct(data, weights):
+    rows, cols = data.shape[0] - weights.shape[0] + 1, data.shape[1] - weights.shape[1] + 1
+    result = numpy.zeros((rows, cols) + data.shape[2:])
+    for (j, i), weight in zip(numpy.ndindex(*weights.shape), weights.ravel()):
+        if weight:
+            result += weight * data[j:j+rows, i:i+cols]
+    return result
+
+def choose_method(weights):
+    """Method for correlate(): 'direct', 'separable' or 'fft'."""
+    if numpy.count_nonzero(weights) <= 9:
+        return 'direct'
+    elif separate(weights) is not None:
+        return 'separable'
+    elif numpy.count_nonzero(weights) <= DIRECT_WEIGHTS:
+        return 'direct'
+    return 'fft'
+
+def correlate(data, weights, method=None):
+    """Filter data (lines, samples[, bands]) with the 2-D kernel weights:
+
+result[y, x] = sum over j, i of weights[j, i] * data[y+j, x+i]
+
+for all positions where the kernel fits (no padding), like the 3x3
+fast_convolve() always did. Zero weights are skipped, so a NaN only
+spreads to the pixels where it is under a nonzero weight.
+
+method is 'direct' (sum of shifted copies), 'separable' (a column and a
+row pass), 'fft', or None to choose with choose_method().
+"""
+    weights = numpy.asarray(weights, dtype='d')
+    if method is None:
+        method = choose_method(weights)
+
+    if method == 'direct':
+        return _direct(data, weights)
+
+    elif method == 'separable':
+        column, row = separate(weights)
+        data = _direct(data, column[:, numpy.newaxis])
+        return _direct(data, row[numpy.newaxis, :])
+
+    elif method == 'fft':
+        valid = numpy.isfinite(data)
+        kernel = weights[::-1, ::-1]
+        if data.ndim == 3:
+            kernel = kernel[:, :, numpy.newaxis]
+        result = fftconvolve(numpy.where(valid, data, 0.0), kernel, mode='valid', axes=(0, 1))
+        if not valid.all():
+            # NaNs under a nonzero weight, as in the direct method
+            hits = fftconvolve((~valid).astype('d'), (kernel != 0).astype('d'),
+                               mode='valid', axes=(0, 1))
+            result[hits > 0.5] = numpy.nan
+        return result
+
+    raise ValueError('unknown method %s' % (method,))
+
+def normalized_correlate(data, weights, method=None):
+    """NaN-aware (normalized) convolution: the NaNs are left out and the
+result is scaled up for the missing weight, by sum(|weights|) divided by
+the sum of the |weights| on valid data. NaN where no valid data is under
+the kernel."""
+    weights = numpy.asarray(weights, dtype='d')
+    valid = numpy.isfinite(data)
+    result = correlate(numpy.where(valid, data, 0.0), weights, method=method)
+    support = correlate(valid.astype('d'), numpy.abs(weights), method=method)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        result = result * (numpy.abs(weights).sum() / support)
+    result[support <= 1e-12 * numpy.abs(weights).sum()] = numpy.nan
+    return result
+
+def filter_slabs(im, im2, work, window, first=0, last=None, halo=0,
+                 fill=numpy.nan, copies=1, threads=None, progress=None):
+    """Run work over slabs of bands first..last-1 of image im in a
+thread pool and write the results into im2[window + (bands,)].
+
+work(data, b0, b1) gets the bands b0..b1-1 as a float64 array data
+(lines, samples, b1 - b0 + 2 * halo), with halo extra bands on both sides
+set to fill beyond the image. It should return the result for the lines
+and samples of window.
+
+The slabs of all threads together, copies of each, take about STRIP_BYTES
+of memory. If that does not even fit one slab of a single band per
+thread, fewer threads are used, down to one.
+"""
+    if last is None:
+        last = im.bands
+    if threads is None:
+        threads = os.cpu_count() or 1
+
+    band_bytes = 8 * im.lines * im.samples * max(1, copies)
+    threads = max(1, min(threads, STRIP_BYTES // (band_bytes * (1 + 2 * halo))))
+    slab = max(1, STRIP_BYTES // (threads * band_bytes) - 2 * halo)
+    todo = iter(range(first, last, slab))
+
+    def task(b0):
+        b1 = min(b0 + slab, last)
+        lo, hi = max(b0 - halo, 0), min(b1 + halo, im.bands)
+        data = numpy.full((im.lines, im.samples, b1 - b0 + 2 * halo), fill)
+        data[:, :, lo - (b0 - halo):hi - (b0 - halo)] = im[:, :, lo:hi]
+        im2[window + (slice(b0, b1),)] = work(data, b0, b1)
+        return b1 - b0
+
+    done = 0
+    pending = set()
+    if progress:
+        progress(0.0)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            # at most 2 * threads slabs in memory
+            while len(pending) < 2 * threads:
+                try:
+                    pending.add(pool.submit(task, next(todo)))
+                except StopIteration:
+                    break
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done += future.result()
+                if progress:
+                    progress(done / float(max(1, last - first)))
+    if progress:
+        progress(1.0)
+
 def message(s):
     pass
 
 def fast_convolve(nameIn, nameOut, kernel='laplace', bias=1.0,
                   offset=0.0, message=message,
-                  sort_wavelengths=False, use_bbl=False, progress=None):
+                  sort_wavelengths=False, use_bbl=False, progress=None,
+                  normalized=False, method=None, threads=None):
     """
 Linear Filter
 
@@ -61,13 +230,20 @@ fast_convolve(nameIn, nameOut, kernel='laplace',
               bias=1.0, offset=0.0, message=message,
               sort_wavelengths=False, use_bbl=False)
 
-Expects kernels in the form of a string, or a tuple of tuples:
+Expects kernels in the form of a string, a tuple of tuples or a 2-D array
+of weights, of any size:
 'smoothing'
 'laplace'
 '0 -1 0 -1 4 -1 0 -1 0'
 ((0, 0,  0),  (0, 1, -1),  (0, 2,  0),
  (1, 0, -1),  (1, 1,  4),  (1, 2, -1),
  (2, 0,  0),  (2, 1, -1),  (2, 2,  0))
+
+The edges where the kernel does not fit are left zero.
+
+If normalized is True NaNs are left out of the sums, see
+normalized_correlate(). method is passed on to correlate(). The bands
+are filtered in slabs by threads threads (default: all CPUs).
 """
     if type(kernel)==str:
         if kernel=='smoothing':
@@ -78,12 +254,16 @@ Expects kernels in the form of a string, or a tuple of tuples:
             kernel = str2kernel(kernel)
             if not kernel:
                 raise ValueError('bad kernel')
+
+    weights = kernel2array(kernel)
+    if method is None:
+        method = choose_method(weights)
+    message('Kernel %dx%d, method %s' % (weights.shape + (method,)))
         
     im = envi2.Open(nameIn, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
 
     lines   = im.lines
     samples = im.samples
-    bands   = im.bands
 
     bbl = None
     if hasattr(im, 'bbl'):
@@ -92,35 +272,24 @@ Expects kernels in the form of a string, or a tuple of tuples:
     # note: selecting BSQ here makes a big difference for speed!
     im2 = envi2.New(nameOut, hdr=im, interleave='bsq', bbl=bbl, data_type='d')
 
-##    # copy edges of the original image
-##    for i in range(samples):
-##        im2[0, i, :]       = im[0, i, :]
-##        im2[lines-1, i, :] = im[lines-1, i, :]
-##
-##    for j in range(lines):
-##        im2[j, 0, :]         = im[j, 0, :]
-##        im2[j, samples-1, :] = im[j, samples-1, :]
+    rows, cols = weights.shape
+    if lines >= rows and samples >= cols:
+        top, left = rows // 2, cols // 2
+        window = (slice(top, top + lines - rows + 1), slice(left, left + samples - cols + 1))
 
-    # go for it!
-    if progress:
-        progress(0.0)
-    for b in range(0, bands): # bands
-        if progress:
-            progress(b / float(bands))
-        result = numpy.zeros((lines, samples))
-        a      = numpy.zeros((lines, samples))
-        for j, i, weight in kernel:
-            if weight:
-                a[1:-1, 1:-1] = im[j:(lines+j-2), i:(samples+i-2), b]
-                result += weight * a
-
-        im2[1:-1, 1:-1, b] = bias * result[1:-1, 1:-1] + offset
+        def work(data, b0, b1):
+            if normalized:
+                result = normalized_correlate(data, weights, method=method)
+            else:
+                result = correlate(data, weights, method=method)
+            return bias * result + offset
 
-    if progress:
-        progress(1.0)
+        # go for it!
+        filter_slabs(im, im2, work, window, copies=4, threads=threads,
+                     progress=progress)
 
     # destroy resources
-    del im2, im, a
+    del im2, im
 
 if __name__ == '__main__':
     # command line version
@@ -150,11 +319,17 @@ Expects kernels in the form of a string, or a tuple of tuples:
     parser.add_argument('-i', dest='input', help='input file name', required=True)
     parser.add_argument('-o', dest='output', help='output file name', required=True)
 
-    parser.add_argument('-k', dest='kernel', help='kernel: smooth, laplace or 9 weights', default='laplace')
+    parser.add_argument('-k', dest='kernel', help='kernel: smoothing, laplace or n*n weights', default='laplace')
     parser.add_argument('--bias', dest='bias', type=float, default=1.0,
                       help='Constant for bias (default 1.0)')
     parser.add_argument('--offset', dest='offset', type=float, default=0.0,
                       help='Constant for offset (default 0.0)')
+    parser.add_argument('-n', action='store_true', dest='normalized',
+                      help='normalized convolution, leave out NaNs')
+    parser.add_argument('-t', dest='threads', type=int, default=None,
+                      help='number of threads (default: all CPUs)')
+    parser.add_argument('-m', dest='method', choices=('direct', 'separable', 'fft'),
+                      help='convolution method (default: chosen from the kernel)')
 
     parser.set_defaults(sort_wavelengths=False, use_bbl=False, force=False,
                         kernel='laplace', bias=1.0, offset=0.0)
@@ -168,5 +343,7 @@ Expects kernels in the form of a string, or a tuple of tuples:
     fast_convolve(options.input, options.output,
                   kernel=options.kernel,
                   bias=options.bias, offset=options.offset,
+                  normalized=options.normalized, threads=options.threads,
+                  method=options.method,
                   sort_wavelengths=options.sort_wavelengths,
                   use_bbl=options.use_bbl)
@@ -2,6 +2,9 @@ from subprocess import Popen, PIPE
 import os
 import sys
 import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy
 import envi2
 import stretch
 from PIL import Image, ImageDraw, ImageFont
@@ -19,39 +22,115 @@ def console(cmd):
 def message(s):
     print(s)
 
+class FrameLayout:
+    """Font and text position shared by all frames of a movie.
+
+Frames are (lines, samples) bands, subsampled by step, with the label
+in the lower right corner."""
+    def __init__(self, im, step=1, fontname='Pillow/Tests/fonts/FreeMono.ttf',
+                 fontsize=30):
+        self.step = step
+        self.lines = len(range(0, im.lines, step))
+        self.samples = len(range(0, im.samples, step))
+        try:
+            self.font = ImageFont.truetype(fontname, max(8, fontsize // step))
+        except OSError:
+            self.font = ImageFont.load_default()
+        # labels have a fixed width, so the position is the same for all frames
+        d = ImageDraw.Draw(Image.new('L', (1, 1)))
+        left, top, right, bottom = d.textbbox((0, 0), self.label(0.0), font=self.font)
+        self.position = (self.samples - right - 10, self.lines - bottom - 10)
+
+    def label(self, wavelength):
+        return "%6.1f nm" % (wavelength,)
+
+    def render(self, band, wavelength):
+        """Stretched and labeled frame as a PIL image. A band without finite
+values gives a black frame of the same size."""
+        if numpy.isfinite(band).any():
+            imout = Image.fromarray(stretch.percent_percent_stretch(band, 0.4, 0.99)[0])
+        else:
+            imout = Image.new('L', (self.samples, self.lines))
+        d = ImageDraw.Draw(imout)
+        d.text(self.position, self.label(wavelength), font=self.font, fill=255)
+        return imout
+
+def frame(im, layout, b):
+    step = layout.step
+    band = im[::step, ::step, b]
+    if hasattr(im, 'wavelength'):
+        return layout.render(band, im.wavelength[b])
+    return layout.render(band, b)
+
 def create_movie(fname, fps=10, sort_wavelengths=False, use_bbl=False,
-                 mode='1P', bitrate='1500k', message=message, progress=None):
+                 mode='1P', bitrate='1500k', message=message, progress=None,
+                 stream=True, step=1, startband=0, endband=None, threads=None):
+    """Create fname.mp4 showing the bands of the image one by one.
+
+The bands startband up to (not including) endband are used, subsampled
+by step in both directions for quick previews.
+
+In stream mode the frames are rendered in a pool of threads and fed in
+order as raw frames to the stdin of ffmpeg. Otherwise every frame is
+saved as a PNG in a temporary directory first.
+"""
     
     im = envi2.Open(fname, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
 
     base = os.path.basename(fname)
-    tdir = tempfile.TemporaryDirectory()
 
-    stretch_fun = stretch.fundict[mode]
+    bands = range(im.bands)[startband:endband]
+    layout = FrameLayout(im, step=step)
+
+    if threads is None:
+        threads = os.cpu_count() or 1
+    threads = max(1, threads)
 
-    message('Saving bands...')
     if progress:
         progress(0)
-    for b in range(im.bands):
-        if progress:
-            progress(b / im.bands)
-##        band = stretch_fun(im[b])
-##        band = stretch.custom_stretch(im[b], 0.37, 0.61)
-        band = stretch.percent_percent_stretch(im[b], 0.4, 0.99)[0]
-        imout = Image.fromarray(band)
-        d = ImageDraw.Draw(imout)
-        fnt = ImageFont.truetype('Pillow/Tests/fonts/FreeMono.ttf', 30)
-        txt = "%6.1f nm" % (im.wavelength[b],)
-        txtsize = d.textsize(txt, font=fnt)
-        d.text((im.samples-txtsize[0]-10, im.lines-txtsize[1]-10), txt, font=fnt, fill=255)
-        imout.save(os.path.join(tdir.name, '%s%05d.png' % (base, b)))
-        
+
+    if stream:
+        message('Creating movie...')
+        p = Popen((FFMPEG, '-f', 'rawvideo', '-pix_fmt', 'gray',
+                   '-s', '%dx%d' % (layout.samples, layout.lines),
+                   '-r', str(fps), '-i', '-',
+                   '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                   '-pix_fmt', 'yuv420p', '-b:v', bitrate,
+                   '-y', '%s.mp4' % (fname,)), stdin=PIPE)
+
+        # at most 2 * threads frames are in flight, written in band order
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            pending = deque()
+            for k, b in enumerate(bands):
+                pending.append(pool.submit(frame, im, layout, b))
+                if len(pending) >= 2 * threads:
+                    p.stdin.write(pending.popleft().result().tobytes())
+                if progress:
+                    progress(k / len(bands))
+            while pending:
+                p.stdin.write(pending.popleft().result().tobytes())
+
+        p.stdin.close()
+        if p.wait():
+            message('ffmpeg failed with exit code %d' % (p.returncode,))
+    else:
+        tdir = tempfile.TemporaryDirectory()
+
+        message('Saving bands...')
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            def save(k, b):
+                frame(im, layout, b).save(os.path.join(tdir.name, '%s%05d.png' % (base, k)))
+            for k, future in enumerate([pool.submit(save, k, b) for k, b in enumerate(bands)]):
+                future.result()
+                if progress:
+                    progress(k / len(bands))
+
+        message('Creating movie...')
+        console((FFMPEG, '-r', str(fps), '-i', os.path.join(tdir.name, '%s%%05d.png' % (base,)), '-b:v', bitrate, '-y', '%s.mp4'%(fname,)))
+
     if progress:
         progress(1)
 
-    message('Creating movie...')
-    console((FFMPEG, '-r', str(fps), '-i', os.path.join(tdir.name, '%s%%05d.png' % (base,)), '-b:v', bitrate, '-y', '%s.mp4'%(fname,)))
-
 if __name__ == '__main__':
 
     create_movie('/data2/data/AVIRISNG/L2/ang20140625t191627_rfl_v1c/ang20140625t191627_corr_v1c_img_sub_fix',
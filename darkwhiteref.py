@@ -43,6 +43,33 @@ datatypes = ('uint8', 'int16', 'int32', 'float32', 'float64',
 def message(s):
     pass
 
+def references(fdark, fwhite=None, robust=True,
+               sort_wavelengths=False, use_bbl=False, message=message):
+    """Average dark and white reference per sample, arrays (samples, bands).
+
+If robust, only the whitest 50% of the lines of the white reference is
+averaged. The white reference is None if fwhite is not given.
+"""
+    message("Reading dark image...")
+    imdark = envi2.Open(fdark, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
+    dark = average_function(imdark[...], axis=0)
+    del imdark
+
+    white = None
+    if fwhite:
+        message("Reading white image...")
+        imwhite = envi2.Open(fwhite, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
+
+        if robust:
+            message("Determine whitest 50% of white reference...")
+            white = average_function(np.sort(imwhite[...], axis=0)[imwhite.lines//2:, :, :], axis=0)
+        else:
+            white = average_function(imwhite[...], axis=0)
+
+        del imwhite
+
+    return dark, white
+
 def darkwhiteref(fin, fdark, fwhite, fout,
                  datatype='float32',
                  robust=True,
@@ -53,9 +80,7 @@ def darkwhiteref(fin, fdark, fwhite, fout,
     im = envi2.Open(fin, sort_wavelengths=False, use_bbl=False)
     im2 = envi2.New(fout, hdr=im, interleave=ENVI_bsq, data_type=datatype)
 
-    message("Reading dark image...")
-    imdark = envi2.Open(fdark, sort_wavelengths=False, use_bbl=False)
-    dark = average_function(imdark[...], axis=0)
+    dark, white = references(fdark, fwhite, robust=robust, message=message)
 
     darkbias = 0
 
@@ -68,16 +93,7 @@ def darkwhiteref(fin, fdark, fwhite, fout,
     if progress:
         progress(0.0)
 
-    if fwhite:
-        message("Reading white image...")
-        imwhite = envi2.Open(fwhite, sort_wavelengths=False, use_bbl=False)
-
-        if robust:
-            message("Determine whitest 50% of white reference...")
-            white = average_function(np.sort(imwhite[...], axis=0)[imwhite.lines//2:, :, :], axis=0)
-        else:
-            white = average_function(imwhite[...], axis=0)
-
+    if white is not None:
         diff = white - dark
 
         if correct_dark:
@@ -103,8 +119,6 @@ def darkwhiteref(fin, fdark, fwhite, fout,
                 im2[band] = whitepanel * 10000.0 * (im[band] - dark[np.newaxis, :, band] - darkbias) / (diff[np.newaxis, :, band] - darkbias)
             else:
                 im2[band] = whitepanel * (im[band] - dark[np.newaxis, :, band] - darkbias) / (diff[np.newaxis, :, band] - darkbias)
-
-        del imwhite
     else:
         message("Dark reference correction...")
 ##        im2[...] = im[...] - dark[np.newaxis, :, :]
@@ -126,7 +140,7 @@ def darkwhiteref(fin, fdark, fwhite, fout,
     if progress:
         progress(0.0)
 
-    del im, imdark, im2
+    del im, im2
     
 if __name__ == '__main__':
     # command line version
@@ -27,6 +27,8 @@ import envi2
 ##from scipy.stats.stats import nanmean, nanstd
 from numpy import nanmean, nanstd
 from numpy import zeros, newaxis, polyfit, poly1d, where, isnan, nan
+from numpy import arange, asarray, einsum, errstate, vander
+from numpy.linalg import pinv
 
 ##from pylab import plot
 
@@ -392,6 +394,119 @@ def bbb_destripe_vertical_divide(fin, fout, order=None,
     del im, im2
 
 
+################# streaming versions ###################
+
+def batched_interpolate(a, order=2):
+    """Fit a polynomial of order order to every column of a (n, bands)
+with one batched least-squares solve. NaNs are ignored, columns without
+any valid values stay NaN."""
+    n = a.shape[0]
+
+    # x scaled to [-1, 1] keeps the normal equations well conditioned
+    x = arange(n, dtype='d')
+    if n > 1:
+        x = 2.0 * x / (n - 1) - 1.0
+    V = vander(x, order + 1)
+
+    valid = ~isnan(a)
+    y = where(valid, a, 0.0)
+
+    # normal equations for all bands at once: (V' W V) c = V' W y
+    A = einsum('nb,np,nq->bpq', valid.astype('d'), V, V)
+    b = einsum('nb,np->bp', y, V)
+    c = einsum('bpq,bq->bp', pinv(A), b)
+
+    result = V.dot(c.T)
+    result[:, ~valid.any(axis=0)] = nan
+
+    return result
+
+def strip_destripe(fin, fout, direction='h', mode='d', order=None,
+                   sort_wavelengths=False, use_bbl=True, lines=None,
+                   message=message, progress=None):
+    """Streaming destriping, reads the image twice in strips of lines.
+
+PASS 1 gathers the row or column sums of all bands in one sequential pass,
+polynomials (order > 0) are fitted for all bands at once, PASS 2 applies
+the correction strip by strip. Only the strips and the statistics are
+kept in memory, so this works on BIL, BIP and BSQ data of any size."""
+    direction = direction.lower()
+    mode = mode.lower()
+    if not (direction.startswith('h') or direction.startswith('v')):
+        raise ValueError("Unknown direction '%s'" % (direction,))
+    if not (mode.startswith('d') or mode.startswith('s')):
+        raise ValueError("Unknown mode '%s'" % (mode,))
+
+    horizontal = direction.startswith('h')
+    divide = mode.startswith('d')
+
+    im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
+
+    im2 = envi2.New(fout, hdr=im, interleave='bsq', data_type='d')
+
+    strips = list(im.strips(lines=lines))
+
+    if progress:
+        progress(0.0)
+
+    message("PASS 1: gathering statistics...")
+
+    if horizontal:
+        total = zeros((im.lines, im.bands))
+        count = zeros((im.lines, im.bands))
+    else:
+        total = zeros((im.samples, im.bands))
+        count = zeros((im.samples, im.bands))
+
+    for k, (top, bottom) in enumerate(strips):
+        if progress:
+            progress(0.5 * k / len(strips))
+
+        a = asarray(im[top:bottom, :, :], dtype='d')
+        valid = ~isnan(a)
+        a = where(valid, a, 0.0)
+
+        if horizontal:
+            total[top:bottom] = a.sum(axis=1)
+            count[top:bottom] = valid.sum(axis=1)
+        else:
+            total += a.sum(axis=0)
+            count += valid.sum(axis=0)
+
+    with errstate(invalid='ignore', divide='ignore'):
+        av = total / count
+
+    if order:
+        av = batched_interpolate(av, order=order)
+
+    avband = nanmean(av, axis=0)
+
+    if divide:
+        av = av / avband[newaxis, :]
+    else:
+        av = av - avband[newaxis, :]
+
+    message("PASS 2: applying correction...")
+
+    for k, (top, bottom) in enumerate(strips):
+        if progress:
+            progress(0.5 + 0.5 * k / len(strips))
+
+        if horizontal:
+            correction = av[top:bottom, newaxis, :]
+        else:
+            correction = av[newaxis, :, :]
+
+        if divide:
+            im2[top:bottom, :, :] = im[top:bottom, :, :] / correction
+        else:
+            im2[top:bottom, :, :] = im[top:bottom, :, :] - correction
+
+    if progress:
+        progress(1.0)
+
+    del im, im2
+
 
 if __name__ == '__main__':
     # command line version
@@ -420,6 +535,8 @@ if __name__ == '__main__':
 
     parser.add_argument('-F', action='store_true', dest='fast',
                       help='fast version, keeps the entire image in memory!')
+    parser.add_argument('-S', action='store_true', dest='stream',
+                      help='streaming version, reads the image in strips of lines')
 
 ##    parser.set_defaults(sort_wavelengths=False, use_bbl=False, force=False,
 ##                        direction='hor', mode='sub', order=0, fast=False)
@@ -430,7 +547,14 @@ if __name__ == '__main__':
 ##    assert options.output, "Option -o output file name required."
     assert options.force or not os.path.exists(options.output), "Output file exists. Use -f to overwrite."
 
-    if options.fast:
+    if options.stream:
+        strip_destripe(options.input, options.output,
+                  direction=options.direction,
+                  mode=options.mode,
+                  order=options.order,
+                  sort_wavelengths=options.sort_wavelengths,
+                  use_bbl=options.use_bbl)
+    elif options.fast:
         destripe(options.input, options.output,
                   direction=options.direction,
                   mode=options.mode,
@@ -36,111 +36,144 @@ np.seterr(all='ignore')
 def message(s):
     pass
 
-## 9-neighborhood version
-def destriping_filter9(fin, fout, foffset=None,
-               sort_wavelengths=False, use_bbl=True,
+# neighborhood kernels over (x, band), True means the pixel takes part
+KERNEL9 = np.ones((3, 3), dtype=bool)
+
+KERNEL8 = np.ones((3, 3), dtype=bool)
+KERNEL8[1, 1] = False
+
+KERNEL4 = np.zeros((3, 3), dtype=bool)
+KERNEL4[1, :] = True
+KERNEL4[:, 1] = True
+KERNEL4[1, 1] = False
+
+def neighborhood_differences(a, kernel):
+    """For a strip a (lines, samples, bands) return the difference between
+the NaN-mean of the (x, band) neighborhood given by kernel and the center
+pixel, for the interior pixels (lines, samples-2, bands-2)."""
+    lines, samples, bands = a.shape
+    total = np.zeros((lines, samples-2, bands-2))
+    count = np.zeros((lines, samples-2, bands-2))
+    for dx, db in zip(*np.nonzero(kernel)):
+        v = a[:, dx:samples-2+dx, db:bands-2+db]
+        valid = ~np.isnan(v)
+        total += np.where(valid, v, 0.0)
+        count += valid
+    ys = total / count
+    xs = a[:, 1:-1, 1:-1]
+    return ys - xs
+
+def offset_statistics(im, strips, kernel, bad=None, progress=None):
+    """Streaming pass over the image gathering the mean and stddev of the
+neighborhood differences for all (x, band) pairs at once. Pixels marked in
+the (samples, bands) array bad are left out of the neighborhoods."""
+    s1 = np.zeros((im.samples, im.bands))
+    s2 = np.zeros((im.samples, im.bands))
+    n = np.zeros((im.samples, im.bands))
+
+    for k, (top, bottom) in enumerate(strips):
+        if progress:
+            progress(k / float(len(strips)))
+
+        a = np.asarray(im[top:bottom, :, :], dtype='d')
+        if bad is not None:
+            a = a + np.where(bad, np.nan, 0.0)[np.newaxis, :, :]
+
+        diff = neighborhood_differences(a, kernel)
+        valid = ~np.isnan(diff)
+        diff = np.where(valid, diff, 0.0)
+
+        s1[1:-1, 1:-1] += diff.sum(axis=0)
+        s2[1:-1, 1:-1] += np.square(diff).sum(axis=0)
+        n[1:-1, 1:-1] += valid.sum(axis=0)
+
+    if progress:
+        progress(1.0)
+
+    mean = s1 / n
+    stddev = np.sqrt(s2 / n - mean**2)
+
+    # edges are not filtered
+    mean[[0, -1], :] = 0
+    mean[:, [0, -1]] = 0
+    stddev[[0, -1], :] = 0
+    stddev[:, [0, -1]] = 0
+
+    return mean, stddev
+
+def _destriping_filter(im, im2, kernel1, kernel2, foffset=None,
                maxmean=1000, maxstddev=500,
-               replace_nan=False, apply_offset=True,
+               replace_nan=False, apply_offset=True, lines=None,
                message=message, progress=None):
+    """Destriping engine shared by the 9- and 8-neighborhood versions.
 
-    im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
-
-    im2 = envi2.New(fout, hdr=im, interleave=ENVI_bsq, data_type='d')
+kernel1 is the neighborhood used for finding the offsets, kernel2 the one
+used for recalculating the offsets next to bad pixels."""
+    strips = list(im.strips(lines=lines))
 
     message("PASS 1: calculating offsets...")
     message("bad pixels: (x, band) mean stddev")
 
-##    bias = np.ones((im.samples, im.bands))
-    offset = np.zeros((im.samples, im.bands))
-    deviat = np.zeros((im.samples, im.bands))
-##    bad = offset.astype(np.bool8)
-    
-    # bands
-    bad_pixels = list()
+    offset, deviat = offset_statistics(im, strips, kernel1, progress=progress)
 
-    if progress:
-        progress(0.0)
+    bad = (np.fabs(offset) > maxmean) | (deviat > maxstddev) | \
+          ~np.isfinite(offset) | ~np.isfinite(deviat)
 
-    for band in range(1, im.bands-1):
-        if progress:
-            progress(band / float(im.bands))
-
-        # samples
-        for x in range(1, im.samples-1):
-            
-            # lines
-            cube = im[:, x-1:x+2, band-1:band+2]
-            xs = cube[:, 1, 1]
-            ys = np.nanmean(cube, axis=(1,2))
-            diff = ys - xs
-
-            mean = np.nanmean(diff)
-            stddev = np.sqrt(np.nanmean(np.square(diff)) - mean**2)
-            offset[x, band] = mean
-            deviat[x, band] = stddev
-
-            if np.fabs(mean) > maxmean or stddev > maxstddev or not np.isfinite(mean) or not np.isfinite(stddev):
-                offset[x, band] = np.nan
-                deviat[x, band] = np.nan
-                bad_pixels.append((x, band))
-                message("(%d, %d) %f %f" % (x, band, mean, stddev))
+    # bad pixels in (band, x) order
+    bad_pixels = [(x, band) for band, x in np.argwhere(bad.T)]
+    for x, band in bad_pixels:
+        message("(%d, %d) %f %f" % (x, band, offset[x, band], deviat[x, band]))
+
+    offset[bad] = np.nan
+    deviat[bad] = np.nan
 
-    if progress:
-        progress(1.0)
-    
     message("PASS 2: recalculating offsets around bad pixels...")
 
     # recalculate offsets next to bad pixels...
-    
-    if progress:
-        progress(0.0)
-
-    count = 0
-    for this_x, this_band in bad_pixels:
-        if progress:
-            progress(count / float(len(bad_pixels)))
-        count += 1
-
-        #bands
-        for band in range(this_band-1, this_band+2):
-            # samples
-            for x in range(this_x-1, this_x+2):
-                if not(band == this_band and x == this_x) and (0<band<im.bands-1 and 0<x<im.samples-1):
-                    # lines
-                    cube = im[:, x-1:x+2, band-1:band+2] + 0*offset[np.newaxis, x-1:x+2, band-1:band+2]
-                    xs = cube[:, 1, 1]
-                    ys = np.nanmean(cube, axis=(1,2))
-                    diff = ys - xs
-
-                    mean = np.nanmean(diff)
-                    stddev = np.sqrt(np.nanmean(np.square(diff)) - mean**2)
-                    offset[x, band] = mean
-                    deviat[x, band] = stddev
+    if bad_pixels:
+        near = np.zeros_like(bad)
+        for dx in (-1, 0, 1):
+            for db in (-1, 0, 1):
+                near[1+dx:im.samples-1+dx, 1+db:im.bands-1+db] |= bad[1:-1, 1:-1]
+        near[[0, -1], :] = False
+        near[:, [0, -1]] = False
+        near &= ~bad
+
+        mean, stddev = offset_statistics(im, strips, kernel2, bad=bad,
+                                         progress=progress)
+        offset[near] = mean[near]
+        deviat[near] = stddev[near]
 
-    if progress:
-        progress(1.0)
-    
     message("Saving output image...")
 
     if apply_offset:
         message("Applying offset...")
-        im2[...] = im[...] + offset[np.newaxis, :, :]
+        correction = offset
     else:
         message("Skipping offset, keeping NaN's... (new)")
- ##       im2[...] = im[...] + 0 * offset[np.newaxis, :, :]
+        correction = 0 * offset
 
+    if replace_nan:
+        message("PASS 3: replacing NaNs...")
+
+    if progress:
+        progress(0.0)
+
+    for k, (top, bottom) in enumerate(strips):
         if progress:
-            progress(0.0)
+            progress(k / float(len(strips)))
 
-        nans = 0 * offset[:, :]
-        for j in range(im.lines):
-            if progress:
-                progress(j / float(im.lines))
+        a = im[top:bottom, :, :] + correction[np.newaxis, :, :]
 
-            im2[j, :, :] = im[j, :, :] + nans[:, :]
+        if replace_nan:
+            # in order, a replaced pixel is used for its bad neighbors
+            for x, band in bad_pixels:
+                a[:, x, band] = np.nanmean(a[:, x-1:x+2, band-1:band+2], axis=(1, 2))
 
-        if progress:
-            progress(1.0)
+        im2[top:bottom, :, :] = a
+
+    if progress:
+        progress(1.0)
 
     if foffset:
         message("Saving offset and stddev image...")
@@ -153,26 +186,21 @@ def destriping_filter9(fin, fout, foffset=None,
         im3[1] = deviat.transpose()
         del im3
 
-    if replace_nan:
-        message("PASS 3: replacing NaNs...")
-
-        if progress:
-            progress(0.0)
+## 9-neighborhood version
+def destriping_filter9(fin, fout, foffset=None,
+               sort_wavelengths=False, use_bbl=True,
+               maxmean=1000, maxstddev=500,
+               replace_nan=False, apply_offset=True, lines=None,
+               message=message, progress=None):
 
-        count = 0
-        for x, band in bad_pixels:
-            if progress:
-                progress(count / float(len(bad_pixels)))
-            count += 1
+    im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
 
-            #bands
-            for y in range(im.lines):
-                cube = im2[y, x-1:x+2, band-1:band+2]
-                im2[y, x, band] = np.nanmean(cube)
+    im2 = envi2.New(fout, hdr=im, interleave=ENVI_bsq, data_type='d')
 
-        if progress:
-            progress(1.0)
-        
+    _destriping_filter(im, im2, KERNEL9, KERNEL9, foffset=foffset,
+                       maxmean=maxmean, maxstddev=maxstddev,
+                       replace_nan=replace_nan, apply_offset=apply_offset,
+                       lines=lines, message=message, progress=progress)
 
     del im, im2
 
@@ -181,7 +209,7 @@ def destriping_filter9(fin, fout, foffset=None,
 def destriping_filter(fin, fout, foffset=None,
                sort_wavelengths=False, use_bbl=True,
                maxmean=1000, maxstddev=500,
-               replace_nan=False, apply_offset=True,
+               replace_nan=False, apply_offset=True, lines=None,
                message=message, progress=None, smallkernel=False):
 
     im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
@@ -191,143 +219,12 @@ def destriping_filter(fin, fout, foffset=None,
     else:
         im2 = envi2.New(fout, hdr=im, interleave=ENVI_bsq, data_type='d')
 
-    message("PASS 1: calculating offsets...")
-    message("bad pixels: (x, band) mean stddev")
-
-##    bias = np.ones((im.samples, im.bands))
-    offset = np.zeros((im.samples, im.bands))
-    deviat = np.zeros((im.samples, im.bands))
-##    bad = offset.astype(np.bool8)
-    
-    # bands
-    bad_pixels = list()
-
-    if progress:
-        progress(0.0)
-
-    for band in range(1, im.bands-1):
-        if progress:
-            progress(band / float(im.bands))
-
-        # samples
-        for x in range(1, im.samples-1):
-            
-            # lines
-            cube = im[:, x-1:x+2, band-1:band+2].astype('d').copy()
-            xs = cube[:, 1, 1].copy()
-            cube[:, 1, 1] = np.nan  # set middle pixels to nan
-            if smallkernel:         # set corner pixels to nan as well
-                cube[:, 0, 0] = np.nan
-                cube[:, 0, 2] = np.nan
-                cube[:, 2, 0] = np.nan
-                cube[:, 2, 2] = np.nan
-            ys = np.nanmean(cube, axis=(1,2))
-            diff = ys - xs
-
-            mean = np.nanmean(diff)
-            stddev = np.sqrt(np.nanmean(np.square(diff)) - mean**2)
-            offset[x, band] = mean
-            deviat[x, band] = stddev
-
-            if np.fabs(mean) > maxmean or stddev > maxstddev or not np.isfinite(mean) or not np.isfinite(stddev):
-                offset[x, band] = np.nan
-                deviat[x, band] = np.nan
-                bad_pixels.append((x, band))
-                message("(%d, %d) %f %f" % (x, band, mean, stddev))
-
-    if progress:
-        progress(1.0)
-    
-    message("PASS 2: recalculating offsets around bad pixels...")
-
-    # recalculate offsets next to bad pixels...
-    
-    if progress:
-        progress(0.0)
-
-    count = 0
-    for this_x, this_band in bad_pixels:
-        if progress:
-            progress(count / float(len(bad_pixels)))
-        count += 1
-
-        #bands
-        for band in range(this_band-1, this_band+2):
-            # samples
-            for x in range(this_x-1, this_x+2):
-                if not(band == this_band and x == this_x) and (0<band<im.bands-1 and 0<x<im.samples-1):
-                    # lines
-                    cube = im[:, x-1:x+2, band-1:band+2] + 0*offset[np.newaxis, x-1:x+2, band-1:band+2]
-                    xs = cube[:, 1, 1].copy()
-                    cube[:, 1, 1] = np.nan
-                    ys = np.nanmean(cube, axis=(1,2))
-                    diff = ys - xs
-
-                    mean = np.nanmean(diff)
-                    stddev = np.sqrt(np.nanmean(np.square(diff)) - mean**2)
-                    offset[x, band] = mean
-                    deviat[x, band] = stddev
-
-    if progress:
-        progress(1.0)
-    
-    message("Saving output image...")
-
-    if apply_offset:
-        message("Applying offset...")
-        im2[...] = im[...] + offset[np.newaxis, :, :]
-    else:
-        message("Skipping offset, keeping NaN's... (new)")
- ##       im2[...] = im[...] + 0 * offset[np.newaxis, :, :]
-
-        if progress:
-            progress(0.0)
-
-        nans = 0 * offset[:, :]
-        for j in range(im.lines):
-            if progress:
-                progress(j / float(im.lines))
-
-            # the slice is there for avoiding having two advanced indices with a slice in the middle!
-            # j, slice, bands (bands are always advanced indices!).
-            # because then the axes get swapped... (bands, samples)
-            # Now it's [slice, slice, advanced], resulting in dimensions (1, samples, bands)
-            im2[j, :, :] = im[j:j+1, :, :] + nans[:, :]
-
-        if progress:
-            progress(1.0)
-
-    if foffset:
-        message("Saving offset and stddev image...")
-        im3 = envi2.New(foffset, file_type=ENVI_Standard,
-                        lines=im.bands, samples=im.samples, bands=2,
-                        band_names=['offset', 'stddev'],
-                        byte_order=0,
-                        interleave=ENVI_bsq, data_type='d')
-        im3[0] = offset.transpose()
-        im3[1] = deviat.transpose()
-        del im3
-
-    if replace_nan:
-        message("PASS 3: replacing NaNs...")
-
-        if progress:
-            progress(0.0)
-
-        count = 0
-        for x, band in bad_pixels:
-            if progress:
-                progress(count / float(len(bad_pixels)))
-            count += 1
-
-            #bands
-            for y in range(im.lines):
-                cube = im2[y, x-1:x+2, band-1:band+2]
-                im2[y, x, band] = np.nanmean(cube)
-
-        if progress:
-            progress(1.0)
-        
+    # the small kernel (1+2+1) is only used for finding the bad pixels
+    _destriping_filter(im, im2, KERNEL4 if smallkernel else KERNEL8, KERNEL8,
+                       foffset=foffset,
+                       maxmean=maxmean, maxstddev=maxstddev,
+                       replace_nan=replace_nan, apply_offset=apply_offset,
+                       lines=lines, message=message, progress=progress)
 
     del im, im2
 
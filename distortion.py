@@ -0,0 +1,357 @@
+#!/usr/bin/python3
+## distortion.py
+##
+## Copyright (C) 2018 Wim Bakker
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by the
+## Free Software Foundation, version 3 of the License.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+## See the GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License along
+## with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+## Contact:
+##     Wim Bakker, <bakker@itc.nl>
+##     University of Twente, Faculty ITC
+##     Hengelosestraat 99
+##     7514 AE Enschede
+##     Netherlands
+##
+## Sensor characterization, keystone and smile.
+##
+## Both distortions are modelled as a displacement that is linear in the
+## position along one axis of the detector:
+##
+##   keystone: d(x) = (s - 1) * (x - mid)   across track, per band
+##   smile:    d(z) = (g - 1) * z + shift   along the bands, per sample
+##
+## The displacements are measured in windows with FFT cross-correlation
+## for all sampled lines and bands (or samples) at once, after which the
+## linear model is fitted in closed form. The correction is applied with
+## sparse resampling matrices, one product per strip of lines.
+##
+
+import os
+import hashlib
+
+import numpy as np
+import scipy.sparse
+
+import envi2
+
+# directory for the cached sensor models
+CACHEDIR = os.path.expanduser('~/hyppy-sensors')
+
+def message(s):
+    print(s)
+
+######################################################################
+#
+# Shift estimation
+#
+
+def subpixel_shifts(ref, data):
+    """Sub-pixel shift of data relative to ref along the last axis.
+
+ref is an array (..., n) and data an array (..., n + 2 * maxshift), the
+data window extends maxshift beyond the ref window on both sides. The two
+should broadcast against each other, for instance one reference for many
+spectra. The normalized cross correlation for all lags -maxshift ..
+maxshift is computed with FFTs for all leading dimensions at once, the
+peak is refined by fitting a parabola through the peak and its neighbors.
+A feature at position x in ref is found at position x + shift in data.
+
+Returns the arrays shift and corr, the peak normalized correlation.
+"""
+    n = ref.shape[-1]
+    maxshift = (data.shape[-1] - n) // 2
+    nlags = 2 * maxshift + 1
+
+    a = ref - ref.mean(axis=-1)[..., np.newaxis]
+
+    # correlation of ref with every n-long segment of data
+    m = data.shape[-1] + n
+    c = np.fft.irfft(np.conj(np.fft.rfft(a, m)) * np.fft.rfft(data, m), m)
+    c = c[..., :nlags]
+
+    # norms of the zero-mean data segments from running sums
+    zero = np.zeros(data.shape[:-1] + (1,))
+    cs = np.concatenate((zero, np.cumsum(data, axis=-1)), axis=-1)
+    cs2 = np.concatenate((zero, np.cumsum(data * data, axis=-1)), axis=-1)
+    s1 = cs[..., n:n+nlags] - cs[..., :nlags]
+    s2 = cs2[..., n:n+nlags] - cs2[..., :nlags]
+    var = (s2 - s1 * s1 / n).clip(0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        c = c / np.sqrt((a * a).sum(axis=-1)[..., np.newaxis] * var)
+    c = np.nan_to_num(c, nan=-1.0, posinf=-1.0, neginf=-1.0)
+
+    k = c.argmax(axis=-1)
+    if nlags < 3:
+        return np.zeros(k.shape), c[..., 0]
+    k = k.clip(1, nlags - 2)
+
+    c0 = np.take_along_axis(c, (k - 1)[..., np.newaxis], axis=-1)[..., 0]
+    c1 = np.take_along_axis(c, k[..., np.newaxis], axis=-1)[..., 0]
+    c2 = np.take_along_axis(c, (k + 1)[..., np.newaxis], axis=-1)[..., 0]
+
+    denom = c0 - 2 * c1 + c2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.where(denom < 0, 0.5 * (c0 - c2) / denom, 0.0)
+
+    shift = k - maxshift + delta.clip(-0.5, 0.5)
+
+    return shift, c1
+
+def windows(n, width=None, maxshift=None):
+    """Start positions, width and maximum shift of half-overlapping windows
+along an axis of length n. The windows keep maxshift from the edges."""
+    if width is None:
+        width = max(16, n // 8)
+    if maxshift is None:
+        maxshift = max(1, width // 4)
+    width = max(1, min(width, n - 2 * maxshift))
+    step = max(1, width // 2)
+    starts = np.arange(maxshift, n - width - maxshift + 1, step)
+    return starts, width, maxshift
+
+def windowed_shifts(ref, data, width=None, maxshift=None):
+    """Measure the shift of data relative to ref in half-overlapping
+windows along the last axis.
+
+Returns the window centers, shifts (..., windows) and correlations
+(..., windows)."""
+    n = data.shape[-1]
+    starts, width, maxshift = windows(n, width, maxshift)
+    idx = starts[:, np.newaxis] + np.arange(width)[np.newaxis, :]
+    idx2 = starts[:, np.newaxis] - maxshift + \
+           np.arange(width + 2 * maxshift)[np.newaxis, :]
+
+    shift, corr = subpixel_shifts(ref[..., idx], data[..., idx2])
+
+    centers = starts + (width - 1) / 2.0
+
+    return centers, shift, corr
+
+######################################################################
+#
+# Resampling
+#
+
+def cubic_weights(t):
+    """Keys cubic convolution weights (a=-0.5) for the four neighbors
+at offsets -1, 0, 1, 2 of fractional positions t."""
+    a = -0.5
+    t2 = t * t
+    t3 = t2 * t
+    w0 = a * (t3 - 2 * t2 + t)
+    w1 = (a + 2) * t3 - (a + 3) * t2 + 1
+    w2 = -(a + 2) * t3 + (2 * a + 3) * t2 - a * t
+    w3 = -a * (t3 - t2)
+    return np.stack((w0, w1, w2, w3), axis=-1)
+
+def resampling_matrix(positions, n):
+    """Sparse matrix M (len(positions), n) such that M.dot(v) gives v,
+interpolated with cubic convolution at the given positions.
+Positions are clipped to [0, n-1], neighbors beyond the edges are
+replaced by the edge values."""
+    positions = np.clip(np.asarray(positions, dtype='d'), 0, n - 1)
+    base = np.floor(positions).astype(int)
+    t = positions - base
+
+    w = cubic_weights(t)
+    cols = (base[:, np.newaxis] + np.arange(-1, 3)[np.newaxis, :]).clip(0, n - 1)
+    rows = np.repeat(np.arange(len(positions)), 4)
+
+    # duplicate entries (at the edges) are summed by the constructor
+    return scipy.sparse.csr_matrix((w.ravel(), (rows, cols.ravel())),
+                                   shape=(len(positions), n))
+
+def keystone_matrix(scales, samples):
+    """Block diagonal resampling matrix for keystone correction of
+band-major line vectors (bands * samples). Band b is resampled at
+positions scales[b] * (x - mid) + mid."""
+    x = np.arange(samples)
+    mid = (samples - 1) / 2
+    blocks = [resampling_matrix(s * (x - mid) + mid, samples) for s in scales]
+    return scipy.sparse.block_diag(blocks, format='csr')
+
+def smile_matrix(smile):
+    """Block diagonal resampling matrix for smile correction of
+sample-major line vectors (samples * bands). smile is the displacement
+(bands, samples), band z of sample i is resampled at z + smile[z, i]."""
+    bands, samples = smile.shape
+    z = np.arange(bands)
+    blocks = [resampling_matrix(z + smile[:, i], bands) for i in range(samples)]
+    return scipy.sparse.block_diag(blocks, format='csr')
+
+def apply_keystone(im, im2, scales, lines=None, progress=None):
+    """Keystone correction of image im into im2, strip by strip."""
+    M = keystone_matrix(scales, im.samples)
+
+    strips = list(im.strips(lines=lines))
+    for k, (top, bottom) in enumerate(strips):
+        if progress:
+            progress(k / len(strips))
+
+        a = np.asarray(im[top:bottom, :, :], dtype='d')
+        n = bottom - top
+        # (lines, samples, bands) -> (bands * samples, lines)
+        v = a.transpose(2, 1, 0).reshape(im.bands * im.samples, n)
+        v = M.dot(v)
+        im2[top:bottom, :, :] = v.reshape(im.bands, im.samples, n).transpose(2, 1, 0)
+
+    if progress:
+        progress(1.0)
+
+def apply_smile(im, im2, smile, lines=None, progress=None):
+    """Smile correction of image im into im2, strip by strip."""
+    M = smile_matrix(smile)
+
+    strips = list(im.strips(lines=lines))
+    for k, (top, bottom) in enumerate(strips):
+        if progress:
+            progress(k / len(strips))
+
+        a = np.asarray(im[top:bottom, :, :], dtype='d')
+        n = bottom - top
+        # (lines, samples, bands) -> (samples * bands, lines)
+        v = a.reshape(n, im.samples * im.bands).T
+        v = M.dot(v)
+        im2[top:bottom, :, :] = v.T.reshape(n, im.samples, im.bands)
+
+    if progress:
+        progress(1.0)
+
+######################################################################
+#
+# Estimation
+#
+
+def estimate_keystone(im, jstep=None, width=None, chunk=16,
+                      message=message, progress=None):
+    """Estimate the keystone scale of every band relative to the middle band.
+
+Lines are sampled every jstep lines. Returns the arrays scale and corr,
+the mean scale and the mean correlation per band over the sampled lines.
+"""
+    if jstep is None:
+        jstep = max(1, im.lines // 100)
+    message("line step %d" % (jstep,))
+
+    midband = im.bands // 2
+    mid = (im.samples - 1) / 2
+
+    sampled = np.arange(0, im.lines, jstep)
+
+    scale = np.zeros(im.bands)
+    corr = np.zeros(im.bands)
+
+    for k in range(0, len(sampled), chunk):
+        if progress:
+            progress(k / len(sampled))
+
+        # (lines, bands, samples), slices avoid mixing advanced indices
+        a = np.concatenate([im[j:j+1, :, :] for j in sampled[k:k+chunk]])
+        a = np.nan_to_num(a.astype('d').transpose(0, 2, 1))
+
+        # the middle band broadcasts against all bands
+        ref = a[:, midband:midband+1, :]
+        centers, shift, c = windowed_shifts(ref, a, width=width)
+
+        # d(x) = (s - 1) * (x - mid), least squares through the origin
+        u = centers - mid
+        s = 1 + (shift * u).sum(axis=-1) / (u * u).sum()
+
+        scale += s.sum(axis=0)
+        corr += c.mean(axis=-1).sum(axis=0)
+
+    if progress:
+        progress(1.0)
+
+    return scale / len(sampled), corr / len(sampled)
+
+def estimate_smile(im, jstep=None, width=None, threshold=0.9,
+                   message=message, progress=None):
+    """Estimate the smile, the displacement in bands of every sample
+relative to the first sample.
+
+Blocks of jstep lines are averaged. Only blocks with a mean correlation
+above threshold are used. Returns an array (bands, samples)."""
+    if jstep is None:
+        jstep = max(1, im.lines // 20)
+    message("line step %d" % (jstep,))
+
+    z = np.arange(im.bands)
+
+    accu = np.zeros((im.bands, im.samples))
+    count = np.zeros(im.samples)
+
+    blocks = range(0, im.lines, jstep)
+    for k, j in enumerate(blocks):
+        if progress:
+            progress(k / len(blocks))
+
+        # (samples, bands)
+        spec = np.asarray(im[j:j+jstep, :, :], dtype='d').mean(axis=0)
+        spec = np.nan_to_num(spec)
+
+        ref = spec[0:1, :]
+        centers, shift, c = windowed_shifts(ref, spec, width=width)
+
+        # d(z) = (g - 1) * z + shift, closed form linear regression,
+        # only the shift with a single window (few bands)
+        if len(centers) > 1:
+            u = centers - centers.mean()
+            slope = (shift * u).sum(axis=-1) / (u * u).sum()
+            offset = shift.mean(axis=-1) - slope * centers.mean()
+        else:
+            slope = np.zeros(shift.shape[:-1])
+            offset = shift.mean(axis=-1)
+
+        good = c.mean(axis=-1) > threshold # only record good correlations...
+        accu[:, good] += slope[good] * z[:, np.newaxis] + offset[good]
+        count[good] += 1
+
+    if progress:
+        progress(1.0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return accu / count
+
+######################################################################
+#
+# Cache of sensor models
+#
+
+def sensor_key(im, kind):
+    """Key identifying the sensor geometry of image im, made up of the
+sensor type, the dimensions and the wavelengths."""
+    h = im.header
+    key = [kind, str(getattr(h, 'sensor_type', '')), im.samples, im.bands]
+    if hasattr(im, 'wavelength'):
+        key.extend(['%.3f' % (w,) for w in im.wavelength])
+    return hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+
+def cache_name(im, kind):
+    return os.path.join(CACHEDIR, '%s_%s.npz' % (kind, sensor_key(im, kind)))
+
+def load_model(im, kind):
+    """Returns the cached model (a dict of arrays) for the sensor of
+image im, or None if there is none."""
+    fname = cache_name(im, kind)
+    if not os.path.exists(fname):
+        return None
+    with np.load(fname) as f:
+        return dict(f)
+
+def save_model(im, kind, **arrays):
+    """Caches the model for the sensor of image im."""
+    if not os.path.isdir(CACHEDIR):
+        os.makedirs(CACHEDIR)
+    np.savez(cache_name(im, kind), **arrays)
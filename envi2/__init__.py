@@ -25,4 +25,5 @@
 from .spectral import *
 from .header import *
 from .image import *
+from .reinterleave import *
 from .speclib import *
@@ -37,3 +37,6 @@ ENVI_bsq = 'bsq'
 ENVI_BIP = 'bip'
 ENVI_BIL = 'bil'
 ENVI_BSQ = 'bsq'
+
+# default memory budget for one strip of lines when streaming over images
+STRIP_BYTES = 32 * 1024 * 1024
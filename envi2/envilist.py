@@ -27,6 +27,10 @@
 ##     Netherlands
 ##
 
+import numpy
+
+# first characters of numbers (besides digits), including nan and inf
+NUMBER_START = set('+-.nNiI')
 
 def find_matching_bracket(s, start=0):
     i = start
@@ -40,7 +44,51 @@ def find_matching_bracket(s, start=0):
             return i
         i = i + 1
 
+def to_scalar(elem):
+    try:
+        return int(elem)
+    except:
+        try:
+            return float(elem)
+        except:
+            return elem
+
+def to_flat_list(s):
+    """Fast path of to_python_list() for lists without nested lists.
+
+The list is split on the commas in one go and numeric lists are converted
+by numpy in a single pass, with the same result as to_python_list()."""
+    s = s.strip()[1:-1].strip()
+    if not s:
+        return []
+    elems = s.split(',')
+    # to_python_list() drops one empty element at the end
+    if len(elems) > 1 and not elems[-1].strip():
+        del elems[-1]
+    elems = [elem.lstrip() for elem in elems]
+
+    try:
+        return numpy.array(elems, dtype=numpy.int64).tolist()
+    except (ValueError, OverflowError):
+        pass
+
+    try:
+        values = numpy.array(elems, dtype='d')
+    except ValueError:
+        # only elements starting like a number can be one
+        return [to_scalar(elem) if elem[:1].isdigit() or elem[:1] in NUMBER_START else elem
+                for elem in elems]
+
+    result = values.tolist()
+    # integers among the floats stay integers
+    for i in numpy.nonzero(values == numpy.floor(values))[0]:
+        result[i] = to_scalar(elems[i])
+    return result
+
 def to_python_list(s):
+    if '{' not in s.strip()[1:]:
+        return to_flat_list(s)
+
     result = []
     s = s.strip()   # strip whitespace
     s = s[1:-1]     # strip { and }
@@ -65,13 +113,7 @@ def to_python_list(s):
             else:
                 elem = s.split(',', 1)[0]
                 s = s[a + 1:]
-            try:
-                result.append(int(elem))
-            except:
-                try:
-                    result.append(float(elem))
-                except:
-                    result.append(elem)
+            result.append(to_scalar(elem))
     return result
 
 def to_envi_list(l):
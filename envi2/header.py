@@ -59,11 +59,118 @@
 import os
 import numpy
 import copy
+import threading
 from . import envilist
 from . import constants
 #import time
 ##import collections
 
+# ENVI lists longer than this (in characters) are converted on first access
+LAZY_LIST_CHARS = 4096
+
+# number of parsed header files kept in memory
+HEADER_CACHE_SIZE = 256
+
+_header_cache = {}
+_header_cache_lock = threading.Lock()
+
+class LazyList:
+    """ENVI list from a header file, converted to a Python list when it
+is needed for the first time."""
+    def __init__(self, text):
+        self.text = text
+        self.value = None
+
+    def get(self):
+        # threads may convert at the same time, the value is published
+        # before the text is dropped
+        text = self.text
+        if text is not None:
+            self.value = envilist.to_python_list(text)
+            self.text = None
+        return copy.copy(self.value)
+
+def parse_header(lines):
+    """Parse the lines of an ENVI header file.
+
+Returns (attrlist, values, lazy). values maps the attributes to their
+Python values, lazy maps the attributes with long lists to a LazyList."""
+    attrlist = []
+    parts = {'magic': ['']}
+    curattr = 'magic'
+    for l in lines:
+        l = l.strip()
+        if l == '':         # Empty line
+            pass
+        elif l[0] == ';':   # Comment
+            pass
+        elif '=' in l:      # Variable
+            s = l.split('=', 1)
+            # replace spaces from attribute names by underscores
+            enviattr = s[0].strip()
+            curattr = '_'.join(enviattr.split(' '))
+            curattr = curattr.lower()
+            attrlist.append(curattr)
+            parts[curattr] = [s[1].strip()]
+        else:               # Variable continued...
+            parts.setdefault(curattr, []).append(l)
+
+    values = {}
+    lazy = {}
+    for attr, part in parts.items():
+        value = ''.join(part)
+        if len(part) == 1:
+            try: # try conversion to integer
+                value = int(value)
+            except ValueError:
+                pass
+
+        # convert envi lists to Python lists
+        if type(value)==str and value and value[0]=='{':
+            if len(value) > LAZY_LIST_CHARS:
+                lazy[attr] = LazyList(value)
+                continue
+            value = envilist.to_python_list(value)
+        values[attr] = value
+
+    # convert envi data type to Python data type
+    if 'data_type' in values:
+        values['data_type'] = Header.datatypedict[values['data_type']]
+
+    return attrlist, values, lazy
+
+def read_header(fname):
+    """Parse ENVI header file fname, see parse_header().
+
+Parsed files are kept in memory, so repeatedly opening the same image does
+not parse its header again, unless the file was modified."""
+    path = os.path.abspath(fname)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+
+    with _header_cache_lock:
+        cached = _header_cache.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    f = open(path, 'r')
+    t = f.readlines()
+    f.close()
+
+    result = parse_header(t)
+
+    with _header_cache_lock:
+        while len(_header_cache) >= HEADER_CACHE_SIZE:
+            del _header_cache[next(iter(_header_cache))]
+        _header_cache[path] = (stamp, result)
+
+    return result
+
+def forget_header(fname):
+    """Remove header file fname from the cache of read_header()."""
+    with _header_cache_lock:
+        _header_cache.pop(os.path.abspath(fname), None)
+
 ######################################################################
 #
 # Definition of the envi_header class
@@ -77,6 +184,21 @@ from . import constants
 # associated envi_header object!
 #
 
+def header_file(fname):
+    """Returns the name of the header file of image fname."""
+    base, ext = os.path.splitext(fname)
+    if ext.lower() == '.hdr':
+        return fname
+    elif os.path.exists(fname + '.hdr'):
+        return fname + '.hdr'
+    elif os.path.exists(fname + '.HDR'):
+        return fname + '.HDR'
+    elif os.path.exists(base + '.hdr'):
+        return base + '.hdr'
+    elif os.path.exists(base + '.HDR'):
+        return base + '.HDR'
+    raise ValueError('%s: header file not found' % (fname,))
+
 class Header:
     # datatypedict translates envi data types to numpy data types
     datatypedict = {1:'u1', 2:'h', 3:'i', 4:'f', 5:'d',
@@ -109,9 +231,13 @@ class Header:
                        'uint64':15
                        }
 
+    # long lists from the header file that have not been converted yet
+    _lazy = {}
+
 # hdr can be envi_header or envi_image object
 
-    def __init__(h, fname=None, hdr=None, sort_wavelengths=True, use_bbl=True, **keys):
+    def __init__(h, fname=None, hdr=None, sort_wavelengths=True, use_bbl=True,
+                 use_band_order=True, **keys):
 ##                 lines=0, samples=0, bands=0,
 ##                 interleave='', datatype=0, byteorder=0):
         h.attrlist = []
@@ -128,7 +254,15 @@ class Header:
 
             # copy attributes from supplied header
             for attr in hdr.attrlist:
-                setattr(h, attr, getattr(hdr, attr))
+                # the band order belongs to the file of hdr
+                if attr == 'band_order':
+                    continue
+                if attr in hdr._lazy and attr not in vars(hdr):
+                    h._lazy = dict(h._lazy)
+                    h._lazy[attr] = hdr._lazy[attr]
+                    h.__dict__.pop(attr, None)
+                else:
+                    setattr(h, attr, getattr(hdr, attr))
                 h.to_attrlist(attr)
 
             # fix the virtual stuff
@@ -161,6 +295,13 @@ class Header:
                 h.to_attrlist(attr)
 
         # STEP 4: set up virtual bands, if needed
+        # a band order stored in the header file comes first, but not
+        # when the bands are asked for in the order on disk
+        order = None
+        if fname and use_band_order and hasattr(h, 'band_order') and \
+           (sort_wavelengths or use_bbl):
+            order = [int(b) for b in h.band_order]
+
         if fname and (sort_wavelengths or use_bbl):
             # look at wavelengths
             if hasattr(h, 'wavelength'):
@@ -168,13 +309,16 @@ class Header:
             else:
                 w = list(range(h.getbands()))
                 
-            i = list(range(len(w)))
+            if order is None:
+                i = list(range(len(w)))
+            else:
+                i = order
             # create list of (wavelength, band) pairs
-            wavband = list(zip(w, i))
+            wavband = [(w[b], b) for b in i]
 
             # look at bad band list, throw out bad bands
             if use_bbl and hasattr(h, 'bbl'):
-                wavband = numpy.array(wavband)[numpy.where(numpy.array(h.bbl))]
+                wavband = numpy.array(wavband)[numpy.where(numpy.array(h.bbl)[i])]
             
             # sort remaining channels
             if sort_wavelengths:
@@ -184,7 +328,28 @@ class Header:
             # create the index to index list in the header    
             h.itoi = numpy.array([int(x[1]) for x in wavband])
             h.goodbands = len(h.itoi)
+
+            # the band order only changes the view, write() keeps the
+            # bands of the file in the order on disk
+            if order is not None and not sort_wavelengths:
+                h._write_itoi = numpy.sort(h.itoi)
             
+    def __getattr__(h, attr):
+        # convert long lists on first access
+        if attr in h._lazy:
+            value = h._lazy[attr].get()
+            setattr(h, attr, value)
+            return value
+        raise AttributeError(attr)
+
+    def __delattr__(h, attr):
+        if attr in h._lazy:
+            h._lazy = dict(h._lazy)
+            del h._lazy[attr]
+            h.__dict__.pop(attr, None)
+        else:
+            object.__delattr__(h, attr)
+
     def to_attrlist(self, attr):
         if attr not in self.attrlist:
             self.attrlist.append(attr)
@@ -197,22 +362,33 @@ class Header:
         return s
 
     def write(h, fname):
-        if fname.split('.')[-1] == 'hdr':
-            f = open(fname, 'w')
-        else: # must have extension .hdr
-            f = open(fname+'.hdr', 'w')
+        if fname.split('.')[-1] != 'hdr': # must have extension .hdr
+            fname = fname + '.hdr'
+        f = open(fname, 'w')
+
+        # virtual bands are written in the order on disk, see STEP 4
+        itoi = getattr(h, '_write_itoi', None)
+        if itoi is None and hasattr(h, 'itoi'):
+            itoi = h.itoi
+
+        # the band order refers to all bands on disk, it is only valid
+        # if the bands are written as they are
+        keep_order = itoi is None or \
+                     numpy.array_equal(itoi, numpy.arange(h.getbands()))
 
         f.write('%s\n' % getattr(h, 'magic', 'ENVI'))
 
         for attr in h.attrlist:
+            if attr == 'band_order' and not keep_order:
+                continue
             enviattr = ' '.join(attr.split('_'))
             value = getattr(h, attr)
 ##            if attr=='description':
 ##                f.write(('description = { header generated by envi.py [%s] }\n')
 ##                        % (time.asctime(time.localtime(time.time())),))
             if isinstance(value, list) or isinstance(value, tuple) or (isinstance(value, numpy.ndarray) and value.shape):
-                if hasattr(h, 'itoi') and len(value)==h.getbands():
-                    value = numpy.array(value)[h.itoi]
+                if itoi is not None and len(value)==h.getbands():
+                    value = numpy.array(value)[itoi]
                 f.write(('%s = %s\n') % (enviattr, envilist.to_envi_list(value)))
             elif attr == 'data_type':
 ##                f.write(('%s = %s\n') % (enviattr, h.revdatatypedict[value]))
@@ -220,12 +396,12 @@ class Header:
             elif value is None: # attribute was reset, don't write!
                 pass
             elif not h.file_type==constants.ENVI_Speclib and attr == 'bands':
-                if hasattr(h, 'itoi'):
-                    value = len(h.itoi) # or h.goodbands
+                if itoi is not None:
+                    value = len(itoi) # or h.goodbands
                 f.write(('%s = %s\n') % (enviattr, str(value)))
             elif h.file_type==constants.ENVI_Speclib and attr == 'samples':
-                if hasattr(h, 'itoi'):
-                    value = len(h.itoi) # or h.goodbands
+                if itoi is not None:
+                    value = len(itoi) # or h.goodbands
                 f.write(('%s = %s\n') % (enviattr, str(value)))
             else:
                 f.write(('%s = %s\n') % (enviattr, str(value)))
@@ -236,62 +412,18 @@ class Header:
         
         f.close()
 
+        forget_header(fname)
+
     def read(h, fname):
-        base, ext = os.path.splitext(fname)
-        if ext.lower() == '.hdr':
-            f = open(fname, 'r')
-        elif os.path.exists(fname + '.hdr'):
-            f = open(fname + '.hdr', 'r')
-        elif os.path.exists(fname + '.HDR'):
-            f = open(fname + '.HDR', 'r')
-        elif os.path.exists(base + '.hdr'):
-            f = open(base + '.hdr', 'r')
-        elif os.path.exists(base + '.HDR'):
-            f = open(base + '.HDR', 'r')
-        else:
-            raise ValueError('%s: header file not found' % (fname,))
-                
-##        try: # where's the header file?
-##            f = open(fname+'.hdr', 'r')
-##        except IOError:
-##            try:
-##                f = open('.'.join(fname.split('.')[:-1])+'.hdr', 'r')
-##            except IOError:
-##                f = open(fname, 'r')
-                
-        t = f.readlines()
-        f.close()
-        curattr = 'magic'
-        setattr(h, 'magic', '')
-        for i in range(len(t)):
-            l = t[i].strip()
-            if l == '':         # Empty line
-                pass
-            elif l[0] == ';':   # Comment
-                pass
-            elif '=' in l:      # Variable
-                s = l.split('=', 1)
-                # replace spaces from attribute names by underscores
-                enviattr = s[0].strip()
-                curattr = '_'.join(enviattr.split(' '))
-                curattr = curattr.lower()
-                h.attrlist.append(curattr)
-                try: # try conversion to integer
-                    setattr(h, curattr, int(s[1].strip()))
-                except ValueError:
-                    setattr(h, curattr, s[1].strip())
-            else:               # Variable continued...
-                setattr(h, curattr, getattr(h, curattr, '') + l)
-
-        # convert envi data type to Python data type
-        if hasattr(h, 'data_type'):
-            h.data_type = h.datatypedict[h.data_type]
+        attrlist, values, lazy = read_header(header_file(fname))
 
-        # convert envi lists to Python lists
-        for attr in h.attrlist:
-            value = getattr(h, attr)
-            if type(value)==str and value and value[0]=='{':
-                setattr(h, attr, envilist.to_python_list(value))
+        for attr, value in values.items():
+            setattr(h, attr, copy.copy(value))
+        h.attrlist.extend(attrlist)
+
+        if lazy:
+            h._lazy = dict(h._lazy)
+            h._lazy.update(lazy)
         
     def copy(h):
         return copy.copy(h)
@@ -120,6 +120,66 @@ bbl - bad band list
             if hasattr(self.header, 'bbl'):
                 self.bbl = self.header.bbl
 
+        self._band_views(getattr(self.header, 'itoi', None))
+
+    def _band_views(self, itoi):
+        """Cache how the virtual bands map onto the bands on disk.
+
+If itoi is a run with a constant step, like the identity when the bands
+are already sorted, _band_range holds it as a range and real_band()
+returns slices, so indexing reads contiguous bands instead of gathering
+them. The result is still copied by _read(), as with the index array,
+unless a view is asked for, see get_strip(). Otherwise, if itoi consists of a few runs of consecutive bands (e.g. a
+bad band list), _band_runs holds these runs as slices.
+"""
+        self._band_range = None
+        self._band_runs = None
+        if itoi is None or len(itoi) == 0:
+            return
+
+        itoi = numpy.asarray(itoi)
+        d = numpy.diff(itoi)
+        if len(itoi) == 1:
+            self._band_range = range(itoi[0], itoi[0] + 1)
+        elif d[0] != 0 and (d == d[0]).all():
+            self._band_range = range(itoi[0], itoi[-1] + d[0], d[0])
+        else:
+            breaks = numpy.where(d != 1)[0] + 1
+            starts = numpy.concatenate(([0], breaks))
+            ends = numpy.concatenate((breaks, [len(itoi)]))
+            # only worth it if the runs are long enough
+            if 8 * len(starts) <= len(itoi):
+                self._band_runs = [slice(itoi[i], itoi[j-1] + 1) for i, j in zip(starts, ends)]
+
+    def _get(self, y, x, b, copy=True):
+        """self.data[y, x, real bands of b], always in BIP order.
+
+Uses the cached band runs if possible. With an int index next to a slice
+numpy would move the band axis to the front, so y and x are applied first.
+See _read() for copy."""
+        basic = not isinstance(y, (list, numpy.ndarray)) and \
+                not isinstance(x, (list, numpy.ndarray))
+        if basic and self._band_runs is not None and \
+           isinstance(b, slice) and b == slice(None):
+            return numpy.concatenate([self.data[y, x, s] for s in self._band_runs], axis=-1)
+        real = self.real_band(b)
+        if basic and isinstance(real, numpy.ndarray):
+            return self.data[y, x][..., real]
+        return self._read(y, x, real, copy=copy)
+
+    def _read(self, y, x, real, copy=True):
+        """self.data[y, x, real] for real band index real.
+
+A virtual band mapping used to give a fancy index and thus a copy. When it
+is a slice, the view is copied as well, so callers always get writable
+arrays. With copy=False the view is returned, which is read-only for
+images opened from file."""
+        result = self.data[y, x, real]
+        if copy and isinstance(real, slice) and self._band_range is not None and \
+           numpy.may_share_memory(result, self.data):
+            result = numpy.array(result)
+        return result
+
     def __len__(self):
         return self.bands
 
@@ -141,22 +201,22 @@ will be in BIP format (y, x, band), in which all the dimensions
 are optional.
 """
         if i == Ellipsis:
-            return self.data[:, : , self.real_band(slice(None))]
+            return self._get(slice(None), slice(None), slice(None))
         elif type(i)!=tuple:
             # one argument, assume we want bands
             if type(i)==float:
                 # this is for bandmath so im[2.2] will work...
                 return self.data[: ,: ,self.wavelength2index(i)]
             else:
-                return self.data[: ,: ,self.real_band(i)]
+                return self._read(slice(None), slice(None), self.real_band(i))
         elif len(i)==2:
             # two arguments, assume we want a spectrum
             y, x = i
-            return self.data[y, x, self.real_band(slice(None))]
+            return self._get(y, x, slice(None))
         elif len(i)==3:
             # three arguments, pass indices in the correct order
             y, x, b = i
-            return self.data[y, x, self.real_band(b)]
+            return self._get(y, x, b)
         else:
             raise IndexError('invalid index')
 
@@ -201,20 +261,33 @@ This function sets image to value value at index i.
 """
         self.data[j,i,b] = value
 
-    def get_spectrum(self, j, i):
+    def get_spectrum(self, j, i, copy=True):
         """Function get_spectrum: get the spectrum at location j, i.
+See get_strip() for copy.
 """
-        return self.virtual_spectrum(self.data[j,i,:])
+        return self._get(j, i, slice(None), copy=copy)
         
     def set_spectrum(self, j, i, value):
         """Function set_spectrum: set the spectrum at location j, i.
 """
         self.data[j,i,:] = value[:]
         
-    def get_band(self, b):
+    def get_band(self, b, copy=True):
         """Function get_band: get band data with band index b.
+See get_strip() for copy.
+"""
+        return self._read(slice(None), slice(None), self.real_band(b), copy=copy)
+
+    def get_strip(self, top, bottom, copy=True):
+        """Function get_strip: get lines top up to bottom, like
+im[top:bottom, :, :].
+
+With copy=False the data is not copied if the bands can be read as a
+view of the file, i.e. without a band mapping or when the mapping is a
+run of bands with a constant step. Such a view is read-only for images
+opened from file, use it for data that is only read or converted.
 """
-        return self.data[:,:,self.real_band(b)]
+        return self._get(slice(top, bottom), slice(None), slice(None), copy=copy)
 
     def set_band(self, b, value):
         """Function set_band: set band data with band index b.
@@ -232,6 +305,19 @@ This function sets image to value value at index i.
     def flush(self):
         self.data.flush()
 
+    def strips(self, lines=None, max_bytes=STRIP_BYTES):
+        """Generator yielding (top, bottom) line ranges that cover the image.
+
+Use for streaming over an image in strips of lines, im[top:bottom, :, :]
+reads one strip. If lines is not given, the strip height is chosen such
+that a strip of float64 values takes about max_bytes of memory.
+"""
+        if lines is None:
+            lines = max_bytes // (8 * max(1, self.samples * self.bands))
+        lines = max(1, int(lines))
+        for top in range(0, self.lines, lines):
+            yield top, min(top + lines, self.lines)
+
     def _to_file(self, fname):
         """Writes the image to file. Basically creates a writable memmap.
 fname should be the name of the output file.
@@ -450,7 +536,15 @@ This is the nan-safe version of the function.
 using the index-to-index (itoi) lookup-table.
 
 Argument b can be a number or a list/array.
+
+If the virtual bands are a run with a constant step, a slice b gives a
+slice, so that indexing the data reads contiguous bands.
 """
+        if self._band_range is not None and not isinstance(b, (list, numpy.ndarray)):
+            r = self._band_range[b]
+            if isinstance(r, range):
+                return slice(r.start, r.stop if r.stop >= 0 else None, r.step)
+            return r
         if hasattr(self.header, 'itoi'):
             return self.header.itoi[b]
         else:
@@ -584,18 +678,23 @@ band argument (b) can be supplied, which will always be ignored.
 """
         self.data[j,i] = value
 
-    def get_band(self, b=0): # band will be ignored!
+    def get_band(self, b=0, copy=True): # band will be ignored!
         """Get band function. Will return the whole data set.
 Any band argument b will be ignored.
 """
         return self.data
 
+    def get_strip(self, top, bottom, copy=True):
+        """Get lines top up to bottom of the data.
+"""
+        return self.data[top:bottom]
+
     def set_band(self, value):
         """Set band function. Will copy the whole data set to disk.
 """
         self.data[:,:] = value[:,:]
 
-    def get_spectrum(self, j, i):
+    def get_spectrum(self, j, i, copy=True):
         """This function is supplied for conformity with the other image classes.
 It fakes a single value at location j, i as a spectrum.
 """
@@ -963,7 +1062,7 @@ See information on the abstract superclass Image for more details.
 #
 
 def Open(fname, as_type=None, hdr=None,
-                 sort_wavelengths=True, use_bbl=True):
+                 sort_wavelengths=True, use_bbl=True, use_band_order=True):
     """Factory function Open returns one of the image objects of class
 Image1Band, ImageBIP, ImageBIL or ImageBSQ.
 
@@ -985,12 +1084,20 @@ which is marked as bad in the header file.
 
 as_type should be any of the types defined in the dtype of numpy.
 hdr should be of type Image or type Header.
-sort_wavelengths and use_bbl should be True or False (default is True).
+The header file may hold a band order (see sortchannels.py), the real
+band indices in the order in which the bands should appear. This is
+applied first when sort_wavelengths or use_bbl is True, unless
+use_band_order is False. With both False the bands are in the order on
+disk.
+
+sort_wavelengths, use_bbl and use_band_order should be True or False
+(default is True).
 """
     # read header first
     h = header.Header(fname, hdr=hdr,
                           sort_wavelengths=sort_wavelengths,
-                          use_bbl=use_bbl)
+                          use_bbl=use_bbl,
+                          use_band_order=use_band_order)
 
     # Check image type and create appropriate object
     if getattr(h, 'file_type', ' ') == ENVI_Speclib:
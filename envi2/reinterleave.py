@@ -0,0 +1,171 @@
+## reinterleave.py
+##
+## Copyright (C) 2010 Wim Bakker
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by the
+## Free Software Foundation, version 3 of the License.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+## See the GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License along
+## with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+## Contact:
+##     Wim Bakker, <bakker@itc.nl>
+##     University of Twente, Faculty ITC
+##     Hengelosestraat 99
+##     7514 AE Enschede
+##     Netherlands
+##
+## Block-wise copying between images of different interleave.
+##
+## An assignment like im2[...] = im[...] between a BSQ and a BIP image
+## is a strided copy that jumps all over both memory maps. Here the data
+## is copied in blocks of lines instead: a block is read in the order of
+## the input file, transposed in memory, and written in the order of the
+## output file. Within a block all reads and writes are sequential runs.
+##
+
+import numpy
+
+from .constants import *
+from .image import Open, New
+
+def file_view(im):
+    """Returns (data, order), the data of image im in the order of the file.
+
+order gives for every axis of data the axis of the BIP view:
+0 is line, 1 is sample and 2 is band. So for a BSQ image order is (2, 0, 1).
+Returns None for spectral libraries."""
+    h = im.header
+    if getattr(h, 'file_type', ' ') == ENVI_Speclib:
+        return None
+
+    data = im.data
+    if data.ndim == 2:
+        return data[:, :, numpy.newaxis], (0, 1, 2)
+    elif h.bands == 1 or h.interleave.lower() == ENVI_bip:
+        return data, (0, 1, 2)
+    elif h.interleave.lower() == ENVI_bil:
+        return data.transpose(0, 2, 1), (0, 2, 1)
+    elif h.interleave.lower() == ENVI_bsq:
+        return data.transpose(2, 0, 1), (2, 0, 1)
+    return None
+
+def copy_image(im, im2, top=0, bottom=None, left=0, right=None,
+               bands=None, lines=None, max_bytes=STRIP_BYTES, progress=None):
+    """Copy im[top:bottom, left:right, bands] into image im2.
+
+This is the same as
+
+im2[...] = im[top:bottom, left:right, bands]
+
+but the data is moved in blocks of lines, read in the order of the input
+file and written in the order of the output file. Use it for converting
+between interleaves, making subsets and changing the data type (the data
+type of im2) of images larger than memory.
+
+bands is a list of (virtual) band indices, or None for all bands.
+The number of lines per block is lines, or chosen such that a block
+takes about max_bytes of memory.
+"""
+    if bottom is None:
+        bottom = im.lines
+    if right is None:
+        right = im.samples
+
+    if bands is None:
+        bands = numpy.arange(im.bands)
+    real = numpy.atleast_1d(numpy.asarray(im.real_band(numpy.asarray(bands, dtype=int))))
+
+    src = file_view(im)
+    dst = file_view(im2)
+    if src is None or dst is None:
+        im2[...] = im[top:bottom, left:right, bands]
+        return
+
+    src, src_order = src
+    dst, dst_order = dst
+
+    samples = right - left
+    if dst.shape[dst_order.index(0)] != bottom - top or \
+       dst.shape[dst_order.index(1)] != samples or \
+       dst.shape[dst_order.index(2)] != len(real):
+        raise ValueError('output image does not match the subset')
+
+    # a run of bands can be sliced, which keeps the reads sequential
+    if len(real) and (numpy.diff(real) == 1).all():
+        band_index = slice(int(real[0]), int(real[-1]) + 1)
+    else:
+        band_index = real
+
+    # from the order of the input file to the order of the output file
+    perm = [src_order.index(axis) for axis in dst_order]
+
+    if lines is None:
+        itemsize = max(src.dtype.itemsize, dst.dtype.itemsize)
+        lines = max_bytes // (2 * itemsize * max(1, samples * len(real)))
+    lines = max(1, int(lines))
+
+    if progress:
+        progress(0.0)
+
+    for y0 in range(top, bottom, lines):
+        y1 = min(y0 + lines, bottom)
+        if progress:
+            progress((y0 - top) / float(bottom - top))
+
+        index = {0: slice(y0, y1), 1: slice(left, right), 2: slice(None)}
+        block = src[tuple(index[axis] for axis in src_order)]
+        if isinstance(band_index, slice):
+            block = block[(slice(None),) * src_order.index(2) + (band_index,)]
+        else:
+            block = numpy.take(block, band_index, axis=src_order.index(2))
+
+        block = numpy.ascontiguousarray(block.transpose(perm), dtype=dst.dtype)
+
+        index = {0: slice(y0 - top, y1 - top), 1: slice(None), 2: slice(None)}
+        dst[tuple(index[axis] for axis in dst_order)] = block
+
+    if progress:
+        progress(1.0)
+
+def Reinterleave(fin, fout, interleave=None, data_type=None,
+                 top=0, bottom=None, left=0, right=None, bands=None,
+                 sort_wavelengths=False, use_bbl=False, progress=None):
+    """Copy image fin to a new image fout, optionally with another interleave
+(ENVI_bsq, ENVI_bil or ENVI_bip) or data type, a spatial subset and a
+selection of bands. See copy_image().
+
+Returns the new image.
+"""
+    im = Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
+
+    if bottom is None:
+        bottom = im.lines
+    if right is None:
+        right = im.samples
+    if bands is None:
+        bands = list(range(im.bands))
+
+    keys = dict(lines=bottom - top, samples=right - left, bands=len(bands),
+                interleave=interleave or im.header.interleave.lower())
+    for attr in ('wavelength', 'fwhm', 'band_names', 'bbl'):
+        if hasattr(im, attr):
+            keys[attr] = [getattr(im, attr)[i] for i in bands]
+    if data_type is not None:
+        keys['data_type'] = data_type
+
+    im2 = New(fout, hdr=im, **keys)
+
+    copy_image(im, im2, top=top, bottom=bottom, left=left, right=right,
+               bands=bands, progress=progress)
+
+    del im
+
+    return im2
+
@@ -25,6 +25,7 @@
 
 # load support for ENVI images
 import envi2
+from envi2.constants import STRIP_BYTES
 
 import numpy as np
 
@@ -100,6 +101,44 @@ ifilters = np.array([ifilter0, ifilter1, ifilter2, ifilter3, ifilter4, ifilter5,
 def message(s):
     pass
 
+def smooth_strip(data):
+    """Edge-preserving smoothing of a strip of lines data (lines, samples, bands).
+
+For every pixel the mean of the five values under each of the filters is
+taken, and the mean under the filter with the smallest busyness (sum of
+absolute differences) wins, the first filter on a tie. Filters with
+NaNs are skipped, pixels where every filter has NaNs become 0. Returns
+the result for data[2:-2, 2:-2, :].
+"""
+    # float data is handled in its own precision, like five.mean()
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype('d')
+
+    lines, samples = data.shape[0] - 4, data.shape[1] - 4
+    means = []
+    busys = []
+    for rows, cols in ifilters:
+        # the five values under the filter for all pixels, as shifted views
+        five = [data[r:r+lines, c:c+samples] for r, c in zip(rows, cols)]
+
+        total = five[0].copy()
+        for values in five[1:]:
+            total += values
+        means.append(total / len(five))
+
+        busy = np.fabs(five[0] - five[1])
+        for v0, v1 in zip(five[1:-1], five[2:]):
+            busy += np.fabs(v0 - v1)
+        busys.append(busy)
+
+    # filters with NaNs never win, pixels without a winner become 0
+    busys = np.array(busys)
+    busys[np.isnan(busys)] = np.inf
+    best = np.argmin(busys, axis=0)
+    result = np.take_along_axis(np.array(means), best[np.newaxis], axis=0)[0]
+    result[np.take_along_axis(busys, best[np.newaxis], axis=0)[0] == np.inf] = 0
+    return result
+
 def eps(nameIn, nameOut, message=message,
                   sort_wavelengths=False, use_bbl=False, progress=None):
     """Edge-Preserving Smoothing"""
@@ -126,28 +165,19 @@ def eps(nameIn, nameOut, message=message,
 ##        im2[j, 0, :]         = im[j, 0, :]
 ##        im2[j, samples-1, :] = im[j, samples-1, :]
 
-    # go for it!
+    # go for it! all bands of a strip of lines at once
     if progress:
         progress(0.0)
-    for b in range(bands): # bands
-        for j in range(2, lines-2):
-            if progress:
-                progress(j / float(lines))
-            for i in range(2, samples-2):
-                the_mean = 0
-                min_busy = np.inf
-                for ifilter in ifilters:
-                    values = im[j-2:j+3, i-2:i+3, b]
-                    five = values[ifilter]
-                    # mean
-                    mean = five.mean()
-                    # busyness
-                    busy = np.sum(np.fabs(five[0:-1] - five[1:]))
-                    if busy < min_busy:
-                        the_mean = mean
-                        min_busy = busy
-
-                im2[j, i, b] = the_mean
+    for top, bottom in im.strips(max_bytes=STRIP_BYTES // (4 * len(ifilters))):
+        # the two lines and samples along the edges are not filtered
+        top, bottom = max(top, 2), min(bottom, lines - 2)
+        if top >= bottom or samples < 5:
+            continue
+        if progress:
+            progress(top / float(lines))
+
+        data = im[top-2:bottom+2, :, :]
+        im2[top:bottom, 2:samples-2, :] = smooth_strip(data)
         
     if progress:
         progress(1.0)
@@ -26,37 +26,17 @@
 import envi2
 import numpy
 
+import replace_values
+from replace_values import LessThan, GreaterThan, Between
+
 def message(s):
     pass
 
-class Equal:
-    def __init__(self, value):
-        self.value = value
+# plain equality, unlike replace_values.Equal NaN never matches
+class Equal(replace_values.Equal):
     def test(self, n):
         return n == self.value
 
-class LessThan:
-    def __init__(self, value):
-        self.value = value
-
-    def test(self, n):
-        return n <= self.value
-
-class GreaterThan:
-    def __init__(self, value):
-        self.value = value
-
-    def test(self, n):
-        return n >= self.value
-
-class Between:
-    def __init__(self, value1, value2):
-        self.value1 = value1
-        self.value2 = value2
-        
-    def test(self, n):
-        return (self.value1 <= n) & (n <= self.value2)
-
 def parse(s):
     result = []
     for term in s.split():
@@ -73,9 +53,9 @@ def parse(s):
 
 def fixnodata(fin, fout, nodata=None,
               sort_wavelengths=False, use_bbl=True,
-              message=message, progress=None):
+              message=message, progress=None, all_bands=False, mask=None):
 
-    nodata = parse(nodata)
+    test = replace_values.compile_terms(parse(nodata))
 
     im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
 
@@ -84,53 +64,19 @@ def fixnodata(fin, fout, nodata=None,
     bbl = getattr(im, "bbl", None)
     fwhm = getattr(im, "fwhm", None)
 
-    im2 = envi2.New(fout, hdr=im, interleave='bsq', bbl=bbl,
+    # same interleave as the input, so strips are read and written in order
+    im2 = envi2.New(fout, hdr=im, interleave=im.header.interleave, bbl=bbl,
                           wavelength=wavelength,
                           data_type='d', band_names=band_names, fwhm=fwhm)
 
-##    # copy data
-##    im2[...] = im[...]
-##
-##    # replace nodata by NaN's
-##    for value in nodata:
-##        im2.data[numpy.where(value.test(im.data))] = numpy.nan
-
-    # copy data
-    im2[...] = im[...]
-
-    # replace nodata by NaN's
-    if progress:
-        progress(0.0)
-    for b in range(im.bands):
-        if progress:
-            progress(b / float(im.bands))
-        for value in nodata:
-            im2[b][numpy.where(value.test(im[b]))] = numpy.nan
-
-##    for j in range(im.lines):
-##        if j%10==0:
-##            message('.')
-##        for i in range(im.samples):
-##            for b in range(im.bands):
-##                for value in nodata:
-##                    pixel = im[j, i, b]
-##                    if value.test(pixel):
-##                        im2[j, i, b] = numpy.nan
-##                    else:
-##                        im2[j, i, b] = pixel
-
-##    for j in range(im.lines):
-##        if j%10 == 0:
-##            message('.')
-##        for i in range(im.samples):
-##            for b in range(im.bands):
-##                if im[j, i, b] in nodata:
-##                    im2[j, i, b] = numpy.nan
-
-    if progress:
-        progress(1.0)
-
-    del im, im2
+    if mask:
+        mask = replace_values.new_mask(mask, im)
+
+    # copy data, replacing nodata by NaN's
+    replace_values.replace_strips(im, im2, test, newdata=numpy.nan,
+                   all_bands=all_bands, mask=mask, progress=progress)
+
+    del im, im2, mask
 
 if __name__ == '__main__':
     # command line version
@@ -150,6 +96,9 @@ if __name__ == '__main__':
     parser.add_argument('-i', dest='input', help='input file name', required=True)
     parser.add_argument('-o', dest='output', help='output file name', required=True)
     parser.add_argument('-n', dest='nodata', help='list of nodata values (=string!)', required=True)
+    parser.add_argument('-a', action='store_true', dest='all_bands',
+                      help='set all bands of a pixel to NaN if any band matches')
+    parser.add_argument('-m', dest='mask', help='output mask file name of the changed pixels')
 
 ##    parser.set_defaults(sort_wavelengths=False, use_bbl=False, force=False)
 
@@ -162,4 +111,5 @@ if __name__ == '__main__':
 
     fixnodata(options.input, options.output, nodata=options.nodata,
               sort_wavelengths=options.sort_wavelengths,
-              use_bbl=options.use_bbl)
+              use_bbl=options.use_bbl,
+              all_bands=options.all_bands, mask=options.mask)
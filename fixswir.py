@@ -34,33 +34,84 @@ import sys
 def message(s):
     print(s)
 
-def checkstats(im):
-    stats = numpy.zeros(8)
-    line = numpy.mean(im[...], axis=(0, 2))
-    for i in range(8):
-        stats[i] = line[i::8].mean()
+PHASES = 8
+
+def phase_statistics(im, progress=None):
+    """Returns the mean of every band for each of the 8 sample phases,
+an array (8, bands). Phase i holds samples i, i+8, i+16, ...
+
+The image is read in strips, each strip is reshaped to
+(lines, samples/8, 8, bands) and summed for all bands at once."""
+    samples = im.samples
+    groups = -(-samples // PHASES)
+
+    total = numpy.zeros((PHASES, im.bands))
+    columns = numpy.bincount(numpy.arange(samples) % PHASES, minlength=PHASES)
+
+    if progress:
+        progress(0.0)
+    for top, bottom in im.strips():
+        if progress:
+            progress(top / float(im.lines))
+        data = numpy.zeros((bottom - top, groups * PHASES, im.bands))
+        data[:, :samples, :] = im[top:bottom, :, :]
+        total += data.reshape(bottom - top, groups, PHASES, im.bands).sum(axis=(0, 1))
+    if progress:
+        progress(1.0)
+
+    return total / (columns * im.lines)[:, numpy.newaxis]
+
+def checkstats(im, stats=None):
+    """Returns the first phase of which the mean deviates more than one
+standard deviation from the mean of all phases."""
+    if stats is None:
+        stats = phase_statistics(im)
+    stats = stats.mean(axis=1)
     m = stats.mean()
     s = stats.std()
 
     start = numpy.where(numpy.fabs(stats-m)>s)[0][0]
 
     return start
-    
+
+def fixstrip(data, start):
+    """Replace every 8th sample of data (lines, samples, bands), starting
+at sample start, by the average of its neighbours."""
+    samples = data.shape[1]
+    result = data.copy()
+
+    i = numpy.arange(start, samples, PHASES)
+    inner = i[(i > 0) & (i < samples-1)]
+    result[:, inner] = (data[:, inner-1] + data[:, inner+1]) / 2
+    if len(i) and i[0] == 0:
+        result[:, 0] = data[:, 1]
+    if len(i) and i[-1] == samples-1:
+        result[:, samples-1] = data[:, samples-2]
+
+    return result
+
 def fixswir(fin, fout, start=1, sort_wavelengths=False, use_bbl=False, message=message,
-            progress=None):
+            progress=None, dry_run=False):
     try:
         im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
     except ValueError as errtext:
         message("Error: %s\n" % (errtext,))
         return
 
+    if start is None or dry_run:
+        message("Phase statistics...")
+        stats = phase_statistics(im)
+
+    if dry_run:
+        for phase, mean in enumerate(stats.mean(axis=1)):
+            message("Phase %d: mean %g" % (phase, mean))
+        message("First bad sample detected at x=%d" % (checkstats(im, stats),))
+        del im
+        return stats
+
     if start is None:
-        start = checkstats(im)
+        start = checkstats(im, stats)
         message("First bad sample detected at x=%d" % (start,))
-    
-    samples = im.samples
-    lines = im.lines
-    bands = im.bands
 
     # Create new image
     try:
@@ -69,9 +120,6 @@ def fixswir(fin, fout, start=1, sort_wavelengths=False, use_bbl=False, message=m
         message("Error: %s" % (errtext,))
         return
 
-    message("Copying data...")
-    im2[...] = im[...]
-
     message("Processing...")
     if progress:
         progress(0.0)
@@ -83,16 +131,11 @@ def fixswir(fin, fout, start=1, sort_wavelengths=False, use_bbl=False, message=m
 ##        for i in range(1, samples, 8):
 ##            im2[j, i] = (im[j, i-1] + im[j, i+1]) / 2
 
-    # Fast version...
-    for i in range(start, samples, 8):
+    # Fast version, copy and fix in one pass
+    for top, bottom in im.strips():
         if progress:
-            progress(i / samples)
-        if i==0:
-            im2[:, i] = im[:, i+1]
-        elif i==samples-1:
-            im2[:, i] = im[:, i-1]
-        else:
-            im2[:, i] = (im[:, i-1] + im[:, i+1]) / 2
+            progress(top / float(im.lines))
+        im2[top:bottom, :, :] = fixstrip(im[top:bottom, :, :], start)
 
     if progress:
         progress(1.0)
@@ -118,12 +161,17 @@ if __name__ == '__main__':
     parser.add_argument('-f', action='store_true', dest='force',
                       help='force overwrite on existing output file')
     parser.add_argument('-i', dest='input', help='input image file name', required=True)
-    parser.add_argument('-o', dest='output', help='output image file name', required=True)
+    parser.add_argument('-o', dest='output', help='output image file name')
+    parser.add_argument('-n', action='store_true', dest='dry_run',
+                      help='dry run, only report the statistics of the 8 phases')
 
     options = parser.parse_args()
 
-    if not options.force and os.path.exists(options.output):
-        sys.exit("Output file exists. Use -f to overwrite.")
+    if not options.dry_run:
+        if not options.output:
+            sys.exit("Output file required. Use -o output.")
+        if not options.force and os.path.exists(options.output):
+            sys.exit("Output file exists. Use -f to overwrite.")
 
     fixswir(options.input, options.output, sort_wavelengths=options.sort_wavelengths,
-             use_bbl=options.use_bbl)
+             use_bbl=options.use_bbl, dry_run=options.dry_run)
@@ -1,30 +1,63 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
 import envi2
+from envi2.constants import STRIP_BYTES
 from circle import *
-from numpy import *
+from numpy import array, zeros, int64, bincount, concatenate, nonzero, newaxis
 
 ##MAXSIZE=100
 
-# globals
-xs = None
-ys = None
-zs = None
-
-def AddPixel(x, y, r):
-    global xs, ys, zs
-    xs.append(x)
-    ys.append(y)
-    zs.append(r)
-
 def message(s):
     print(s)
 
-def hough_transform(fin, fout, minsize, maxsize, stepsize=1, threshold=128,
-                    message=message, progress=None):
-    global xs, ys, zs
-    xs = []
+def hough_template(radii):
+    """Returns (ys, xs, zs), the offsets of the hough cone.
+
+Band zs holds the circle of radius radii[zs]. Every (ys, xs, zs)
+occurs only once, so an edge pixel adds at most 1 to every cell."""
     ys = []
+    xs = []
     zs = []
+    for z, radius in enumerate(radii):
+        x, y = CircleOffsets(radius)
+        xs.extend(x)
+        ys.extend(y)
+        zs.extend([z] * len(x))
+    return array(ys), array(xs), array(zs)
+
+def edge_pixels(im, threshold):
+    """Returns (y, x), the coordinates of the pixels above threshold."""
+    ys = []
+    xs = []
+    for top, bottom in im.strips():
+        y, x = nonzero(im[top:bottom, :, 0] > threshold)
+        ys.append(y + top)
+        xs.append(x)
+    return concatenate(ys), concatenate(xs)
+
+def accumulate(y, x, ys, xs, zs, lines, samples, bands):
+    """Returns the hough accumulator (lines, samples, bands) for edge
+pixels y, x and cone offsets ys, xs, zs. The offsets must already be
+shifted into the accumulator.
+
+The votes are counted with bincount over batches of edge pixels, sized
+such that a batch takes about as much memory as the accumulator."""
+    size = lines * samples * bands
+    acc = zeros(size, dtype=int64)
+
+    # flat index of the cone, relative to the edge pixel
+    cone = (ys * samples + xs) * bands + zs
+    batch = max(1, size // max(1, len(cone)))
+    for i in range(0, len(y), batch):
+        pixel = (y[i:i+batch] * samples + x[i:i+batch]) * bands
+        index = (pixel[:, newaxis] + cone).ravel()
+        acc += bincount(index, minlength=size)
+
+    return acc.reshape(lines, samples, bands)
 
+def hough_transform(fin, fout, minsize, maxsize, stepsize=1, threshold=128,
+                    message=message, progress=None, threads=None):
     # get ENVI image data
     im = envi2.Open(fin)
 
@@ -33,9 +66,11 @@ def hough_transform(fin, fout, minsize, maxsize, stepsize=1, threshold=128,
 
 ##    print im.lines, im.samples, im.bands
 
+    radii = list(range(minsize, maxsize, stepsize))
+
     lines   = im.lines + 2 * maxsize
     samples = im.samples + 2 * maxsize
-    bands   = (maxsize - minsize) // stepsize
+    bands   = len(radii)
     x_start = -maxsize
     y_start = -maxsize
 
@@ -45,33 +80,53 @@ def hough_transform(fin, fout, minsize, maxsize, stepsize=1, threshold=128,
     if hasattr(im.header, 'y_start'):
         y_start += im.header.y_start
 
-    band_names = ['radius ' + str(s) for s in range(minsize, maxsize, stepsize)]
+    band_names = ['radius ' + str(s) for s in radii]
 
     # open output Hough Transform image
-    hough = envi2.New(fout, 
+    hough = envi2.New(fout,
                       hdr=im.header, lines=lines, samples=samples, bands=bands,
                       x_start=x_start, y_start=y_start,
                       data_type='d',
                       band_names=band_names)
 
-    # construct coordinate list of hough cone
-    for radius in range(minsize, maxsize, stepsize):
-        MidpointCircle(0, 0, radius, writepix=AddPixel)
-
-    # convert to array
-    xs = array(xs)
-    ys = array(ys)
-    zs = (array(zs) - minsize) // stepsize
- 
-    count = 0
-    y, x, z = where(im.data>threshold)
+    y, x = edge_pixels(im, threshold)
+
+    # groups of radii that are accumulated in memory, accumulator, bincount
+    # result and indices of all threads together take about STRIP_BYTES,
+    # fewer threads if one radius per thread does not fit
+    band_bytes = 3 * 8 * lines * samples
+    if threads is None:
+        threads = os.cpu_count() or 1
+    threads = max(1, min(threads, STRIP_BYTES // band_bytes))
+    group = max(1, STRIP_BYTES // (threads * band_bytes))
+    todo = iter(range(0, bands, group))
+
+    def task(b0):
+        b1 = min(b0 + group, bands)
+        ys, xs, zs = hough_template(radii[b0:b1])
+        hough[:, :, b0:b1] = accumulate(y, x, ys + maxsize, xs + maxsize, zs,
+                                        lines, samples, b1 - b0)
+        return b1 - b0
+
+    done = 0
+    pending = set()
     if progress:
         progress(0.0)
-    for i in range(len(x)):
-        if progress:
-            progress(i / float(len(x)))
-        count += 1
-        hough[ys+maxsize+y[i], xs+maxsize+x[i], zs] += 1
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            # radius groups are independent, at most threads in memory
+            while len(pending) < threads:
+                try:
+                    pending.add(pool.submit(task, next(todo)))
+                except StopIteration:
+                    break
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done += future.result()
+                if progress:
+                    progress(done / float(bands))
 
     if progress:
         progress(1.0)
@@ -83,4 +138,4 @@ if __name__ == '__main__':
 
 ##    fin = '/data/Data/AgentschapNL/Areas/area1/koeltoren_envi_grad_ID'
 ##    fout = '/tmp/hough'
-##    hough_transform(fin, fout, 50, 70, 5, 100) 
+##    hough_transform(fin, fout, 50, 70, 5, 100)
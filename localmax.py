@@ -25,6 +25,7 @@
 
 # load support for ENVI images
 import envi2
+import convolve
 
 import numpy
 
@@ -96,7 +97,7 @@ def median(nameIn, nameOut, mode='med27', message=message,
 
 
 def fast_localmax(nameIn, nameOut, kernel, message=message,
-             sort_wavelengths=False, use_bbl=False):
+             sort_wavelengths=False, use_bbl=False, threads=None):
     im = envi2.Open(nameIn, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
 
     lines = im.lines
@@ -122,27 +123,28 @@ def fast_localmax(nameIn, nameOut, kernel, message=message,
 ##        im2[j, 0, :]         = im[j, 0, :]
 ##        im2[j, samples-1, :] = im[j, samples-1, :]
 
-    a = numpy.zeros((lines, samples, len(kernel)))
+    # radius of every band
+    radii = numpy.array([int(name.split()[1]) for name in im.band_names])
 
-    # go for it!
-    for b in range(0, bands-0): # bands
-        message('.')
-        counter = 0
-        for j, i, bshift in kernel:
-            if 0<=(b+bshift-1)<bands:
-                a[1:-1, 1:-1, counter] = im[j:(lines+j-2), i:(samples+i-2), (b+bshift-1)]
-                counter += 1
+    def work(data, b0, b1):
+        # bands beyond the image are -inf, so they never win
+        result = convolve.neighbours(data, kernel).max(axis=0)
 
-        result = a.max(axis=2)
+        radius = radii[b0:b1]
+        tmp = data[1:-1, 1:-1, 1:-1]
+        return ((tmp > result) & (tmp > radius)) * radius
 
-        radius = int(im.band_names[b].split()[1])
-        tmp = im[1:-1, 1:-1, b]
-        im2[1:-1, 1:-1, b] = ((tmp > result[1:-1, 1:-1]) & (tmp > radius)) * radius
+    # go for it!
+    filter_window = (slice(1, lines-1), slice(1, samples-1))
+    convolve.filter_slabs(im, im2, work, filter_window, halo=1,
+                          fill=-numpy.inf, copies=len(kernel)+1,
+                          threads=threads,
+                          progress=lambda fraction: message('.'))
 
     message('\n')
 
     # destroy resources
-    del im2, im, a
+    del im2, im
 
 if __name__ == '__main__':
     # command line version
@@ -29,9 +29,8 @@
 ##
 
 import envi2
+from envi2.constants import STRIP_BYTES
 import numpy
-##from scipy.stats.stats import nanmean, nanstd
-from numpy import nanmean, nanstd
 
 try:
     from pylab import plot, title, xlabel, ylabel, ion, show, draw
@@ -45,13 +44,192 @@ LINEWIDTH = 1.0
 def message(s):
     pass
 
-def logresiduals(fin, fout, albedo=None, rlub=None, N=3.0,
-                 sort_wavelengths=False, use_bbl=True,
-                 message=message, progress=None):
-
+# number of bins of the histograms for finding the highest 1%
+BINS = 1024
+
+# maximum number of extra reads that narrow down the highest 1%
+MAX_REFINE = 4
+
+class BandHistograms:
+    """Histograms of BINS bins of the finite values of every band.
+
+The range of a band grows while values are added: when a value falls
+outside, pairs of bins are merged into bins of twice the width, so the
+counts stay exact. -inf values are only counted."""
+    def __init__(self, bands):
+        self.counts = numpy.zeros((bands, BINS), dtype=int)
+        self.origin = numpy.zeros(bands)
+        self.width = numpy.zeros(bands) # 0 as long as a band has no values
+        self.ninf = numpy.zeros(bands, dtype=int)
+
+    def grow(self, b, down):
+        """Double the width of the bins of band b, extending the range
+below (down) or above the current range."""
+        merged = self.counts[b].reshape(-1, 2).sum(axis=1)
+        empty = numpy.zeros(BINS // 2, dtype=int)
+        if down:
+            self.counts[b] = numpy.hstack((empty, merged))
+            self.origin[b] -= BINS * self.width[b]
+        else:
+            self.counts[b] = numpy.hstack((merged, empty))
+        self.width[b] *= 2
+
+    def add(self, v):
+        """Add the values v (pixels, bands), NaNs are ignored."""
+        finite = numpy.isfinite(v)
+        self.ninf += (v == -numpy.inf).sum(axis=0)
+
+        some = finite.any(axis=0)
+        vmin = numpy.where(finite, v, numpy.inf).min(axis=0)
+        vmax = numpy.where(finite, v, -numpy.inf).max(axis=0)
+
+        # the first values of a band set its range
+        first = some & (self.width == 0)
+        span = vmax - vmin
+        self.origin[first] = vmin[first]
+        self.width[first] = numpy.where(span > 0, span / (BINS - 1),
+                                        numpy.maximum(numpy.fabs(vmin), 1.0) / BINS)[first]
+
+        outside = some & ((vmin < self.origin) | (vmax >= self.origin + BINS * self.width))
+        for b in numpy.nonzero(outside)[0]:
+            while vmin[b] < self.origin[b]:
+                self.grow(b, True)
+            while vmax[b] >= self.origin[b] + BINS * self.width[b]:
+                self.grow(b, False)
+
+        index = self.index(numpy.where(finite, v, self.origin), self.origin, self.width)
+        bands = numpy.arange(len(self.width))
+        self.counts += numpy.bincount((bands * BINS + index)[finite],
+                            minlength=len(bands) * BINS).reshape(-1, BINS)
+
+    @staticmethod
+    def index(v, origin, width):
+        return ((v - origin) / width).clip(0, BINS - 1).astype(int)
+
+def window(counts, k, origin, width):
+    """Returns (lo, hi, size), the range of the bin holding the value at
+index k of the sorted values of every band, plus one bin on either side
+for rounding, and the number of values in it."""
+    bands = numpy.arange(len(k))
+    cumulative = counts.cumsum(axis=1)
+    target = (cumulative <= k[:, numpy.newaxis]).sum(axis=1).clip(0, BINS - 1)
+    first = (target - 1).clip(0, BINS - 1)
+    last = (target + 1).clip(0, BINS - 1)
+    size = cumulative[bands, last] - cumulative[bands, first] + counts[bands, first]
+    return origin + first * width, origin + (last + 1) * width, size
+
+def rank_values(rank, n, histograms, normalized, message=message):
+    """Returns the value at index rank[b] of the sorted valid values of
+every band b, NaN for bands without values (n[b] == 0).
+
+histograms are the BandHistograms of all values, normalized() yields the
+values again, as strips (pixels, bands), for every extra read. Windows
+around the ranks are narrowed down with histograms of BINS bins until
+their values take at most STRIP_BYTES, then the values in the windows
+are collected and the ranks are looked up exactly."""
+    mx = numpy.full(len(rank), numpy.nan)
+
+    finite = histograms.counts.sum(axis=1)
+    k = rank - histograms.ninf
+    mx[(n > 0) & (k < 0)] = -numpy.inf
+    mx[(n > 0) & (k >= finite)] = numpy.inf
+    todo = (n > 0) & (k >= 0) & (k < finite)
+
+    lo, hi, size = window(histograms.counts, k, histograms.origin, histograms.width)
+
+    for i in range(MAX_REFINE):
+        if size[todo].sum() * 8 <= STRIP_BYTES:
+            break
+        message('Narrowing down RLUB windows, %d values' % (size[todo].sum(),))
+
+        # histograms of the values in the windows
+        width = (hi - lo) / BINS
+        counts = numpy.zeros((len(rank), BINS), dtype=int)
+        below = numpy.zeros(len(rank), dtype=int)
+        wmin = numpy.full(len(rank), numpy.inf)
+        wmax = numpy.full(len(rank), -numpy.inf)
+        bands = numpy.arange(len(rank))
+        for v in normalized():
+            inside = todo & (v >= lo) & (v < hi)
+            below += (todo & (v < lo)).sum(axis=0)
+            wmin = numpy.fmin(wmin, numpy.where(inside, v, numpy.inf).min(axis=0))
+            wmax = numpy.fmax(wmax, numpy.where(inside, v, -numpy.inf).max(axis=0))
+            index = BandHistograms.index(numpy.where(inside, v, lo), lo, width)
+            counts += numpy.bincount((bands * BINS + index)[inside],
+                                     minlength=len(rank) * BINS).reshape(-1, BINS)
+
+        # windows holding one distinct value are done
+        k = rank - below
+        single = todo & (wmin == wmax) & (k >= 0) & (k < counts.sum(axis=1))
+        mx[single] = wmin[single]
+        todo &= ~single
+
+        previous = size[todo].sum()
+        lo, hi, size = window(counts, k, lo, width)
+        if size[todo].sum() >= previous:
+            break
+
+    # collect the values in the windows
+    below = numpy.zeros(len(rank), dtype=int)
+    found = []
+    for v in normalized():
+        inside = todo & (v >= lo) & (v < hi)
+        below += (todo & (v < lo)).sum(axis=0)
+        pixel, band = numpy.nonzero(inside)
+        found.append((band, v[pixel, band]))
+
+    if found:
+        band = numpy.concatenate([f[0] for f in found])
+        values = numpy.concatenate([f[1] for f in found])
+        for b in numpy.nonzero(todo)[0]:
+            inside = values[band == b]
+            j = rank[b] - below[b]
+            if 0 <= j < len(inside):
+                mx[b] = numpy.partition(inside, j)[j]
+
+    return mx
+
+def normalize_strip(a, kwik=False, norm=None):
+    """Returns (v, norm), the normalized spectra of strip a (lines, samples,
+bands) as an array (pixels, bands), and the normalizer of every pixel.
+
+For kwik residuals v = a / m with m the mean of the spectrum, for log
+residuals v = log(a) - lm with lm the mean of the log of the spectrum,
+so exp(lm) is the geometric mean. Values <= 0 are NaN for log residuals.
+If norm is given it is used instead of computing it again."""
+    bands = a.shape[2]
+    if kwik:
+        if norm is None:
+            valid = ~numpy.isnan(a)
+            norm = numpy.where(valid, a, 0.0).sum(axis=2) / valid.sum(axis=2)
+        v = a / norm[:, :, numpy.newaxis]
+    else:
+        la = numpy.log(numpy.where(a > 0.0, a, numpy.nan))  ## LOG
+        if norm is None:
+            # geometric mean
+            valid = ~numpy.isnan(la)
+            norm = numpy.where(valid, la, 0.0).sum(axis=2) / valid.sum(axis=2)
+        v = la - norm[:, :, numpy.newaxis]
+    return v.reshape(-1, bands), norm
+
+def residuals(fin, fout, kwik=False, albedo=None, rlub=None, N=3.0,
+              sort_wavelengths=False, use_bbl=True, lines=None,
+              message=message, progress=None):
+    """Log residuals (kwik=False) or kwik residuals (kwik=True).
+
+The image is read in strips of lines. Pass 1 determines the albedo of
+every pixel (geometric mean for log residuals, mean for kwik residuals),
+the statistics of the normalized spectra per band, and histograms of
+the normalized values of every band. These locate the value below which
+99% of the normalized values of every band lie, the values around it are
+read once more, see rank_values(). Pass 2 writes the normalized spectra
+divided by the robust least upper bound (RLUB).
+
+Next to the strips only the normalizer of every pixel, the histograms and
+at most STRIP_BYTES of values around the 99% are kept in memory.
+"""
     im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
 
-#    im2 = envi2.New('/tmp/znorm', hdr=im, interleave='bsq', data_type='d')
     if albedo:
         imalbedo = envi2.New(albedo, hdr=im, interleave='bsq', data_type='d',
                              bands=1, wavelength=None, bbl=None, fwhm=None,
@@ -63,61 +241,68 @@ def logresiduals(fin, fout, albedo=None, rlub=None, N=3.0,
 
     im3 = envi2.New(fout, hdr=im, interleave='bsq', data_type='d', bbl=bbl)
 
-    im2 = im3
-
     oldsettings = numpy.seterr(all='ignore')
 
+    strips = list(im.strips(lines=lines))
+
+    def read(top, bottom):
+        # a copy, the image data may be read-only
+        return numpy.array(im.get_strip(top, bottom, copy=False), dtype='float')
+
     message('Pass 1: normalize spectra by albedo')
-    
+
+    norms = numpy.zeros((im.lines, im.samples))
+
+    # per band sum, sum of squares, count and histogram of the normalized values
+    s1 = numpy.zeros(im.bands)
+    s2 = numpy.zeros(im.bands)
+    n = numpy.zeros(im.bands, dtype=int)
+    histograms = BandHistograms(im.bands)
+
     if progress:
         progress(0.0)
 
-    for j in range(im.lines):
+    for k, (top, bottom) in enumerate(strips):
         if progress:
-            progress(j / float(im.lines))
-        for i in range(im.samples):
-            spec = im[j, i].astype('float')
-            spec[numpy.where(spec<=0.0)] = numpy.nan
-            # geometric mean
-            m = numpy.e**nanmean(numpy.log(spec))  ## LOG + EXP
+            progress(k / float(len(strips)))
 
-            im2[j, i] = spec / m
+        v, norms[top:bottom] = normalize_strip(read(top, bottom), kwik)
 
-            if albedo:
-                imalbedo[j, i] = m
+        valid = ~numpy.isnan(v)
+        s1 += numpy.where(valid, v, 0.0).sum(axis=0)
+        s2 += numpy.where(valid, v * v, 0.0).sum(axis=0)
+        n += valid.sum(axis=0)
+        histograms.add(v)
 
-    im2.flush()
+    if kwik:
+        means = norms
+    else:
+        means = numpy.e**norms  ## EXP
 
     if albedo:
+        imalbedo[...] = means[:, :, numpy.newaxis]
         del imalbedo
-    
+
     message('\n')
 
-    message('Pass 2: determine RLUB (ignore highest 1%)')
+    message('Determine RLUB (ignore highest 1%)')
     message('Using %f Standard Deviations' % (N,))
 
-    slub = numpy.zeros(im.bands)
+    m = s1 / n
+    s = numpy.sqrt(s2 / n - m**2)
 
-    if progress:
-        progress(0.0)
+    def normalized():
+        for top, bottom in strips:
+            yield normalize_strip(read(top, bottom), kwik, norms[top:bottom])[0]
 
-    for b in range(im2.bands):
-        if progress:
-            progress(b / float(im2.bands))
-        band = im2[b].flatten().astype('float')
-        band[numpy.where(band<=0.0)] = numpy.nan
-        #geometric mean
-        band = numpy.log(band)  ## LOG
-        m = nanmean(band)
-        s = nanstd(band)
-#        mx = band.max()
-##        band = band.flatten()
-        # Take out any NaN's in the band...
-        band = band[numpy.where(numpy.isnan(band)==False)]
-        band.sort()
-        mx = band[int(len(band)*0.99)]
-        
-        slub[b] = numpy.e**min((m + N * s), mx)  ## EXP
+    # value at index int(n * 0.99) of the sorted valid values per band
+    mx = rank_values((n * 0.99).astype(int), n, histograms, normalized,
+                     message=message)
+
+    if kwik:
+        slub = numpy.minimum(m + N * s, mx)
+    else:
+        slub = numpy.e**numpy.minimum(m + N * s, mx)  ## EXP
 
     message('\n')
 
@@ -147,139 +332,41 @@ def logresiduals(fin, fout, albedo=None, rlub=None, N=3.0,
                 ftxt.write('%d %f\n' % (i, slub[i]))
         ftxt.close()
 
-    message('Pass 3: divide spectra by RLUB')
+    message('Pass 2: divide spectra by RLUB')
     
     if progress:
         progress(0.0)
 
-    for j in range(im2.lines):
+    for k, (top, bottom) in enumerate(strips):
         if progress:
-            progress(j / float(im2.lines))
-        for i in range(im2.samples):
-            im3[j, i] = im2[j, i] / slub
+            progress(k / float(len(strips)))
+
+        a = read(top, bottom)
+        if not kwik:
+            a = numpy.where(a > 0.0, a, numpy.nan)
+
+        im3[top:bottom, :, :] = a / (means[top:bottom, :, numpy.newaxis] * slub)
 
     if progress:
         progress(1.0)
 
     numpy.seterr(**oldsettings)
 
-    del im, im2, im3
+    del im, im3
 
-def kwikresiduals(fin, fout, albedo=None, rlub=None, N=3.0,
+def logresiduals(fin, fout, albedo=None, rlub=None, N=3.0,
                  sort_wavelengths=False, use_bbl=True,
                  message=message, progress=None):
+    residuals(fin, fout, kwik=False, albedo=albedo, rlub=rlub, N=N,
+              sort_wavelengths=sort_wavelengths, use_bbl=use_bbl,
+              message=message, progress=progress)
 
-    im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
-
-#    im2 = envi2.New('/tmp/znorm', hdr=im, interleave='bsq', data_type='d')
-    if albedo:
-        imalbedo = envi2.New(albedo, hdr=im, interleave='bsq', data_type='d',
-                             bands=1, wavelength=None, bbl=None, fwhm=None,
-                             band_names=['Albedo of %s' % (fin,)])
-
-    bbl = None
-    if hasattr(im, 'bbl'):
-        bbl = im.bbl
-
-    im3 = envi2.New(fout, hdr=im, interleave='bsq', data_type='d', bbl=bbl)
-
-    im2 = im3
-
-    oldsettings = numpy.seterr(all='ignore')
-
-    message('Pass 1: normalize spectra by albedo')
-    
-    if progress:
-        progress(0.0)
-
-    for j in range(im.lines):
-        if progress:
-            progress(j / float(im.lines))
-        for i in range(im.samples):
-            spec = im[j, i]
-##            m = spec.mean()
-            m = nanmean(spec)
-
-            im2[j, i] = spec / m
-
-            if albedo:
-                imalbedo[j, i] = m
-
-    im2.flush()
-
-    if albedo:
-        del imalbedo
-    
-    message('\n')
-
-    message('Pass 2: determine RLUB (ignoring highest 1%)')
-    message('Using %f Standard Deviations' % (N,))
-
-    slub = numpy.zeros(im.bands)
-
-    if progress:
-        progress(0.0)
-
-    for b in range(im2.bands):
-        if progress:
-            progress(b / float(im2.bands))
-        band = im2[b].flatten()
-##        m = band.mean()
-        m = nanmean(band)
-##        s = band.std()
-        s = nanstd(band)
-#        mx = band.max()
-##        band = band.flatten()
-        # Take out any NaN's in the band...
-        band = band[numpy.where(numpy.isnan(band)==False)]
-        band.sort()
-        mx = band[int(len(band)*0.99)]
-        
-        slub[b] = min((m + N * s), mx)
-
-    message('\n')
-
-    # Plot RLUB, if we can...
-    if HAS_PYLAB:
-        if hasattr(im, 'wavelength'):
-            plot(im.wavelength, slub, linewidth=LINEWIDTH)
-            xlabel('wavelength')
-        else:
-            plot(slub, linewidth=LINEWIDTH)
-            xlabel('band')
-
-        ylabel('RLUB')
-        title('Robust Least Upper Bound')
-
-    # write RLUB to text file
-    if rlub:
-        ftxt = open(rlub, 'w')
-        if hasattr(im, 'wavelength'):
-            ftxt.write('Wavelength RLUB\n')
-            for i in range(im.bands):
-                ftxt.write('%f %f\n' % (im.wavelength[i], slub[i]))
-        else:        
-            ftxt.write('Band RLUB\n')
-            for i in range(im.bands):
-                ftxt.write('%d %f\n' % (i, slub[i]))
-        ftxt.close()
-
-    message('Pass 3: divide spectra by RLUB')
-    
-    if progress:
-        progress(0.0)
-    for j in range(im2.lines):
-        if progress:
-            progress(j / float(im2.lines))
-        for i in range(im2.samples):
-            im3[j, i] = im2[j, i] / slub
-
-    if progress:
-        progress(1.0)
-
-    numpy.seterr(**oldsettings)
-
-    del im, im2, im3
+def kwikresiduals(fin, fout, albedo=None, rlub=None, N=3.0,
+                 sort_wavelengths=False, use_bbl=True,
+                 message=message, progress=None):
+    residuals(fin, fout, kwik=True, albedo=albedo, rlub=rlub, N=N,
+              sort_wavelengths=sort_wavelengths, use_bbl=use_bbl,
+              message=message, progress=progress)
 
 if __name__ == '__main__':
 ##    logresiduals('/data/Data/Tmp/logres/Rodalquilar_01_rad_geo_sub2', '/data/Data/Tmp/logres/Rodalquilar_01_rad_geo_sub2_lr')
@@ -25,6 +25,7 @@
 
 import os
 import envi2
+from envi2.constants import STRIP_BYTES
 import numpy
 import time
 
@@ -34,6 +35,8 @@ ion()
 #from scipy.stats.stats import nanmean, nanstd
 from numpy import nanmean, nanstd
 
+from spectrumblock import merge_moments
+
 def message(s):
     print(s)
 
@@ -61,9 +64,69 @@ def local_busyness(band):
     y = nanmean(numpy.fabs(band[1:, :] - band[:-1, :]).flatten())
     return max(x, y)
 
+def noise_statistics(im, step=1, progress=None):
+    """Returns (mean, std, busyness) of every band of image im, in one
+pass over strips of lines. See local_busyness() and normalize.
+
+The differences are taken in float64. local_busyness() takes them in the
+data type of the image, where they wrap around for unsigned integers,
+which makes every band of e.g. a uint16 image look busy.
+
+With step > 1 only every step-th line and sample is used, together with
+its right and lower neighbour for the busyness, for a fast estimate."""
+    lines = im.lines
+    samples = im.samples
+    bands = im.bands
+
+    n = numpy.zeros(bands)
+    mean = numpy.zeros(bands)
+    m2 = numpy.zeros(bands)
+
+    # sums and counts of the absolute differences, along lines and samples
+    x_sum = numpy.zeros(bands)
+    x_count = numpy.zeros(bands)
+    y_sum = numpy.zeros(bands)
+    y_count = numpy.zeros(bands)
+
+    # pairs of neighbours in the sample direction
+    left = numpy.arange(0, samples-1, step)
+
+    for top, bottom in im.strips(max_bytes=STRIP_BYTES // 4):
+        if progress:
+            progress(top / float(lines))
+        first = top + (-top % step)
+        if first >= bottom:
+            continue
+
+        # sampled lines of the strip and the lines below them
+        if step == 1:
+            block = im.get_strip(top, min(bottom+1, lines), copy=False).astype('float64')
+            data = block[:bottom-top]
+            below = block[1:]
+        else:
+            data = im[first:bottom:step, :, :].astype('float64')
+            below = im[first+1:min(bottom+1, lines):step, :, :].astype('float64')
+
+        n, mean, m2 = merge_moments(n, mean, m2,
+                                    data[:, ::step, :].reshape(-1, bands))
+
+        dx = numpy.fabs(data[:, left+1, :] - data[:, left, :]).reshape(-1, bands)
+        dy = numpy.fabs(below[:, ::step, :] - data[:len(below), ::step, :]).reshape(-1, bands)
+        for d, total, count in ((dx, x_sum, x_count), (dy, y_sum, y_count)):
+            valid = ~numpy.isnan(d)
+            total += numpy.where(valid, d, 0.0).sum(axis=0)
+            count += valid.sum(axis=0)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = numpy.where(n > 0, mean, numpy.nan)
+        std = numpy.sqrt(m2 / n)
+        busyness = numpy.fmax(x_sum / x_count, y_sum / y_count)
+
+    return mean, std, busyness
+
 def mask_noisy_bands(fin, threshold=20.0,
                  sort_wavelengths=False, use_bbl=False,
-                 message=message, progress=None):
+                 message=message, progress=None, step=1):
     im = envi2.Open(fin, sort_wavelengths=False, use_bbl=False)
 
     snr = []
@@ -71,15 +134,11 @@ def mask_noisy_bands(fin, threshold=20.0,
     message("band: mean, std, snr, mean/busyness")
     if progress:
         progress(0.0)
+    means, stds, busyness = noise_statistics(im, step=step, progress=progress)
     for b in range(im.bands):
-        if progress:
-            progress(b / float(im.bands))
-        band = im[b]
-        busy = local_busyness(band)
-        
-        band = im[b].flatten()
-        m = nanmean(band)
-        s = nanstd(band)
+        m = means[b]
+        s = stds[b]
+        busy = busyness[b]
         message("%d: %.2f, %.2f, %.2f, %.2f" % (b, m, s, (m/s)**2, (m/busy)))
         if s == 0.0:
             snr.append(0.0)
@@ -115,6 +174,10 @@ def mask_noisy_bands(fin, threshold=20.0,
 
     message("Setting up new header")
     hdr = envi2.Header(hdr=im, bbl=new_bbl, original_bbl=original_bbl)
+    # same file, keep its band order
+    if hasattr(im.header, 'band_order'):
+        hdr.band_order = im.header.band_order
+        hdr.to_attrlist('band_order')
 
     if progress:
         progress(1.0)
@@ -161,8 +224,10 @@ if __name__ == '__main__':
                       help='plot signal to noise ratio and threshold')
     parser.add_option('-t', dest='threshold', type='float',
                       help='threshold for bad bands')
+    parser.add_option('-d', dest='step', type='int',
+                      help='use every d-th line and sample only, for a fast estimate')
 
-    parser.set_defaults(threshold=20.0, verbose=False, plot=False)
+    parser.set_defaults(threshold=20.0, verbose=False, plot=False, step=1)
 
     (options, args) = parser.parse_args()
 
@@ -172,10 +237,10 @@ if __name__ == '__main__':
 
     if options.verbose:
         mask_noisy_bands(options.input, threshold=options.threshold,
-                         message=message)
+                         message=message, step=options.step)
     else:
         mask_noisy_bands(options.input, threshold=options.threshold,
-                         message=silent)
+                         message=silent, step=options.step)
 
     if options.plot:
         show()
@@ -25,6 +25,7 @@
 
 # load support for ENVI images
 import envi2
+import convolve
 
 import numpy
 ##import scipy.stats
@@ -363,7 +364,7 @@ def median27(nameIn, nameOut, message=message,
 ##    del im2, im, a
 
 def fast_median(nameIn, nameOut, kernel, message=message,
-             sort_wavelengths=False, use_bbl=False, progress=None):
+             sort_wavelengths=False, use_bbl=False, progress=None, threads=None):
     im = envi2.Open(nameIn, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
 
     lines = im.lines
@@ -380,45 +381,27 @@ def fast_median(nameIn, nameOut, kernel, message=message,
     # copy edges of the original image
     im2[0]       = im[0]
     im2[bands-1] = im[bands-1]
-    
-    for i in range(samples):
-        im2[0, i, :]       = im[0, i, :]
-        im2[lines-1, i, :] = im[lines-1, i, :]
 
-    for j in range(lines):
-        im2[j, 0, :]         = im[j, 0, :]
-        im2[j, samples-1, :] = im[j, samples-1, :]
+    im2[0, :, :]         = im[0, :, :]
+    im2[lines-1, :, :]   = im[lines-1, :, :]
+    im2[:, 0, :]         = im[:, 0, :]
+    im2[:, samples-1, :] = im[:, samples-1, :]
 
-    a = numpy.zeros((lines, samples, len(kernel)))
+    def work(data, b0, b1):
+        # all neighbours of all pixels of the slab at once
+        return nanmedian(convolve.neighbours(data, kernel), axis=0)
 
     # go for it!
-    if progress:
-        progress(0.0)
-    for b in range(1, bands-1): # bands
-        if progress:
-            progress(b / float(bands))
-        counter = 0
-        for j, i, bshift in kernel:
-            a[1:-1, 1:-1, counter] = im[j:(lines+j-2), i:(samples+i-2), (b+bshift-1)]
-            counter += 1
-
-        # note: numpy version >= 1.40 will put nan's at the end!
-##        a.sort(axis=2)
-##
-##        im2[1:-1, 1:-1, b] = a[1:-1, 1:-1, (len(kernel)-1)/2]
-
-        result = nanmedian(a, axis=2)
-
-        im2[1:-1, 1:-1, b] = result[1:-1, 1:-1]
-
-    if progress:
-        progress(1.0)
+    filter_window = (slice(1, lines-1), slice(1, samples-1))
+    convolve.filter_slabs(im, im2, work, filter_window, first=1, last=bands-1,
+                          halo=1, copies=len(kernel)+1, threads=threads,
+                          progress=progress)
 
     # destroy resources
-    del im2, im, a
+    del im2, im
 
 def fast_mean(nameIn, nameOut, kernel, message=message,
-             sort_wavelengths=False, use_bbl=False, progress=None):
+             sort_wavelengths=False, use_bbl=False, progress=None, threads=None):
     im = envi2.Open(nameIn, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
 
     lines = im.lines
@@ -435,41 +418,24 @@ def fast_mean(nameIn, nameOut, kernel, message=message,
     # copy edges of the original image
     im2[0]       = im[0]
     im2[bands-1] = im[bands-1]
-    
-    for i in range(samples):
-        im2[0, i, :]       = im[0, i, :]
-        im2[lines-1, i, :] = im[lines-1, i, :]
 
-    for j in range(lines):
-        im2[j, 0, :]         = im[j, 0, :]
-        im2[j, samples-1, :] = im[j, samples-1, :]
+    im2[0, :, :]         = im[0, :, :]
+    im2[lines-1, :, :]   = im[lines-1, :, :]
+    im2[:, 0, :]         = im[:, 0, :]
+    im2[:, samples-1, :] = im[:, samples-1, :]
 
-    a = numpy.zeros((lines, samples, len(kernel)))
+    def work(data, b0, b1):
+        # all neighbours of all pixels of the slab at once
+        return numpy.nanmean(convolve.neighbours(data, kernel), axis=0)
 
     # go for it!
-    if progress:
-        progress(0.0)
-    for b in range(1, bands-1): # bands
-        if progress:
-            progress(b / float(bands))
-        counter = 0
-        for j, i, bshift in kernel:
-            a[1:-1, 1:-1, counter] = im[j:(lines+j-2), i:(samples+i-2), (b+bshift-1)]
-            counter += 1
-
-##        result = a.mean(axis=2)
-##
-##        im2[1:-1, 1:-1, b] = result[1:-1, 1:-1]
-
-        result = numpy.nanmean(a, axis=2)
-
-        im2[1:-1, 1:-1, b] = result[1:-1, 1:-1]
-
-    if progress:
-        progress(1.0)
+    filter_window = (slice(1, lines-1), slice(1, samples-1))
+    convolve.filter_slabs(im, im2, work, filter_window, first=1, last=bands-1,
+                          halo=1, copies=len(kernel)+1, threads=threads,
+                          progress=progress)
 
     # destroy resources
-    del im2, im, a
+    del im2, im
 
 if __name__ == '__main__':
     # command line version
@@ -27,6 +27,7 @@
 import os
 import glob
 import sys
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Try to import from Pillow or PIL
 try:
@@ -49,7 +50,183 @@ import calibration
 def message(s):
     print(s)
 
-def convert_meteosat(pattern, output, message=message):
+def time_stamps(fnames, message=message):
+    """Get the time stamps of the images from the file names only.
+The images are not opened. Returns lists of linear times and band names."""
+    wavelength = []
+    band_names = []
+    for fname in fnames:
+        base = os.path.basename(fname)
+        message("Inspecting '%s'" % (base,))
+
+        year, month, day, hour, minute = timestr.time_from_string(base)
+        band_names.append("%4d%02d%02d%02d%02d" % (year, month, day, hour, minute))
+
+        ltime = gregorian.to_linear_time(year, month, day, hour, minute)
+        message("Linear time: %f" % (ltime,))
+##        print gregorian.from_linear_time(ltime)
+
+        # add linear time to the list of 'wavelengths'
+        wavelength.append(ltime)
+
+    return wavelength, band_names
+
+def decode_slot(fname, band, is_calibrated):
+    """Decode one GeoTIFF into a brightness temperature array.
+Runs in a worker thread, so it does not send any messages itself. Returns
+(band, BT, info) where info is a list of message strings for the caller."""
+    try:
+        im = Image.open(fname)
+        im.load()
+    except Exception as errtext:
+        raise ValueError('%s on file %s band %d' % (errtext, fname, band))
+
+    base = os.path.basename(fname)
+    info = []
+
+    if is_calibrated:
+        info.append("Convering: %s" % (base,))
+        info.append('Calibration SKIPPED')
+
+        BT = numpy.asarray(im)
+    else:
+        year, month, day, hour, minute = timestr.time_from_string(base)
+        calib = calibration.get_coeffs(year, month, day, hour, minute)
+
+        alpha = calib[-2]
+        space_count = calib[-1]
+
+        info.append("Calibrating: %s" % (base,))
+        info.append('Calibration data: %f %f' % (alpha, space_count))
+
+        data = numpy.asarray(im).astype('d')
+
+        # convert to radiance
+        radiance = alpha * (data - space_count)
+
+        # convert to brightness temperature
+        A = 6.7348
+        B = -1272.2
+        BT = B / (numpy.log(radiance) - A)
+
+    if BT.shape != (im.size[1], im.size[0]):
+        raise ValueError('unexpected image shape %s on file %s band %d' % (BT.shape, fname, band))
+
+    im.close()
+
+    info.append("Average scene brightness temperature: %.1f Kelvin" % (BT.mean()))
+
+    return band, BT, info
+
+def stack_slots(fnames, data, first_band=0, is_calibrated=True,
+                threads=None, message=message, progress=None):
+    """Decode the files in a thread pool and write every band into the
+memmap data (bands, lines, samples) as soon as its decode has finished.
+
+At most 2 * threads images are in flight, so memory use does not grow
+with the number of slots."""
+    if threads is None:
+        threads = os.cpu_count() or 1
+    threads = max(1, threads)
+
+    total = len(fnames)
+    todo = iter(enumerate(fnames))
+    pending = set()
+    done_count = 0
+
+    if progress:
+        progress(0.0)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            # keep the pool fed
+            while len(pending) < 2 * threads:
+                try:
+                    i, fname = next(todo)
+                except StopIteration:
+                    break
+                pending.add(pool.submit(decode_slot, fname,
+                                        first_band + i, is_calibrated))
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                band, BT, info = future.result()
+                for s in info:
+                    message(s)
+                data[band] = BT
+                done_count = done_count + 1
+                if progress:
+                    progress(done_count / float(total))
+
+    if progress:
+        progress(1.0)
+
+def append_meteosat(fnames, output, is_calibrated=True, threads=None,
+                    message=message, progress=None):
+    """Append new slots to an existing BSQ stack.
+
+Slots that are already in the stack (by band name) are skipped. The data
+file is extended in place and only the new bands are written, the header
+gets its bands, wavelength and band_names updated."""
+    h = envi2.Header(output, sort_wavelengths=False, use_bbl=False)
+
+    if h.interleave.lower() != envi2.constants.ENVI_bsq and h.bands > 1:
+        raise ValueError('%s: can only append to a BSQ stack' % (output,))
+
+    im = Image.open(fnames[0])
+    samples, lines = im.size
+    del im
+    if (samples, lines) != (h.samples, h.lines):
+        raise ValueError('image size %dx%d does not match stack size %dx%d' %
+                         (samples, lines, h.samples, h.lines))
+
+    band_names = list(getattr(h, 'band_names', []))
+    wavelength = list(getattr(h, 'wavelength', []))
+
+    new_wavelength, new_band_names = time_stamps(fnames, message=message)
+
+    # band names like 200301010000 are read back from the header as numbers
+    known = set(str(name) for name in band_names)
+    keep = [k for k in range(len(fnames)) if new_band_names[k] not in known]
+    message("Appending %d new slots to %d existing bands" % (len(keep), h.bands))
+
+    if not keep:
+        return
+
+    fnames = [fnames[k] for k in keep]
+    old_bands = h.bands
+    new_bands = len(fnames)
+
+    dtype = numpy.dtype(h.data_type)
+    band_size = h.lines * h.samples * dtype.itemsize
+
+    # extend the data file, the old bands stay where they are
+    with open(output, 'r+b') as f:
+        f.truncate((old_bands + new_bands) * band_size)
+
+    data = numpy.memmap(output, mode='r+', dtype=dtype,
+                        offset=old_bands * band_size,
+                        shape=(new_bands, h.lines, h.samples))
+
+    stack_slots(fnames, data, is_calibrated=is_calibrated,
+                threads=threads, message=message, progress=progress)
+
+    data.flush()
+    del data
+
+    # only now update the header, so a failure leaves a consistent stack
+    h.bands = old_bands + new_bands
+    h.wavelength = wavelength + [new_wavelength[k] for k in keep]
+    h.band_names = band_names + [new_band_names[k] for k in keep]
+    h.to_attrlist('wavelength')
+    h.to_attrlist('band_names')
+    h.write(output)
+
+def convert_meteosat(pattern, output, append=False, threads=None,
+                     message=message, progress=None):
     # figure out input files from the pattern
 
     fnames = sorted(glob.glob(pattern))
@@ -81,6 +258,12 @@ def convert_meteosat(pattern, output, message=message):
         is_calibrated = False
     ##    raise ValueError('Unsupported image mode')
 
+    if append and os.path.exists(output):
+        del im
+        append_meteosat(fnames, output, is_calibrated=is_calibrated,
+                        threads=threads, message=message, progress=progress)
+        return
+
     # figure out byte order of the machine
     if sys.byteorder == 'little':
         byte_order = 0
@@ -98,22 +281,8 @@ def convert_meteosat(pattern, output, message=message):
 
     del im
 
-    # loop over file names to get time stamps of images
-    wavelength = []
-    band_names = []
-    for fname in fnames:
-        base = os.path.basename(fname)
-        message("Inspecting '%s'" % (base,))
-
-        year, month, day, hour, minute = timestr.time_from_string(base)
-        band_names.append("%4d%02d%02d%02d%02d" % (year, month, day, hour, minute))
-
-        ltime = gregorian.to_linear_time(year, month, day, hour, minute)
-        message("Linear time: %f" % (ltime,))
-##        print gregorian.from_linear_time(ltime)
-        
-        # add linear time to the list of 'wavelengths'
-        wavelength.append(ltime)
+    # get time stamps of images from the file names
+    wavelength, band_names = time_stamps(fnames, message=message)
 
     # open the output image
     im2 = envi2.New(output, file_type=envi2.constants.ENVI_Standard,
@@ -124,52 +293,13 @@ def convert_meteosat(pattern, output, message=message):
                     map_info=map_info, band_names=band_names)
 
     # and here we go...
-    band = 0
-    for fname in fnames:
-        try:
-            im = Image.open(fname)
-        except Exception as errtext:
-            raise ValueError('%s on file %s band %d' % (errtext, fname, band))
+    # im2.data is a BIP view, write into the raw (band, line, sample) memmap
+    data = im2.data.transpose(2, 0, 1)
 
-        base = os.path.basename(fname)
-
-        if is_calibrated:
-            message("Convering: %s" % (base,))
-            message('Calibration SKIPPED')
-            
-            im.load()
-            # again, DON'T ASK!!!
-            BT = numpy.array(im.getdata()).reshape(im.size[::-1])
-        else:
-            year, month, day, hour, minute = timestr.time_from_string(base)
-            calib = calibration.get_coeffs(year, month, day, hour, minute)
-
-            alpha = calib[-2]
-            space_count = calib[-1]
-
-            message("Calibrating: %s" % (base,))
-            message('Calibration data: %f %f' % (alpha, space_count))
-            
-            im.load()
-            # again, DON'T ASK!!!
-            data = numpy.array(im.getdata()).reshape(im.size[::-1])
-
-            # convert to radiance
-            radiance = alpha * (data - space_count)
-
-            # convert to brightness temperature
-            A = 6.7348
-            B = -1272.2
-            BT = B / (numpy.log(radiance) - A)
-
-        message("Average scene brightness temperature: %.1f Kelvin" % (BT.mean()))
-        
-        im2[band] = BT
-
-        del im
-        band = band + 1
+    stack_slots(fnames, data, is_calibrated=is_calibrated,
+                threads=threads, message=message, progress=progress)
 
-    del im2
+    del data, im2
 
 if __name__=='__main__':
     pattern = r'/data/Data/Nadira/format1/*.tif'
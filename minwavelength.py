@@ -25,7 +25,8 @@
 
 # load support for ENVI images
 import envi2
-from quickhull2d import hull_resampled
+import spectrumblock
+import numpy
 from numpy import array, nanmin, nanmax, where, isnan, seterr, isfinite, nan
 
 ##from scipy.stats.stats import nanmean, nanstd
@@ -76,6 +77,16 @@ def localminima(y, x, band):
             result.append((y[i], x[i], band[i]))
     return sorted(result)
 
+def narrowness(wavs, y, band):
+    """Coefficient a of the parabola through band and its two neighbors,
+for every row of y. Zero at the edges."""
+    edge = (band==0) | (band==len(wavs)-1)
+    i = where(edge, 1, band)
+    rows = numpy.arange(len(y))
+    a = spectrumblock.parabola(wavs[i-1], wavs[i], wavs[i+1],
+                               y[rows, i-1], y[rows, i], y[rows, i+1])[2]
+    return where(edge, 0.0, a)
+
 def message(s):
     pass
 
@@ -106,64 +117,61 @@ def minwavelength(nameIn, nameOut, maskfile=None, mode='div',
 
     startband = im.wavelength2index(startwav)
     endband = im.wavelength2index(endwav) + 1 # modified to include the endwav
-    wavs = im.wavelength[startband:endband]
+    wavs = numpy.asarray(im.wavelength[startband:endband], dtype='d')
 
     oldsettings = seterr(all='ignore')
 
     # go for it!
     if progress:
         progress(0.0)
-    for j in range(lines):
+    for top, bottom in im.strips():
         if progress:
-            progress(j / float(lines))
-        for i in range(samples):
-          if not mask or mask[j, i, 0]:
-            spec = im[j, i][startband:endband]
-            if isfinite(spec).all():
-                spec_hull = hull_resampled(array(list(zip(wavs, spec))))[:,1]
-                if mode.lower()=='div':
-                    hull_removed = spec / spec_hull
-                elif mode.lower()=='sub':
-                    hull_removed = 1 + (spec - spec_hull)
-                else:
-                    hull_removed = spec
-
-                # find minimum and store wavelength of minimum
-                miny, minx, minband = sorted(zip(hull_removed, wavs, list(range(len(wavs)))))[0]
-                im2[j,i,0] = minx
-
-                # fit parabola and retrieve useful parameters
-                if minband==0 or minband==len(wavs)-1:
-                    zx, zy = minx, miny
-                    a = 0
-                else:
-                    x = array([wavs[minband-1] , minx, wavs[minband+1]])
-                    y = array([hull_removed[minband-1] , miny, hull_removed[minband+1]])
-                    (zx, zy), (a, b, c) = fit_parabola(x, y)
-
-                im2[j, i, 1] = zx
-                im2[j, i, 2] = 1-zy
-                im2[j, i, 3] = a
-
-                nextband = 4
-
-                # determine wavelength and depth of the first three local minima...
-                for y1, x1, b1 in localminima(hull_removed, wavs, list(range(len(wavs))))[:3]:
-                    im2[j, i, nextband] = x1
-                    nextband = nextband + 1
-                    im2[j, i, nextband] = 1 - y1
-                    nextband = nextband + 1
-                    if INTERPOLATE_ALL:
-                        x = array([wavs[b1-1] , x1, wavs[b1+1]])
-                        y = array([hull_removed[b1-1] , y1, hull_removed[b1+1]])
-                        (zx, zy), (a, b, c) = fit_parabola(x, y)
-
-                        im2[j, i, nextband] = zx
-                        nextband = nextband + 1
-                        im2[j, i, nextband] = 1-zy
-                        nextband = nextband + 1
-                        im2[j, i, nextband] = a
-                        nextband = nextband + 1
+            progress(top / float(lines))
+
+        block = im[top:bottom, :, startband:endband].reshape((-1, len(wavs)))
+        valid = isfinite(block).all(axis=1)
+        if mask is not None:
+            valid &= mask[top:bottom, :, :][:, :, 0].ravel() != 0
+        if not valid.any():
+            continue
+
+        spec = block[valid].astype('d')
+        hull_removed = spectrumblock.nohull(wavs, spec, mode=mode.lower())
+
+        result = numpy.full((len(spec), len(BAND_NAMES)), nan)
+
+        # find minimum and store wavelength of minimum
+        minband = hull_removed.argmin(axis=1)
+        result[:, 0] = wavs[minband]
+
+        # fit parabola and retrieve useful parameters
+        zx, zy = spectrumblock.fitparabola(wavs, hull_removed, minband[:, numpy.newaxis])
+        a = narrowness(wavs, hull_removed, minband)
+        edge = (minband==0) | (minband==len(wavs)-1)
+        zx[edge, 0] = wavs[minband[edge]]
+        zy[edge, 0] = hull_removed[edge, minband[edge]]
+
+        result[:, 1] = zx[:, 0]
+        result[:, 2] = 1 - zy[:, 0]
+        result[:, 3] = a
+
+        # determine wavelength and depth of the first three local minima...
+        idx = spectrumblock.localminidx(hull_removed, 3)
+        zx, zy = spectrumblock.fitparabola(wavs, hull_removed, idx)
+        step = 5 if INTERPOLATE_ALL else 2
+        for k in range(3):
+            found = idx[:, k] >= 0
+            b1 = idx[found, k]
+            result[found, 4+step*k] = wavs[b1]
+            result[found, 5+step*k] = 1 - hull_removed[found, b1]
+            if INTERPOLATE_ALL:
+                result[found, 6+step*k] = zx[found, k]
+                result[found, 7+step*k] = 1 - zy[found, k]
+                result[found, 8+step*k] = narrowness(wavs, hull_removed[found], b1)
+
+        out = numpy.full((len(block), len(BAND_NAMES)), nan)
+        out[valid] = result
+        im2[top:bottom, :, :] = out.reshape((bottom - top, samples, len(BAND_NAMES)))
 
     if progress:
         progress(1.0)
@@ -27,6 +27,7 @@
 # load support for ENVI images
 import envi2
 import spectrum
+import spectrumblock
 
 import numpy
 
@@ -70,25 +71,46 @@ def minwavelength(nameIn, nameOut, maskfile=None, mode='div',
 
     startband = im.wavelength2index(startwav)
     endband = im.wavelength2index(endwav) + 1 # modified to include the endwav
-    wavs = im.wavelength[startband:endband]
+    wavs = numpy.asarray(im.wavelength[startband:endband], dtype='d')
 
 ##    # create a spectral subset view on the image
 ##    imsub = im[:, :, startband:endband]
 
+    nb = endband - startband
+
     # go for it!
     if progress:
         progress(0.0)
-    for j in range(lines):
+    for top, bottom in im.strips():
         if progress:
-            progress(j / float(lines))
-        for i in range(samples):
-            if not mask or mask[j, i, 0]:
-                S = spectrum.Spectrum(wavelength=wavs, spectrum=im[j, i, startband:endband])
-
-                minwavs = sorted(S.minwav(numfeatures, mode=mode, broad=broad).tuple(), key=lambda x:x[1], reverse=True)
-                for k in range(len(minwavs)):
-                    im2[j, i, 2*k]   = minwavs[k][0]
-                    im2[j, i, 2*k+1] = minwavs[k][1]
+            progress(top / float(lines))
+
+        block = im[top:bottom, :, startband:endband].reshape((-1, nb))
+        valid = numpy.ones(len(block), dtype=bool)
+        if mask is not None:
+            valid &= mask[top:bottom, :, :][:, :, 0].ravel() != 0
+        finite = valid & numpy.isfinite(block).all(axis=1)
+
+        out = numpy.full((len(block), numfeatures*2), numpy.nan)
+
+        # all spectra without NaN's in one go...
+        if finite.any():
+            minwav, depth = spectrumblock.minwav(wavs, block[finite], numfeatures,
+                                                 mode=mode, broad=broad)
+            order = numpy.argsort(-depth, axis=1, kind='stable')
+            out[finite, 0::2] = numpy.take_along_axis(minwav, order, axis=1)
+            out[finite, 1::2] = numpy.take_along_axis(depth, order, axis=1)
+
+        # ...the remaining spectra one by one
+        for p in numpy.where(valid & ~finite)[0]:
+            S = spectrum.Spectrum(wavelength=wavs, spectrum=block[p])
+
+            minwavs = sorted(S.minwav(numfeatures, mode=mode, broad=broad).tuple(), key=lambda x:x[1], reverse=True)
+            for k in range(len(minwavs)):
+                out[p, 2*k]   = minwavs[k][0]
+                out[p, 2*k+1] = minwavs[k][1]
+
+        im2[top:bottom, :, :] = out.reshape((bottom - top, samples, numfeatures*2))
 
     if progress:
         progress(1.0)
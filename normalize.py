@@ -23,13 +23,39 @@
 ##     Netherlands
 ##
 
+import numpy
+
 import envi2
 ##from scipy.stats.stats import nanmean, nanstd
 from numpy import nanmean, nanstd
 
+from spectrumblock import merge_moments
+
 def message(s):
     pass
 
+def band_statistics(im, progress=None):
+    """Mean and standard deviation of every band of image im, ignoring NaNs,
+like nanmean() and nanstd() of the bands.
+
+The image is read once, in strips of lines. The statistics of the strips
+are merged with merge_moments()."""
+    n = numpy.zeros(im.bands)
+    mean = numpy.zeros(im.bands)
+    m2 = numpy.zeros(im.bands)
+
+    for top, bottom in im.strips():
+        if progress:
+            progress(top / float(im.lines))
+        strip = im.get_strip(top, bottom, copy=False).astype('float64').reshape(-1, im.bands)
+        n, mean, m2 = merge_moments(n, mean, m2, strip)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = numpy.where(n > 0, mean, numpy.nan)
+        std = numpy.sqrt(m2 / n)
+
+    return mean, std
+
 def normalize(fin, fout, add_stdev=0.0, sort_wavelengths=False, use_bbl=True,
               message=message, progress=None):
     im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
@@ -38,18 +64,19 @@ def normalize(fin, fout, add_stdev=0.0, sort_wavelengths=False, use_bbl=True,
 
     if progress:
         progress(0.0)
-    for i in range(im.bands):
+
+    # first pass, statistics of all bands
+    m, s = band_statistics(im,
+                           progress=progress and (lambda f: progress(f / 2.0)))
+
+    # second pass, normalize all bands of a strip at once
+    for top, bottom in im.strips():
         if progress:
-            progress(i / float(im.bands))
+            progress(0.5 + top / float(2 * im.lines))
         
-        one = im[i]
-        onef = one.flatten()
-        m = nanmean(onef)
-        s = nanstd(onef)
-
-        data = (one - m) / s + add_stdev
+        one = im.get_strip(top, bottom, copy=False).astype('float64')
 
-        im2[i] = data[:,:]
+        im2[top:bottom, :, :] = (one - m) / s + add_stdev
 
     if progress:
         progress(1.0)
@@ -47,6 +47,12 @@ def planck(l, T):
     c2 = H * C / K
     return c1 / (l**5 * (math.e**(c2/(l * T)) - 1.0))
 
+# derivative of planck(l, T) to the temperature T
+def dplanck_dT(l, T):
+    c2 = H * C / K
+    x = c2 / (l * T)
+    return planck(l, T) * (x / T) / (1.0 - math.e**-x)
+
 def inverse_planck(l, I):
     K1 = 2 * H * C**2 * l**-5
     K2 = (H * C) / (K * l)
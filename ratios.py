@@ -45,17 +45,17 @@ def ratios(fin, fout, delta=1, sort_wavelengths=False, use_bbl=True,
                           wavelength=wavelength,
                           data_type='d', band_names=None, fwhm=None)
 
+    bands = im.bands - delta
+
     if progress:
         progress(0.0)
-    for i in range(im.bands-delta):
+    # all band pairs of a strip of lines at once
+    for top, bottom in im.strips():
         if progress:
-            progress(i / float(im.bands-delta))
-        one = im.get_band(i).astype('float64')
-        two = im.get_band(i+delta).astype('float64')
-
-        data = one / two
+            progress(top / float(im.lines))
+        strip = im.get_strip(top, bottom, copy=False).astype('float64')
 
-        im2[:,:,i] = data[:,:]
+        im2[top:bottom, :, :] = strip[:, :, :bands] / strip[:, :, delta:]
 
     if progress:
         progress(1.0)
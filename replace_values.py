@@ -83,19 +83,86 @@ def parse(s):
             result.append(Equal(float(term)))
     return result
 
+def compile_terms(terms):
+    """Compile a list of terms into a single test(n) that returns the
+mask of all values of n that match any of the terms.
+
+The finite Equal values are tested with one isin(), the LessThan and
+GreaterThan terms fold into one comparison each."""
+    equal = []
+    lower = []
+    upper = []
+    other = []
+    for term in terms:
+        if isinstance(term, Equal) and numpy.isfinite(term.value):
+            equal.append(term.value)
+        elif isinstance(term, LessThan) and not numpy.isnan(term.value):
+            lower.append(term.value)
+        elif isinstance(term, GreaterThan) and not numpy.isnan(term.value):
+            upper.append(term.value)
+        else:
+            other.append(term)
+
+    def test(n):
+        result = numpy.zeros(n.shape, dtype=bool)
+        if lower:
+            result |= n <= max(lower)
+        if upper:
+            result |= n >= min(upper)
+        if equal:
+            result |= numpy.isin(n, equal)
+        for term in other:
+            result |= term.test(n)
+        return result
+
+    return test
+
+def replace_strips(im, im2, test, newdata=numpy.nan, filler=None,
+                   all_bands=False, mask=None, progress=None):
+    """Copy image im to im2, replacing the values for which test() is true
+by newdata, or by the values of image filler if given.
+
+With all_bands a pixel is replaced in all bands if any band matches.
+If mask is an image of 1 band, it records the pixels that changed.
+The images are processed in strips of lines, in one pass."""
+    if progress:
+        progress(0.0)
+    for top, bottom in im.strips():
+        if progress:
+            progress(top / float(im.lines))
+        data = im[top:bottom, :, :]
+        here = test(data)
+        if all_bands:
+            here = here.any(axis=2, keepdims=True)
+        if filler is not None:
+            new = filler[top:bottom, :, :]
+        else:
+            new = newdata
+        im2[top:bottom, :, :] = numpy.where(here, new, data)
+        if mask is not None:
+            mask[top:bottom, :, :] = here.any(axis=2, keepdims=True)
+    if progress:
+        progress(1.0)
+
+def new_mask(fname, im):
+    """Set up a sidecar mask image for im, 1 where pixels changed."""
+    return envi2.New(fname, hdr=im, bands=1, interleave='bsq',
+                     data_type='B', band_names=['changed'],
+                     wavelength=None, fwhm=None, bbl=None)
+
 def replace_values(fin, fout, nodata=None, newdata='nan',
               sort_wavelengths=False, use_bbl=True,
-              message=message, progress=None):
+              message=message, progress=None, all_bands=False, mask=None):
+
+    test = compile_terms(parse(nodata))
 
-    nodata = parse(nodata)
-    
     if os.path.exists(newdata):
         filler = envi2.Open(newdata, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
-        from_file = True
+        newdata = numpy.nan
     else:
         newdata = float(newdata)
-        from_file = False
-        
+        filler = None
+
     im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
 
     band_names = getattr(im, "band_names", None)
@@ -103,57 +170,19 @@ def replace_values(fin, fout, nodata=None, newdata='nan',
     bbl = getattr(im, "bbl", None)
     fwhm = getattr(im, "fwhm", None)
 
-    im2 = envi2.New(fout, hdr=im, interleave='bsq', bbl=bbl,
+    # same interleave as the input, so strips are read and written in order
+    im2 = envi2.New(fout, hdr=im, interleave=im.header.interleave, bbl=bbl,
                           wavelength=wavelength,
                           data_type='d', band_names=band_names, fwhm=fwhm) # data_type='d'
 
-##    # copy data
-##    im2[...] = im[...]
-##
-##    # replace nodata by NaN's
-##    for value in nodata:
-##        im2.data[numpy.where(value.test(im.data))] = numpy.nan
-
-    # copy data
-    im2[...] = im[...]
-
-    # replace nodata by NaN's
-    if progress:
-        progress(0.0)
-    for b in range(im.bands):
-        if progress:
-            progress(b / float(im.bands))
-        for value in nodata:
-            if from_file:   # values from file
-                here = numpy.where(value.test(im[b]))
-                im2[b][here] = filler[b][here]
-            else:           # constant value
-                im2[b][numpy.where(value.test(im[b]))] = newdata
-
-##    for j in range(im.lines):
-##        if j%10==0:
-##            message('.')
-##        for i in range(im.samples):
-##            for b in range(im.bands):
-##                for value in nodata:
-##                    pixel = im[j, i, b]
-##                    if value.test(pixel):
-##                        im2[j, i, b] = numpy.nan
-##                    else:
-##                        im2[j, i, b] = pixel
-
-##    for j in range(im.lines):
-##        if j%10 == 0:
-##            message('.')
-##        for i in range(im.samples):
-##            for b in range(im.bands):
-##                if im[j, i, b] in nodata:
-##                    im2[j, i, b] = numpy.nan
+    if mask:
+        mask = new_mask(mask, im)
 
-    if progress:
-        progress(1.0)
+    # copy data, replacing nodata
+    replace_strips(im, im2, test, newdata=newdata, filler=filler,
+                   all_bands=all_bands, mask=mask, progress=progress)
 
-    del im, im2
+    del im, im2, mask, filler
 
 if __name__ == '__main__':
     # command line version
@@ -174,6 +203,9 @@ if __name__ == '__main__':
     parser.add_argument('-o', dest='output', help='output file name', required=True)
     parser.add_argument('-n', dest='nodata', help='list of nodata values (=string!)', required=True)
     parser.add_argument('-v', dest='newdata', help='new output value(s), can be NaN or another image file', default='nan')
+    parser.add_argument('-a', action='store_true', dest='all_bands',
+                      help='replace all bands of a pixel if any band matches')
+    parser.add_argument('-m', dest='mask', help='output mask file name of the changed pixels')
 
 ##    parser.set_defaults(sort_wavelengths=False, use_bbl=False, force=False, newdata=float('nan'))
 
@@ -187,4 +219,5 @@ if __name__ == '__main__':
     replace_values(options.input, options.output, nodata=options.nodata,
                    newdata=options.newdata,
               sort_wavelengths=options.sort_wavelengths,
-              use_bbl=options.use_bbl)
+              use_bbl=options.use_bbl,
+              all_bands=options.all_bands, mask=options.mask)
@@ -28,46 +28,17 @@ import envi2
 from envi2.constants import *
 
 import numpy as np
-from scipy.interpolate import interp1d
-from scipy.optimize import fmin, minimize
 import sys
 
+import distortion
+
 import time
 
 def message(s):
     print(s)
 
-## function for minimization process...
-## s is the shift
-def f(s, spec1, f2, z):
-    gain = s[0]
-    shift = s[1]
-
-    z2 = (gain*z + shift).clip(0, len(z)-1)
-    data1 = spec1[z][2:-2] # cut off some of the edges...
-    data2 = f2(z2)[2:-2]
-    
-##    z2 = gain*z + shift
-##
-##    overlap = np.where((0<=z2)&(z2<=(len(z)-1)))
-##
-##    data1 = spec1[z[overlap]]
-##    data2 = f2(z2[overlap])
-
-    # determine normalized autocorrelation...
-    a = data1
-    b = data2
-##    a = (a - np.mean(a)) / (np.std(a) * len(a))
-##    b = (b - np.mean(b)) / (np.std(b))
-##    c = -np.correlate(a, b)[0] # turn maximum into minimum...
-
-    a = a - a.mean()
-    b = b - b.mean()
-    c = -np.dot(a / np.linalg.norm(a), b / np.linalg.norm(b))
-    return c
-
 def smile(fin, fout, sort_wavelengths=False, use_bbl=False, message=message,
-            progress=None, full=False):
+            progress=None, full=False, fcorrected=None, use_cache=False):
     try:
         im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
     except ValueError as errtext:
@@ -87,51 +58,44 @@ def smile(fin, fout, sort_wavelengths=False, use_bbl=False, message=message,
         message("Error: %s" % (errtext,))
         return
 
-##    midsample = samples // 2
-##    midsample = 3
-##    message("midsample: %d" % (midsample,))
-    
-    fullz = np.arange(bands)
-
-    jstep = 1 if full else max(1, lines//20)
-    message("line step %d" % (jstep,))
+    # the sensor may have been characterized before...
+    model = distortion.load_model(im, 'smile') if use_cache else None
 
     if progress:
         progress(0.0)
 
-    for i in range(samples):
+    if model is not None:
+        message("Using cached smile model %s" % (distortion.cache_name(im, 'smile'),))
+        accu_smile = model['smile']
+    else:
+        jstep = 1 if full else max(1, lines//20)
+
+        accu_smile = distortion.estimate_smile(im, jstep=jstep, message=message,
+                                               progress=progress)
+
+        if use_cache:
+            distortion.save_model(im, 'smile', smile=accu_smile)
+
+    im2[:, :] = accu_smile[:, :, np.newaxis]
+
+    del im2
+
+    if fcorrected:
+        message("Correcting smile...")
+        try:
+            im3 = envi2.New(fcorrected, value=np.nan, hdr=im)
+        except Exception as errtext:
+            message("Error: %s" % (errtext,))
+            return
+
         if progress:
-            progress(i/samples)
-
-        count = 0
-        accu_smile = np.zeros(fullz.shape)
-        for j in range(0, lines, jstep):
-            if jstep==1:
-                spec1 = im[j, 0, :]
-                spec2 = im[j, i, :]
-            else:
-                spec1 = np.mean(im[j:j+jstep, 0, :], axis=(0,))
-                spec2 = np.mean(im[j:j+jstep, i, :], axis=(0,))
-
-##            f1 = interp1d(fullz, spec1, kind='quadratic')
-            f2 = interp1d(fullz, spec2, kind='cubic') # spec2 interpolated with cubic spline...
-
-##            result = fmin(f, [1.0, 0.0], (spec1, f2, fullz), ftol=0.000001, full_output=1, disp=0)
-##            g_max = result[0][0]
-##            s_max = result[0][1]
-##            c_max = -result[1] # turn minimum into maximum...
-
-            result = minimize(f, [1.0, 0.0], (spec1, f2, fullz))
-            g_max = result.x[0]
-            s_max = result.x[1]
-            c_max = -result.fun # turn minimum into maximum...
-
-            if c_max > 0.9: # only record good correlations...
-                accu_smile = accu_smile + ((g_max - 1) * fullz + s_max)
-                count = count + 1
-
-        im2[:, i] = accu_smile[:, np.newaxis] / count
-    
+            progress(0.0)
+
+        # samples without a good correlation are left as they are
+        distortion.apply_smile(im, im3, np.nan_to_num(accu_smile), progress=progress)
+
+        del im3
+
     if progress:
         progress(1.0)
 
@@ -151,12 +115,16 @@ if __name__ == '__main__':
                       help='use bad band list from the header')
     parser.add_argument('-i', dest='input', help='input image file name', required=True)
     parser.add_argument('-o', dest='output', help='output smile file name', required=True)
+    parser.add_argument('-r', dest='corrected', help='output smile corrected image file name')
+    parser.add_argument('-c', action='store_true', dest='use_cache',
+                      help='use (and store) the cached smile model of the sensor')
 
     options = parser.parse_args()
 
     smile(options.input, options.output,
           sort_wavelengths=options.sort_wavelengths,
-          use_bbl=options.use_bbl)
+          use_bbl=options.use_bbl, fcorrected=options.corrected,
+          use_cache=options.use_cache)
 
 ##    smile('/data2/data/SWIRtest/2018-08-06_15-05-07_SWIR_smile/2018-08-06_15-05-07_SWIR_smile_dwref2_fx8',
 ##          use_bbl=True)
@@ -33,9 +33,13 @@
 
 #import string
 
+import os
+
 import envi2
 import envi2.resample
+import darkwhiteref
 
+import numpy
 from numpy import array
 
 def message(s):
@@ -62,10 +66,56 @@ def sort_wav(wav, spec):
     data = sorted(zip(wav, spec))
     return [x[0] for x in data], [x[1] for x in data]
 
+# resampled solar spectra, key is (image wavelengths, solar file, mtime)
+_solar_cache = {}
+
+def solar_resampled(wavelength, solar_spectrum=None, message=message):
+    """Solar spectrum resampled to the (sorted) wavelengths.
+
+Without a solar_spectrum file wavelength.dat and specsol_0403.dat are used.
+The result is cached per wavelength set and solar file, a file that
+changed on disk is read again.
+"""
+    if solar_spectrum:
+        message('Result will be absolute relectance.')
+        fnames = (solar_spectrum,)
+    else:
+        message('Sun-Mars distance NOT taken into account!')
+        message('Result will NOT be absolute relectance.')
+        fnames = ('wavelength.dat', 'specsol_0403.dat')
+
+    wavelength = numpy.asarray(wavelength, dtype='d')
+    key = (wavelength.tobytes(),) + \
+          tuple((os.path.abspath(f), os.path.getmtime(f)) for f in fnames)
+
+    if key not in _solar_cache:
+        if solar_spectrum:
+            solwav, solar = read_data2(solar_spectrum)
+        else:
+            solwav = read_data('wavelength.dat')
+            solar = read_data('specsol_0403.dat')
+
+        solwav, solar = sort_wav(solwav, solar)
+
+        # this assumes that the wavelengths of the image are sorted!!!
+        _solar_cache[key] = envi2.resample.resample(array(solar), array(solwav),
+                                                    wavelength)
+
+    return _solar_cache[key]
+
 def solar_correction(fin, fout,
                      solar_spectrum=None,
                      sort_wavelengths=True, use_bbl=True,
+                     fdark=None, fwhite=None, robust=True,
                              message=message, progress=None):
+    """Divide the image by the solar spectrum.
+
+If a dark reference fdark is given, the dark & white reference correction
+of darkwhiteref is applied in the same pass: (image - dark) / (white - dark),
+or image - dark without a white reference.
+
+The output has the interleave of the input.
+"""
     im = envi2.Open(fin, sort_wavelengths=True, use_bbl=use_bbl)
 
     bbl = None
@@ -73,35 +123,29 @@ def solar_correction(fin, fout,
         bbl = im.bbl
 
     im2 = envi2.New(fout, 
-                          hdr=im, interleave='bip', bbl=bbl, # this should fix it
+                          hdr=im, interleave=im.header.interleave.lower(), bbl=bbl, # this should fix it
                           data_type='d')
 
-    if solar_spectrum:
-        message('Result will be absolute relectance.')
-        solwav, solar = read_data2(solar_spectrum)
-
-        solwav, solar = sort_wav(solwav, solar)
-    else:
-        message('Sun-Mars distance NOT taken into account!')
-        message('Result will NOT be absolute relectance.')
-        solwav = read_data('wavelength.dat')
-        solar = read_data('specsol_0403.dat')
-
-        solwav, solar = sort_wav(solwav, solar)
+    solres = solar_resampled(im.wavelength, solar_spectrum, message=message)
 
-    # this assumes that the wavelengths of the image are sorted!!!
-    solres = envi2.resample.resample(array(solar), array(solwav),
-                                     array(im.wavelength))
+    # fold the radiometric steps into one offset and one scale per sample and band
+    offset = 0.0
+    scale = 1.0 / solres
+    if fdark:
+        dark, white = darkwhiteref.references(fdark, fwhite, robust=robust,
+                                              sort_wavelengths=True, use_bbl=use_bbl,
+                                              message=message)
+        offset = dark
+        if white is not None:
+            scale = scale / (white - dark)
 
     if progress:
         progress(0.0)
 
-    for j in range(im.lines):
+    for top, bottom in im.strips():
         if progress:
-            progress(j / float(im.lines))
-        for i in range(im.samples):
-            s1 = im.get_spectrum(j, i)
-            im2[j,i,:] = s1 / solres
+            progress(top / float(im.lines))
+        im2[top:bottom, :, :] = (im[top:bottom, :, :] - offset) * scale
 
     if progress:
         progress(1.0)
@@ -127,6 +171,8 @@ if __name__ == '__main__':
     parser.add_argument('-o', dest='output', help='output file name', required=True)
 
     parser.add_argument('-s', dest='solarspec', help='input Solar spectrum file name', required=True)
+    parser.add_argument('-d', dest='darkref', help='dark reference file name (optional)')
+    parser.add_argument('-w', dest='whiteref', help='white reference file name (optional)')
 
 ##    parser.set_defaults(sort_wavelengths=False, use_bbl=False, force=False)
 
@@ -140,4 +186,5 @@ if __name__ == '__main__':
     solar_correction(options.input, options.output,
                      solar_spectrum=options.solarspec,
                      sort_wavelengths=True,
-                     use_bbl=options.use_bbl)
+                     use_bbl=options.use_bbl,
+                     fdark=options.darkref, fwhite=options.whiteref)
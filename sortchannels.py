@@ -26,41 +26,64 @@
 # load support for ENVI images
 import envi2
 #from numpy import array
+import numpy
 
 def message(s):
     pass
 
-def sortchannels(nameIn, nameOut, use_bbl=True, message=message, progress=None):
+def band_order(nameIn):
+    """Write the wavelength order of the bands of image nameIn into its
+header, as the band order entry. envi2.Open then shows the bands sorted
+on wavelength, without copying any data.
+
+All bands are listed, the bad band list is still applied when opening
+the image with use_bbl=True. Opening with sort_wavelengths=False and
+use_bbl=False still gives the bands in the order on disk. Returns the
+band order."""
+    h = envi2.Header(nameIn, sort_wavelengths=False, use_bbl=False)
+
+    # stable, like the sorting of (wavelength, band) pairs in envi2.Header
+    order = numpy.argsort(numpy.array(h.wavelength, dtype=float), kind='stable')
+
+    h.band_order = order
+    h.to_attrlist('band_order')
+    h.write(envi2.header.header_file(nameIn))
+
+    return order
+
+def sortchannels(nameIn, nameOut, use_bbl=True, message=message, progress=None,
+                 header_only=False, interleave=None):
+    """Sort the bands of image nameIn on wavelength.
+
+With header_only only the band order is recorded in the header of nameIn,
+see band_order(), and nameOut is not used. Otherwise the sorted bands are
+copied into image nameOut, in blocks of lines, with the interleave of
+the input unless interleave is given."""
     # get ENVI virtual image data
     im = envi2.Open(nameIn, sort_wavelengths=True, use_bbl=use_bbl)
 
-    lines = im.lines
-    samples = im.samples
     bands = im.bands
 
     if not hasattr(im.header, 'wavelength'):
         message('ABORT: No wavelengths found in header!')
         return
 
+    if header_only:
+        del im
+        message('Writing band order to header of: ' + nameIn)
+        band_order(nameIn)
+        return
+
     # set up output ENVI image
     im2 = envi2.New(nameOut, hdr=im.header,
-                    bands=bands, wavelength=im.wavelength, interleave='bsq')
-
-#    b = im2.data
-
-    # go for it!
-    if progress:
-        progress(0.0)
-    for band in range(bands):
-        if progress:
-            progress(band / float(bands))
-        im2[band] = im.get_band(band)
+                    bands=bands, wavelength=im.wavelength,
+                    interleave=interleave or im.header.interleave)
 
-    if progress:
-        progress(1.0)
+    # go for it! one sequential pass, bands are permuted within the blocks
+    envi2.copy_image(im, im2, progress=progress)
 
     # destroy resources
-    del im2, im#, b
+    del im2, im
 
 if __name__ == '__main__':
 ##    print "Run this module using tkSortChannels!"
@@ -80,7 +103,9 @@ if __name__ == '__main__':
     parser.add_argument('-f', action='store_true', dest='force',
                       help='force overwrite on existing output file')
     parser.add_argument('-i', dest='input', help='input file name', required=True)
-    parser.add_argument('-o', dest='output', help='output file name', required=True)
+    parser.add_argument('-o', dest='output', help='output file name')
+    parser.add_argument('-r', action='store_true', dest='header_only',
+                      help='only record the band order in the header of the input, no copying')
 
 ##    parser.set_defaults(use_bbl=False, force=False)
 
@@ -88,6 +113,8 @@ if __name__ == '__main__':
 
 ##    assert options.input, "Option -i input file name required."
 ##    assert options.output, "Option -o output file name required."
-    assert options.force or not os.path.exists(options.output), "Output file exists. Use -f to overwrite."
+    assert options.header_only or options.output, "Option -o output file name required."
+    assert options.header_only or options.force or not os.path.exists(options.output), "Output file exists. Use -f to overwrite."
 
-    sortchannels(options.input, options.output, use_bbl=options.use_bbl)
+    sortchannels(options.input, options.output, use_bbl=options.use_bbl,
+                 header_only=options.header_only)
@@ -26,6 +26,7 @@
 ##     Netherlands
 ##
 
+import ast
 import collections
 
 import envi2
@@ -39,10 +40,115 @@ import numpy
 ##import time
 
 from spectrum import Spectrum
+from spectrumblock import SpectrumBlock
 
 def message(s):
     print(s)
 
+# raw arrays and functions that may reduce over all spectra of a block
+RAW_ATTRIBUTES = ('spectrum', 's')
+RAW_NAMES = ('numpy', 'max', 'min', 'sum', 'len', 'sorted', 'list', 'iter')
+
+def block_safe(expression):
+    """False if expression touches the raw spectral values or uses functions
+that may take them together over a block, like numpy.max(S1.spectrum).
+Such expressions are evaluated per pixel."""
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError:
+        return False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and node.attr in RAW_ATTRIBUTES:
+            return False
+        if isinstance(node, ast.Name) and node.id in RAW_NAMES:
+            return False
+    return True
+
+def check_rows(strips):
+    """Indices of the spectra of a block to compare with single
+evaluations: the first and last, and those with the smallest and largest
+sum, minimum and maximum in every image."""
+    rows = {0, len(strips[0]) - 1}
+    for strip in strips:
+        for values in (strip.sum(axis=1), strip.min(axis=1), strip.max(axis=1)):
+            rows.add(int(numpy.argmin(values)))
+            rows.add(int(numpy.argmax(values)))
+    return sorted(rows)
+
+def evaluate_block(expression, imlist, spectra):
+    """Evaluate expression once for blocks of spectra (pixels, bands), one
+block per image in imlist, named S1, S2, ... like the single spectra.
+
+Returns the output values (pixels, n). Raises an exception if the
+expression or its result is not supported for blocks."""
+    variables = {}
+    for k, (im, s) in enumerate(zip(imlist, spectra)):
+        variables['S%d' % (k+1,)] = SpectrumBlock(wavelength=im.wavelength, spectrum=s,
+                                wavelength_units=getattr(im.header, 'wavelength_units', None))
+
+    with numpy.errstate(all='ignore'):
+        return block_values(eval(expression, globals(), variables), len(spectra[0]))
+
+def block_values(result, pixels):
+    """Translate the result of an expression evaluated on SpectrumBlocks
+into output values (pixels, n)."""
+    if isinstance(result, SpectrumBlock):
+        if result.partial:
+            raise NotImplementedError('hull as result')
+        values = result.spectrum
+        if len(values) != pixels:
+            raise ValueError('result does not match the block of spectra')
+        return values
+    elif isinstance(result, Spectrum):
+        raise NotImplementedError('Spectrum as result')
+    elif isinstance(result, (tuple, list)):
+        if any(isinstance(r, (SpectrumBlock, Spectrum)) for r in result):
+            raise NotImplementedError('sequence of spectra as result')
+        return numpy.hstack([block_values(r, pixels) for r in result])
+
+    # a single value is a reduction over the whole block, not per pixel
+    values = numpy.asarray(result)
+    if values.ndim == 1 and len(values) == pixels:
+        return values[:, numpy.newaxis]
+    elif values.ndim == 2 and len(values) == pixels:
+        return values
+    raise ValueError('result does not match the block of spectra')
+
+def evaluate_pixel(expression, bands):
+    """Evaluate expression for the single spectra S1, S2, ... set in the
+globals, returns the output values (bands,), truncated or padded with NaN."""
+    result = eval(expression)
+    if isinstance(result, Spectrum):
+        result = result.spectrum
+        # what about wavelength?
+    elif not isinstance(result, collections.abc.Iterable): # scalar
+        pass
+    else: # result is a tuple or a value
+        result = numpy.ndarray.flatten(result) # result is always a list
+    out = numpy.full(bands, numpy.nan)
+    try:
+        out[:] = result
+    except ValueError: # arrays don't match!
+        result = result[:bands]
+        out[:len(result)] = result
+    return out
+
+def same_values(block, single):
+    """True if the block result of a pixel equals its single evaluation,
+up to the rounding of the block algorithms."""
+    scale = max(1.0, numpy.nanmax(numpy.fabs(single), initial=0.0))
+    return numpy.allclose(block, single, rtol=1e-6, atol=1e-9 * scale, equal_nan=True)
+
+def fit_bands(values, bands):
+    """Truncate or pad (with NaN) values (pixels, n) to the output bands,
+as done for a single spectrum."""
+    n = values.shape[1]
+    if n == bands or n == 1:
+        return values
+    elif n > bands:
+        return values[:, :bands]
+    return numpy.hstack((values, numpy.full((len(values), bands - n), numpy.nan)))
+
 def specmath(fin, fout, expression, maskfile=None, data_type=None,
              sort_wavelengths=False, use_bbl=False, message=message,
              progress=None):
@@ -112,44 +218,58 @@ def specmath(fin, fout, expression, maskfile=None, data_type=None,
                       description=['spectral math: %s' % (expression,)])
 
     if progress: progress(0.0)
-    ## Loop over lines and samples
-    lines = imlist[0].lines
-    for j in range(lines):
-        if progress: progress(j / float(lines-1))
-        for i in range(imlist[0].samples):
-            if not mask or mask[j, i, 0]:
-                ## Loop over the set of input images to collect spectra
-                for k in range(len(imlist)):
-    ##                myS = Spectrum(wavelength=imlist[k].wavelength, spectrum=imlist[k][j, i],
-    ##                               wavelength_units=getattr(imlist[k].header, 'wavelength_units', None))
-    ##
-    ##                ## Construct a variable name
-    ##                vars()['S%d' % (k+1,)] = myS
-
-                    # Recycle Spectrum object and replace spectrum for speedup...
-                    globals()['S%d' % (k+1,)].spectrum = imlist[k][j, i]
-                    
-                try:
-                    #S = S1 # first is also known as S... (this doesn't work...)
-                    result = eval(expression)
-                    if isinstance(result, Spectrum):
-                        result = result.spectrum
-                        # what about wavelength?
-                    elif not isinstance(result, collections.abc.Iterable): # scalar
-                        pass
-                    else: # result is a tuple or a value
-                        result = numpy.ndarray.flatten(result) # result is always a list
-                    try:
-                        imout[j, i] = result
-                    except ValueError: # arrays don't match!
-                        result = result[:bands]
-                        lenresult = len(result)
-                        imout[j, i, :lenresult] = result
-                        imout[j, i, lenresult:] = nan
-                except Exception as e:
-                    message(repr(e))
-                    return
-            
+    ## Loop over strips of lines, evaluate all spectra of a strip at once
+    samples = imlist[0].samples
+    use_blocks = block_safe(expression)
+    if not use_blocks:
+        message('Evaluating per pixel (expression uses raw spectra)')
+    for top, bottom in imlist[0].strips():
+        if progress: progress(top / float(imlist[0].lines))
+        strips = [im[top:bottom, :, :].reshape(-1, im.bands) for im in imlist]
+        out = numpy.full((len(strips[0]), bands), numpy.nan)
+
+        todo = numpy.ones(len(strips[0]), dtype=bool)
+        if mask:
+            todo = mask[top:bottom, :, 0].reshape(-1) != 0
+
+        if use_blocks:
+            # spectra with NaNs go one by one, like the unsupported expressions
+            block = todo.copy()
+            for strip in strips:
+                block &= numpy.isfinite(strip).all(axis=1)
+            try:
+                if block.any():
+                    spectra = [strip[block] for strip in strips]
+                    values = fit_bands(evaluate_block(expression, imlist, spectra), bands)
+                    # several different pixels of the block must agree with
+                    # single evaluations, a reduction over the block does not
+                    for r in check_rows(spectra):
+                        for k in range(len(imlist)):
+                            globals()['S%d' % (k+1,)].spectrum = spectra[k][r]
+                        if not same_values(values[r], evaluate_pixel(expression, bands)):
+                            raise ValueError('block result differs from the single spectrum')
+                    out[block] = values
+                    todo &= ~block
+            except Exception as e:
+                message('Evaluating per pixel (%s)' % (repr(e),))
+                use_blocks = False
+
+        ## Loop over the remaining pixels
+        for p in numpy.nonzero(todo)[0]:
+            ## Loop over the set of input images to collect spectra
+            for k in range(len(imlist)):
+                # Recycle Spectrum object and replace spectrum for speedup...
+                globals()['S%d' % (k+1,)].spectrum = strips[k][p]
+
+            try:
+                #S = S1 # first is also known as S... (this doesn't work...)
+                out[p] = evaluate_pixel(expression, bands)
+            except Exception as e:
+                message(repr(e))
+                return
+
+        imout[top:bottom, :, :] = out.reshape(bottom - top, samples, bands)
+
     if progress: progress(1.0)          
     message('Completed!')
 
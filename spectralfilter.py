@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+## spectralfilter.py
+##
+## Copyright (C) 2020 Wim Bakker
+##  Modified:
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by the
+## Free Software Foundation, version 3 of the License.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+## See the GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License along
+## with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+## Contact:
+##     Wim Bakker, <bakker@itc.nl>
+##     University of Twente, Faculty ITC
+##     Hengelosestraat 99
+##     7514 AE Enschede
+##     Netherlands
+##
+## Spectral filters for whole image cubes.
+##
+## The filters of Spectrum (smooth, medfilt, gradient, second, convolve,
+## savgol and spline) are applied to strips of lines at once, as a SpectrumBlock
+## of all spectra of the strip. Strips are processed in parallel.
+##
+
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# load support for ENVI images
+import envi2
+from envi2.constants import STRIP_BYTES
+import spectrumblock
+
+import numpy
+
+FILTERS = ['smooth', 'medfilt', 'convolve', 'gradient', 'second', 'savgol', 'spline']
+
+def message(s):
+    pass
+
+def apply_filter(block, method='smooth', n=None, order=2, deriv=0, kernel=None,
+                 s=0.001):
+    """Apply spectral filter method to SpectrumBlock block.
+
+n is the number of times to smooth, or the window size of medfilt and
+savgol. order and deriv are the polynomial order and derivative of
+savgol, kernel holds the 3 weights of convolve, s is the smoothing
+factor of spline. savgol and spline give NaN for spectra with NaNs."""
+    if method == 'smooth':
+        return block.smooth(1 if n is None else n)
+    elif method == 'medfilt':
+        return block.medfilt(3 if n is None else n)
+    elif method == 'convolve':
+        return block.convolve(kernel)
+    elif method == 'gradient':
+        return block.gradient()
+    elif method == 'second':
+        return block.second()
+    elif method == 'savgol':
+        return block.savgol(5 if n is None else n, order=order, deriv=deriv)
+    elif method == 'spline':
+        return block.spline(s)
+    raise ValueError('unknown spectral filter: %s' % (method,))
+
+def filter_strips(im, im2, func, copies=4, threads=None, progress=None):
+    """im2[top:bottom] = func(block) for all strips of image im, where block
+is the SpectrumBlock of the spectra of the strip, as float64.
+
+func may return a SpectrumBlock or an array (pixels, bands). The strips
+are processed by a pool of threads, and are sized such that copies of
+the strips of all threads together take about STRIP_BYTES of memory."""
+    if threads is None:
+        threads = os.cpu_count() or 1
+    threads = max(1, threads)
+
+    if hasattr(im, 'wavelength'):
+        wavelength = numpy.asarray(im.wavelength, dtype=float)
+    else:
+        wavelength = numpy.arange(im.bands, dtype=float)
+
+    lines = im.lines
+    samples = im.samples
+    todo = iter(im.strips(max_bytes=STRIP_BYTES // (max(1, copies) * threads)))
+
+    def task(strip):
+        top, bottom = strip
+        data = numpy.array(im.get_strip(top, bottom, copy=False), dtype=float)
+        block = spectrumblock.SpectrumBlock(wavelength=wavelength,
+                    spectrum=data.reshape(-1, im.bands))
+        result = func(block)
+        if isinstance(result, spectrumblock.SpectrumBlock):
+            result = result.spectrum
+        im2[top:bottom, :, :] = result.reshape(bottom - top, samples, -1)
+        return bottom - top
+
+    done = 0
+    pending = set()
+    if progress:
+        progress(0.0)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            # at most 2 * threads strips in memory
+            while len(pending) < 2 * threads:
+                try:
+                    pending.add(pool.submit(task, next(todo)))
+                except StopIteration:
+                    break
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done += future.result()
+                if progress:
+                    progress(done / float(lines))
+    if progress:
+        progress(1.0)
+
+def spectralfilter(nameIn, nameOut, method='smooth', n=None, order=2,
+                   deriv=0, kernel=None, s=0.001, message=message,
+                   sort_wavelengths=True, use_bbl=True, progress=None,
+                   threads=None):
+    """Apply spectral filter method to every spectrum of image nameIn.
+
+See apply_filter() for the methods and their parameters. The output
+has the interleave of the input."""
+    if method not in FILTERS:
+        raise ValueError('unknown spectral filter: %s' % (method,))
+
+    # get ENVI image data
+    im = envi2.Open(nameIn, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
+
+    # set up output ENVI image
+    im2 = envi2.New(nameOut, value=numpy.nan,
+                     hdr=im, interleave=im.header.interleave,
+                     data_type='d', fwhm=None, bbl=None)
+
+    message('Spectral filter: %s' % (method,))
+
+    filter_strips(im, im2,
+                  lambda block: apply_filter(block, method, n=n, order=order,
+                                             deriv=deriv, kernel=kernel, s=s),
+                  threads=threads, progress=progress)
+
+    # destroy resources
+    del im2, im
+
+if __name__ == '__main__':
+    # command line version
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(prog='spectralfilter.py',
+        description='Apply a spectral filter to every spectrum of an image')
+
+    parser.add_argument('-b', action='store_true', dest='use_bbl', help='use bad band list')
+    parser.add_argument('-s', action='store_true', dest='sort_wavelengths', help='sort wavelengths')
+    parser.add_argument('-f', action='store_true', dest='force', help='force overwrite of output file')
+    parser.add_argument('-i', dest='input', required=True, help='input file')
+    parser.add_argument('-o', dest='output', required=True, help='ouput file')
+    parser.add_argument('-m', dest='method', choices=FILTERS, default='smooth', help='spectral filter (default smooth)')
+    parser.add_argument('-n', dest='n', type=int, help='times to smooth, or window size of medfilt and savgol')
+    parser.add_argument('-p', dest='order', type=int, default=2, help='polynomial order of savgol (default 2)')
+    parser.add_argument('-d', dest='deriv', type=int, default=0, help='derivative of savgol (default 0)')
+    parser.add_argument('-k', dest='kernel', type=float, nargs=3, help='3 weights for convolve')
+    parser.add_argument('-a', dest='s', type=float, default=0.001, help='smoothing factor of spline (default 0.001)')
+    parser.add_argument('-t', dest='threads', type=int, help='number of threads (default all cores)')
+
+    options = parser.parse_args()
+
+    if not options.force and os.path.exists(options.output):
+        sys.exit("Output file exists. Use option -f to overwrite.")
+
+    if options.method == 'convolve' and options.kernel is None:
+        sys.exit("Filter convolve needs 3 weights, use option -k.")
+
+    spectralfilter(options.input, options.output, method=options.method,
+                   n=options.n, order=options.order, deriv=options.deriv,
+                   kernel=options.kernel, s=options.s,
+                   sort_wavelengths=options.sort_wavelengths,
+                   use_bbl=options.use_bbl, threads=options.threads)
+
+    sys.exit(0)
@@ -27,6 +27,7 @@
 # load support for ENVI images
 import envi2
 #import spectrum
+import spectralfilter
 
 import numpy
 
@@ -35,28 +36,19 @@ def message(s):
 
 def spectralgradient(nameIn, nameOut,
                   message=message, sort_wavelengths=True,
-                  use_bbl=True, progress=None):
+                  use_bbl=True, progress=None, threads=None):
     # get ENVI image data
     im = envi2.Open(nameIn, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
 
-    lines = im.lines
-    samples = im.samples
-
     # set up output ENVI image
     im2 = envi2.New(nameOut, value=numpy.nan,
-                     hdr=im.header, data_type='d',
-                     fwhm=None, bbl=None)
+                     hdr=im.header, interleave=im.header.interleave,
+                     data_type='d', fwhm=None, bbl=None)
 
     # go for it!
-    if progress:
-        progress(0.0)
-    for j in range(lines):
-        if progress:
-            progress(j / float(lines))
-        im2[j, :, :] = numpy.gradient(im[j, :, :], axis=-1)
-
-    if progress:
-        progress(1.0)
+    spectralfilter.filter_strips(im, im2,
+                  lambda block: numpy.gradient(block.spectrum, axis=-1),
+                  threads=threads, progress=progress)
 
     # destroy resources
     del im2, im
@@ -75,6 +67,7 @@ if __name__ == '__main__':
     parser.add_argument('-f', action='store_true', dest='force', help='force overwrite of output file')
     parser.add_argument('-i', dest='input', required=True, help='input file')
     parser.add_argument('-o', dest='output', required=True, help='ouput file')
+    parser.add_argument('-t', dest='threads', type=int, help='number of threads (default all cores)')
 
     options = parser.parse_args()
 
@@ -83,6 +76,6 @@ if __name__ == '__main__':
 
     spectralgradient(options.input, options.output,
                   sort_wavelengths=options.sort_wavelengths,
-                  use_bbl=options.use_bbl)
+                  use_bbl=options.use_bbl, threads=options.threads)
 
     sys.exit(0)
@@ -26,11 +26,12 @@
 
 # load support for ENVI images
 import envi2
-import spectrum
+import spectrumblock
 
 import numpy
 
 BAND_NAMES = ['curvature', 'slope', 'offset']
+STATISTICS_NAMES = ['r_squared', 'rms']
 
 def message(s):
     pass
@@ -38,44 +39,48 @@ def message(s):
 def spectralslope(nameIn, nameOut, startwav=None, endwav=None,
                   message=message, sort_wavelengths=True,
                   use_bbl=True, progress=None,
-                  fitorder=1):
+                  fitorder=1, statistics=False):
+    """Fit a polynomial of order fitorder through every spectrum between
+startwav and endwav. The output bands are the coefficients, and if
+statistics is True also the R^2 and the RMS of the residuals of the fit.
+"""
     # get ENVI image data
     im = envi2.Open(nameIn, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
 
     lines = im.lines
     samples = im.samples
 
+    band_names = BAND_NAMES[2-fitorder:]
+    if statistics:
+        band_names = band_names + STATISTICS_NAMES
+
     # set up output ENVI image
     im2 = envi2.New(nameOut, value=numpy.nan,
                      hdr=envi2.Header(hdr=im.header,
-                                      bands=fitorder+1,
+                                      bands=len(band_names),
                                       data_type='d',
-                                     band_names=BAND_NAMES[2-fitorder:], wavelength=None,
+                                     band_names=band_names, wavelength=None,
                                      fwhm=None, bbl=None))
 
     startband = im.wavelength2index(startwav)
     endband = im.wavelength2index(endwav) + 1 # modified to include the endwav
     wavs = im.wavelength[startband:endband]
 
-##    # create a spectral subset view on the image
-##    imsub = im[:, :, startband:endband]
-
-    # go for it!
+    # go for it! all spectra of a strip of lines are fitted at once
     if progress:
         progress(0.0)
-    for j in range(lines):
+    for top, bottom in im.strips():
         if progress:
-            progress(j / float(lines))
-        for i in range(samples):
-            S = spectrum.Spectrum(wavelength=wavs, spectrum=im[j, i, startband:endband])
+            progress(top / float(lines))
+        s = im[top:bottom, :, startband:endband].reshape(-1, len(wavs))
 
-            c = numpy.polyfit(S.w, S.s, fitorder)
+        if statistics:
+            c, r2, rms = spectrumblock.polyfit(wavs, s, fitorder, full=True)
+            c = numpy.hstack((c, r2[:, numpy.newaxis], rms[:, numpy.newaxis]))
+        else:
+            c = spectrumblock.polyfit(wavs, s, fitorder)
 
-            im2[j, i, 0] = c[0]
-            im2[j, i, 1] = c[1]
-            if fitorder==2:
-                im2[j, i, 2] = c[2]
-                
+        im2[top:bottom, :, :] = c.reshape(bottom - top, samples, -1)
 
     if progress:
         progress(1.0)
@@ -99,6 +104,7 @@ if __name__ == '__main__':
     parser.add_argument('-w', dest='start', type=float, required=True, help='starting wavelength (float)')
     parser.add_argument('-W', dest='end', type=float, required=True, help='ending wavelength (float)')
     parser.add_argument('-n', dest='fitorder', choices=(1, 2), type=int, default=1, help='fitting order (1, 2)')
+    parser.add_argument('-r', action='store_true', dest='statistics', help='add R squared and RMS residual bands')
 
     options = parser.parse_args()
 
@@ -109,6 +115,7 @@ if __name__ == '__main__':
                   startwav=options.start, endwav=options.end,
                   sort_wavelengths=True,
                   use_bbl=options.use_bbl,
-                  fitorder=options.fitorder)
+                  fitorder=options.fitorder,
+                  statistics=options.statistics)
 
     sys.exit(0)
@@ -39,11 +39,13 @@ import sys
 
 #from scipy.integrate import trapz
 from scipy.integrate import trapezoid
-from scipy.signal import medfilt
+from scipy.signal import medfilt, savgol_filter
 import scipy.spatial
 from scipy.interpolate import interp1d, UnivariateSpline
 from scipy.stats import entropy
 
+import spectrumblock
+
 import pylab as pl
 pl.ion()
 
@@ -782,6 +784,20 @@ which means that local extrema may not be found anymore.
 """
         return Spectrum(wavelength=self.wavelength, spectrum=medfilt(self.spectrum, kernel_size=n), name=self.name, description=self.description)
 
+    def savgol(self, n=5, order=2, deriv=0):
+        """Smooth spectrum with a Savitzky-Golay filter.
+
+Fits a polynomial of the given order in a window of n bands. With
+deriv > 0 returns the deriv-th derivative to the wavelength instead.
+
+Uses scipy.signal.savgol_filter, which assumes equally spaced
+wavelengths. The mean band spacing is used for the derivatives.
+"""
+        w = self.wavelength
+        delta = (w[-1] - w[0]) / float(len(w) - 1)
+        s = savgol_filter(self.spectrum, n, order, deriv=deriv, delta=delta)
+        return Spectrum(wavelength=self.wavelength, spectrum=s, name=self.name, description=self.description)
+
 ## THIS NEEDS WORK
 ##    def bspline(self, n=2):
 ##        """Smooth spectrum with a bspline.
@@ -1622,8 +1638,8 @@ Currently 39 summary products are implemented.
         """Fit a polynomial with order n through spectrum.
 
 The resulting interpolated spectrum has exactly the same wavelengths as
-the input spectrum."""
-        coef = numpy.polyfit(self.wavelength, self.spectrum, n)
+the input spectrum. NaNs are left out of the fit."""
+        coef = spectrumblock.polyfit(self.wavelength, self.spectrum[numpy.newaxis, :], n)[0]
         s = numpy.polyval(coef, self.wavelength)
         return Spectrum(wavelength=self.wavelength, spectrum=s, name=self.name, description=self.description)
 
@@ -0,0 +1,820 @@
+#!/usr/bin/python3
+## spectrumblock.py
+##
+## Copyright (C) 2012- Wim Bakker
+##
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU General Public License as published by the
+## Free Software Foundation, version 3 of the License.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+## See the GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License along
+## with this program. If not, see <http://www.gnu.org/licenses/>.
+##
+## Contact:
+##     Wim Bakker, <bakker@itc.nl>
+##     University of Twente, Faculty ITC
+##     Hengelosestraat 99
+##     7514 AE Enschede
+##     Netherlands
+##
+## Batched versions of the spectral primitives of spectrum.py.
+##
+## All functions work on a block of spectra s (pixels, bands) sharing
+## the same wavelengths w (bands), for instance one strip of an image.
+##
+
+import collections.abc
+
+import numpy
+
+def hull(w, s):
+    """Vertices of the upper convex hull of every spectrum in s.
+
+The hull is built with the monotone chain algorithm, running over the
+bands once for all spectra at the same time. The spectra should not
+contain NaNs. Returns a boolean array (pixels, bands), True for the
+bands that are vertices of the hull.
+"""
+    s = numpy.asarray(s, dtype='d')
+    w = numpy.asarray(w, dtype='d')
+    N, B = s.shape
+    rows = numpy.arange(N)
+
+    stack = numpy.zeros((N, B), dtype=int)
+    top = numpy.zeros(N, dtype=int)
+
+    for k in range(B):
+        while True:
+            # pop the last vertex if it is not above the line from the one
+            # before it to the current band
+            can = top >= 2
+            i1 = stack[rows, (top - 2).clip(0)]
+            i2 = stack[rows, (top - 1).clip(0)]
+            cross = (w[i2] - w[i1]) * (s[:, k] - s[rows, i1]) - \
+                    (s[rows, i2] - s[rows, i1]) * (w[k] - w[i1])
+            pop = can & (cross >= 0)
+            if not pop.any():
+                break
+            top[pop] -= 1
+        stack[rows, top] = k
+        top += 1
+
+    vertices = numpy.zeros((N, B), dtype=bool)
+    used = numpy.arange(B)[numpy.newaxis, :] < top[:, numpy.newaxis]
+    vertices[numpy.nonzero(used)[0], stack[used]] = True
+
+    return vertices
+
+def continuum(w, s):
+    """Convex hull of every spectrum in s, resampled to the wavelengths w.
+Equivalent to S.hull() resampled to the wavelengths of S."""
+    s = numpy.asarray(s, dtype='d')
+    w = numpy.asarray(w, dtype='d')
+    N, B = s.shape
+    rows = numpy.arange(N)[:, numpy.newaxis]
+
+    vertices = hull(w, s)
+
+    # the hull vertices to the left and to the right of every band
+    band = numpy.arange(B)[numpy.newaxis, :]
+    left = numpy.maximum.accumulate(numpy.where(vertices, band, 0), axis=1)
+    right = numpy.where(vertices, band, B - 1)
+    right = numpy.minimum.accumulate(right[:, ::-1], axis=1)[:, ::-1]
+
+    wl = w[left]
+    wr = w[right]
+    sl = s[rows, left]
+    sr = s[rows, right]
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        t = numpy.where(right > left, (w[numpy.newaxis, :] - wl) / (wr - wl), 0.0)
+
+    return sl + t * (sr - sl)
+
+def nohull(w, s, mode='div'):
+    """Continuum removal of every spectrum in s, see Spectrum.nohull()."""
+    s = numpy.asarray(s, dtype='d')
+    if mode=='div':
+        return s / continuum(w, s)
+    elif mode=='sub':
+        return 1 + (s - continuum(w, s))
+    else:
+        return s
+
+def localminidx(s, n=None):
+    """Indices of the n smallest strict local minima of every spectrum,
+sorted on value (ties on index). Returns an integer array (pixels, n),
+padded with -1 if a spectrum has less than n local minima."""
+    s = numpy.asarray(s, dtype='d')
+    N, B = s.shape
+    if n is None:
+        n = max(0, B - 2)
+
+    interior = s[:, 1:-1]
+    ismin = (interior < s[:, :-2]) & (interior < s[:, 2:])
+    values = numpy.where(ismin, interior, numpy.inf)
+
+    order = numpy.argsort(values, axis=1, kind='stable')[:, :n]
+    found = numpy.take_along_axis(ismin, order, axis=1)
+
+    idx = numpy.where(found, order + 1, -1)
+    if idx.shape[1] < n:
+        idx = numpy.hstack((idx, numpy.full((N, n - idx.shape[1]), -1)))
+
+    return idx
+
+def parabola(x0, x1, x2, y0, y1, y2):
+    """Closed form parabola y = a*x*x + b*x + c through three points.
+All arguments are arrays of the same shape. Returns the vertex (zx, zy)
+and the coefficient a."""
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        d01 = (y1 - y0) / (x1 - x0)
+        d12 = (y2 - y1) / (x2 - x1)
+        a = (d12 - d01) / (x2 - x0)
+        b = d01 - a * (x0 + x1)
+        c = y0 - (a * x0 + b) * x0
+        zx = -b / (2 * a)
+        zy = (a * zx + b) * zx + c
+    return zx, zy, a
+
+def fitparabola(w, s, idx):
+    """Fit a parabola through every minimum idx (pixels, n) and its two
+neighbors. Returns the vertices (zx, zy), NaN where idx is -1 or at the
+edges."""
+    s = numpy.asarray(s, dtype='d')
+    w = numpy.asarray(w, dtype='d')
+    B = s.shape[1]
+
+    ok = (idx > 0) & (idx < B - 1)
+    i = numpy.where(ok, idx, 1)
+
+    x0, x1, x2 = w[i-1], w[i], w[i+1]
+    y0 = numpy.take_along_axis(s, i-1, axis=1)
+    y1 = numpy.take_along_axis(s, i, axis=1)
+    y2 = numpy.take_along_axis(s, i+1, axis=1)
+
+    zx, zy, a = parabola(x0, x1, x2, y0, y1, y2)
+
+    zx[~ok] = numpy.nan
+    zy[~ok] = numpy.nan
+
+    return zx, zy
+
+def fitparabola_broad(w, s, idx):
+    """Least squares parabola through every minimum idx (pixels, n) and
+its adjacent points below half the depth, see Spectrum._fitparabola_broad().
+
+The window sums for the normal equations come from cumulative sums over
+the bands, so all windows of all spectra are fitted at once.
+Returns the vertices (zx, zy), NaN where idx is -1."""
+    s = numpy.asarray(s, dtype='d')
+    w = numpy.asarray(w, dtype='d')
+    N, B = s.shape
+
+    ok = (idx > 0) & (idx < B - 1)
+    i = numpy.where(ok, idx, 1)
+
+    # threshold (s[i]+1)/2 for every feature
+    thr = (numpy.take_along_axis(s, i, axis=1) + 1) / 2
+
+    band = numpy.arange(B)[numpy.newaxis, numpy.newaxis, :]
+    above = s[:, numpy.newaxis, :] > thr[:, :, numpy.newaxis]
+    ii = i[:, :, numpy.newaxis]
+
+    # grow to the left while band lowidx-1 > 0 is below the threshold
+    cand = above & (band >= 1) & (band <= ii - 2)
+    low = numpy.where(cand, band, 0).max(axis=2) + 1
+    low = numpy.where(i - 1 < 1, i - 1, low)
+
+    # grow to the right while band highidx+1 < B-1 is below the threshold
+    cand = above & (band >= ii + 2) & (band <= B - 2)
+    high = numpy.where(cand, band, B - 1).min(axis=2) - 1
+    high = numpy.where(i + 1 >= B - 2, i + 1, high)
+
+    # normalized wavelengths keep the normal equations well conditioned
+    center = (w[0] + w[-1]) / 2
+    scale = (w[-1] - w[0]) / 2 or 1.0
+    x = (w - center) / scale
+
+    zero = numpy.zeros(1)
+    X = [numpy.concatenate((zero, numpy.cumsum(x**k))) for k in range(5)]
+    zeros = numpy.zeros((N, 1))
+    Y = [numpy.hstack((zeros, numpy.cumsum(s * x**k, axis=1))) for k in range(3)]
+
+    def window(cs, axis_sum=False):
+        if axis_sum:
+            return numpy.take_along_axis(cs, high + 1, axis=1) - \
+                   numpy.take_along_axis(cs, low, axis=1)
+        return cs[high + 1] - cs[low]
+
+    Sx = [window(X[k]) for k in range(5)]
+    Sy = [window(Y[k], True) for k in range(3)]
+
+    # normal equations for (c, b, a)
+    A = numpy.stack((numpy.stack((Sx[0], Sx[1], Sx[2]), axis=-1),
+                     numpy.stack((Sx[1], Sx[2], Sx[3]), axis=-1),
+                     numpy.stack((Sx[2], Sx[3], Sx[4]), axis=-1)), axis=-2)
+    rhs = numpy.stack((Sy[0], Sy[1], Sy[2]), axis=-1)
+
+    A[~ok] = numpy.eye(3)
+    rhs[~ok] = 0.0
+
+    coef = numpy.linalg.pinv(A) @ rhs[..., numpy.newaxis]
+    c, b, a = coef[..., 0, 0], coef[..., 1, 0], coef[..., 2, 0]
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        zx = -b / (2 * a)
+        zy = (a * zx + b) * zx + c
+        zx = center + scale * zx
+
+    zx[~ok] = numpy.nan
+    zy[~ok] = numpy.nan
+
+    return zx, zy
+
+def minwav(w, s, n=None, mode='div', broad=False):
+    """Batched version of Spectrum.minwav().
+
+Returns the wavelengths and depths (pixels, n) of the n deepest local
+minima of the continuum removed spectra, in order of the bands (like the
+pSpectrum returned by Spectrum.minwav()). Missing features are NaN.
+"""
+    cr = nohull(w, s, mode=mode)
+    idx = localminidx(cr, n)
+
+    # back in band order, missing features at the end
+    order = numpy.argsort(numpy.where(idx < 0, cr.shape[1], idx), axis=1, kind='stable')
+    idx = numpy.take_along_axis(idx, order, axis=1)
+
+    if broad:
+        zx, zy = fitparabola_broad(w, cr, idx)
+    else:
+        zx, zy = fitparabola(w, cr, idx)
+
+    return zx, 1 - zy
+
+def interpol(w, s, x):
+    """Linear interpolation of every spectrum in s at wavelength x,
+see Spectrum.interpol(). Returns an array (pixels,)."""
+    s = numpy.asarray(s)
+    w = numpy.asarray(w)
+    i_right = w.searchsorted(x)
+    if i_right == 0:
+        return s[:, 0]
+    elif i_right == len(w):
+        return s[:, -1]
+    else:
+        i_left = i_right - 1
+        a = (w[i_right] - x) / (w[i_right] - w[i_left])
+        b = 1 - a
+        return a * s[:, i_left] + b * s[:, i_right]
+
+def resample(w, s, w2):
+    """Linear interpolation of every spectrum in s at the wavelengths w2,
+like scipy.interpolate.interp1d(w, s, bounds_error=False)(w2) of
+Spectrum.resample(). Values outside the wavelengths w are NaN."""
+    s = numpy.asarray(s)
+    w = numpy.asarray(w, dtype='d')
+    w2 = numpy.asarray(w2, dtype='d')
+
+    # the same interval and formula as interp1d
+    hi = w.searchsorted(w2).clip(1, len(w) - 1)
+    lo = hi - 1
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        slope = (s[:, hi] - s[:, lo]) / (w[hi] - w[lo])
+        result = slope * (w2 - w[lo]) + s[:, lo]
+
+    result[:, (w2 < w[0]) | (w2 > w[-1])] = numpy.nan
+    return result
+
+def _unary(func, doc):
+    def method(self):
+        return self._new(func(self.spectrum))
+    method.__doc__ = doc
+    return method
+
+def _binary(func, doc, reflected=False):
+    def method(self, other):
+        self, other = self.__coerce__(other)
+        s = getattr(other, 'spectrum', other)
+        if reflected:
+            return self._new(func(s, self.spectrum), other)
+        return self._new(func(self.spectrum, s), other)
+    method.__doc__ = doc
+    return method
+
+def _reduce(func, doc):
+    def method(self, *args):
+        self._check()
+        return func(self.spectrum, axis=1)
+    method.__doc__ = doc
+    return method
+
+def _distance(func, doc):
+    def method(self, other):
+        if isinstance(other, (SpectrumBlock, _Spectrum())):
+            self, other = self.__coerce__(other)
+            return func(self.spectrum.astype('d'), other.spectrum.astype('d'))
+        else:
+            return [method(self, s2) for s2 in other]
+    method.__doc__ = doc
+    return method
+
+def _spectral_angle(s1, s2):
+    s1 = s1 / numpy.linalg.norm(s1, axis=1)[:, numpy.newaxis]
+    s2 = s2 / numpy.linalg.norm(s2, axis=1)[:, numpy.newaxis]
+    d = numpy.add.reduce(s1*s2, axis=1)
+    # math.acos() of Spectrum.SA() fails outside [-1, 1], giving 0.0
+    with numpy.errstate(invalid='ignore'):
+        return numpy.where((d < -1) | (d > 1), 0.0, numpy.arccos(d))
+
+def _normxcorr(s1, s2):
+    s1 = s1 / numpy.linalg.norm(s1, axis=1)[:, numpy.newaxis]
+    s2 = s2 / numpy.linalg.norm(s2, axis=1)[:, numpy.newaxis]
+    return numpy.add.reduce(s1*s2, axis=1)
+
+def _euclidean_distance(s1, s2):
+    ds = s2 - s1
+    return numpy.sqrt(numpy.add.reduce(ds*ds, axis=1))
+
+def _intensity_difference(s1, s2):
+    i1 = numpy.sqrt(numpy.add.reduce(s1*s1, axis=1))
+    i2 = numpy.sqrt(numpy.add.reduce(s2*s2, axis=1))
+    return numpy.fabs(i2 - i1)
+
+def _spectral_information_divergence(s1, s2):
+    r1 = s1 / numpy.add.reduce(s1, axis=1)[:, numpy.newaxis]
+    r2 = s2 / numpy.add.reduce(s2, axis=1)[:, numpy.newaxis]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        tmp1 = r1 * numpy.log(r1 / r2)
+        tmp2 = r2 * numpy.log(r2 / r1)
+    tmp1[~numpy.isfinite(tmp1)] = 0
+    tmp2[~numpy.isfinite(tmp2)] = 0
+    return numpy.add.reduce(tmp1, axis=1) + numpy.add.reduce(tmp2, axis=1)
+
+def _bray_curtis_distance(s1, s2):
+    return numpy.add.reduce(numpy.fabs(s1-s2), axis=1) / \
+           (numpy.add.reduce(s1, axis=1) + numpy.add.reduce(s2, axis=1))
+
+def _Spectrum():
+    # spectrum.py pulls in pylab and scipy, only import it when needed
+    from spectrum import Spectrum
+    return Spectrum
+
+class SpectrumBlock:
+    """A block of spectra (pixels, bands) with the same wavelengths that
+behaves like a Spectrum, so that an expression written for a Spectrum
+evaluates all spectra of the block at once.
+
+Methods of Spectrum that return a value per spectrum return an array
+(pixels,). Methods that can not be evaluated on a block, for instance
+because the result has a different length for every spectrum, raise
+NotImplementedError or are missing (AttributeError); evaluate those
+per Spectrum.
+
+A block returned by hull() stands in for the hulls of the spectra, it
+only supports arithmetic with the spectra itself (as in S / S.hull()).
+A block returned by minwav() has wavelengths per spectrum and only
+supports arithmetic with numbers.
+"""
+    # numpy should leave array (op) block to the block
+    __array_ufunc__ = None
+
+    def __init__(self, wavelength=None, spectrum=None, name=None, description='',
+                 wavelength_units=None, partial=False, points=False):
+        self.wavelength = numpy.asarray(wavelength)
+        self.spectrum = numpy.asarray(spectrum)
+        if self.spectrum.ndim == 1:
+            self.spectrum = self.spectrum[numpy.newaxis, :]
+        self.shape = self.spectrum.shape
+        self.name = name
+        self.description = description
+        self.wavelength_units = wavelength_units
+        self.partial = partial
+        self.points = points
+        # shorthand
+        self.w = self.wavelength
+        self.s = self.spectrum
+
+    def _new(self, spectrum, other=None, wavelength=None, **keys):
+        """New block like this one with other spectral values."""
+        if wavelength is None:
+            wavelength = self.wavelength
+        keys.setdefault('partial', self.partial and not isinstance(other, SpectrumBlock))
+        keys.setdefault('points', self.points)
+        return SpectrumBlock(wavelength=wavelength, spectrum=spectrum,
+                             name=self.name, description=self.description,
+                             wavelength_units=self.wavelength_units, **keys)
+
+    def _check(self):
+        if self.partial or self.points:
+            raise NotImplementedError('not supported for hulls or point spectra in a SpectrumBlock')
+
+    def __len__(self):
+        return self.spectrum.shape[1]
+
+    def __repr__(self):
+        return 'SpectrumBlock(%d spectra, %d bands)' % self.shape
+
+    def _index(self, i):
+        self._check()
+        return _Spectrum()(wavelength=self.wavelength,
+                           spectrum=numpy.zeros(len(self.wavelength)))._index(i)
+
+    def __getitem__(self, i):
+        """See Spectrum.__getitem__(), a single band returns an array (pixels,)."""
+        if i is Ellipsis:
+            return self._new(self.spectrum)
+        idx = self._index(i)
+        if isinstance(idx, collections.abc.Iterable) and idx:
+            idx = sorted(set(numpy.r_[tuple(idx)]))
+        if isinstance(idx, collections.abc.Iterable):
+            return self._new(self.spectrum[:, idx], wavelength=self.wavelength[idx])
+        return self.spectrum[:, idx]
+
+    def __call__(self, wav):
+        return self[wav]
+
+    def wavelength2index(self, wavelength):
+        return self._index(float(wavelength))
+
+    def index2wavelength(self, index):
+        return self.wavelength[index]
+
+    def __coerce__(self, other):
+        """Resample both blocks to the union of their wavelengths within the
+overlapping range, see Spectrum.__coerce__(). A Spectrum is turned into a
+block of one spectrum."""
+        if isinstance(other, _Spectrum()):
+            other = SpectrumBlock(wavelength=other.wavelength, spectrum=other.spectrum)
+        if isinstance(other, SpectrumBlock):
+            if self.points or other.points or (self.partial and other.partial):
+                raise NotImplementedError('not supported for hulls or point spectra in a SpectrumBlock')
+            if numpy.array_equal(self.wavelength, other.wavelength):
+                return self, other
+            if self.partial or other.partial:
+                raise NotImplementedError('hull with other wavelengths in a SpectrumBlock')
+            wmin = max(self.wavelength.min(), other.wavelength.min())
+            wmax = min(self.wavelength.max(), other.wavelength.max())
+            w = numpy.array(sorted(set(self.wavelength)|set(other.wavelength)))
+            w = w[numpy.where((wmin<=w) & (w<=wmax))]
+            return self.resample(w), other.resample(w)
+        elif self.partial and numpy.ndim(other):
+            raise NotImplementedError('hull with an array in a SpectrumBlock')
+        return self, other
+
+    ## resampling
+
+    def interpol(self, w):
+        self._check()
+        return interpol(self.wavelength, self.spectrum, w)
+
+    def resampled(self, w=None, step=None, mode='linear'):
+        return self.resample(w=w, step=step, mode=mode).spectrum
+
+    def resample(self, w=None, step=None, mode='linear'):
+        """See Spectrum.resample(), only linear interpolation."""
+        self._check()
+        if mode != 'linear':
+            raise NotImplementedError('only linear resampling in a SpectrumBlock')
+        if step:
+            delta = 1e-6
+            if w is None:
+                w = numpy.arange(self.wavelength.min(), self.wavelength.max()+delta, step)
+            else:
+                w = numpy.arange(w.min(), w.max()+delta, step)
+        if w is None:
+            return self
+        w = numpy.asarray(w)
+        return self._new(resample(self.wavelength, self.spectrum, w), wavelength=w)
+
+    def cut(self, w1=None, w2=None):
+        """See Spectrum.cut()."""
+        self._check()
+        if w1 is None:
+            w1 = self.wavelength[0]
+        if w2 is None:
+            w2 = self.wavelength[-1]
+        if w1>w2:
+            w1, w2 = w2, w1
+        i1 = self.wavelength.searchsorted(w1)
+        i2 = self.wavelength.searchsorted(w2, 'right')
+        w = self.wavelength[i1:i2]
+        s = self.spectrum[:, i1:i2]
+        if not w1 in self.wavelength:
+            w = numpy.hstack((w1, w))
+            s = numpy.hstack((self.interpol(w1)[:, numpy.newaxis], s))
+        if not w2 in self.wavelength or len(w)==1:
+            w = numpy.hstack((w, w2))
+            s = numpy.hstack((s, self.interpol(w2)[:, numpy.newaxis]))
+        return self._new(s, wavelength=w)
+
+    def integrate(self):
+        self._check()
+        return numpy.trapezoid(self.spectrum, self.wavelength, axis=1)
+
+    ## filters
+
+    def convolve(self, kernel):
+        """See Spectrum.convolve()."""
+        self._check()
+        s = self.spectrum
+        a, b, c = kernel
+        sum_ = sum(kernel)
+        s = numpy.hstack((sum_*s[:, :1], a*s[:, :-2]+b*s[:, 1:-1]+c*s[:, 2:], sum_*s[:, -1:]))
+        return self._new(s)
+
+    def smooth(self, n=1):
+        """See Spectrum.smooth()."""
+        self._check()
+        s = self.spectrum
+        for i in range(n):
+            s = numpy.hstack((s[:, :1], (2*s[:, 1:-1]+s[:, :-2]+s[:, 2:])/4.0, s[:, -1:]))
+        return self._new(s)
+
+    def gradient(self):
+        """See Spectrum.gradient()."""
+        self._check()
+        s = self.spectrum
+        w = self.wavelength
+        zero = numpy.zeros((len(s), 1))
+        s = numpy.hstack((zero, (s[:, 2:]-s[:, :-2])/(w[2:]-w[:-2]), zero))
+        return self._new(s)
+
+    def second(self):
+        """See Spectrum.second()."""
+        self._check()
+        s = self.spectrum
+        w = self.wavelength
+        zero = numpy.zeros((len(s), 1))
+        s = numpy.hstack((zero, (s[:, 2:]-2*s[:, 1:-1]+s[:, :-2])/((w[2:]-w[1:-1])*(w[1:-1]-w[:-2])), zero))
+        return self._new(s)
+
+    def medfilt(self, n=3):
+        """See Spectrum.medfilt()."""
+        from scipy.signal import medfilt
+        self._check()
+        return self._new(medfilt(self.spectrum, kernel_size=(1, n)))
+
+    def savgol(self, n=5, order=2, deriv=0):
+        """See Spectrum.savgol(). Spectra with NaNs become all NaN."""
+        from scipy.signal import savgol_filter
+        self._check()
+        w = self.wavelength
+        delta = (w[-1] - w[0]) / float(len(w) - 1)
+        finite = numpy.isfinite(self.spectrum).all(axis=1)
+        s = numpy.full(self.spectrum.shape, numpy.nan)
+        if finite.any():
+            s[finite] = savgol_filter(self.spectrum[finite], n, order, deriv=deriv, delta=delta, axis=1)
+        return self._new(s)
+
+    def spline(self, s=0.001, wavelength=None):
+        """See Spectrum.spline(). Spectra with NaNs become all NaN."""
+        from scipy.interpolate import UnivariateSpline
+        self._check()
+        if wavelength is None:
+            wavelength = self.wavelength
+        wavelength = numpy.asarray(wavelength, dtype=float)
+        result = numpy.full((len(self.spectrum), len(wavelength)), numpy.nan)
+        for i in numpy.flatnonzero(numpy.isfinite(self.spectrum).all(axis=1)):
+            result[i] = UnivariateSpline(self.wavelength, self.spectrum[i], s=s)(wavelength)
+        return self._new(result, wavelength=wavelength)
+
+    def fit(self, n=1):
+        """See Spectrum.fit()."""
+        self._check()
+        coef = polyfit(self.wavelength, self.spectrum, n)
+        return self._new(coef @ numpy.vander(self.wavelength, n + 1).T)
+
+    ## continuum
+
+    def nonan(self):
+        self._check()
+        if not numpy.isfinite(self.spectrum).all():
+            raise NotImplementedError('nonan() of spectra with NaNs in a SpectrumBlock')
+        return self
+
+    def hull(self):
+        """The convex hulls, resampled to the wavelengths of the block.
+See the class documentation."""
+        self.nonan()
+        return self._new(continuum(self.wavelength, self.spectrum), partial=True)
+
+    def nohull(self, mode='div'):
+        """See Spectrum.nohull()."""
+        self.nonan()
+        return self._new(nohull(self.wavelength, self.spectrum, mode=mode))
+
+    def peaks(self):
+        return self.hull() - self
+
+    def busyness(self):
+        self._check()
+        return numpy.add.reduce(numpy.fabs(self.spectrum[:, :-1] - self.spectrum[:, 1:]), axis=1)
+
+    def minwav(self, n=None, mode='div', broad=False):
+        """See Spectrum.minwav(). Returns a block of point spectra, missing
+features are NaN."""
+        self.nonan()
+        zx, depth = minwav(self.wavelength, self.spectrum, n=n, mode=mode, broad=broad)
+        return self._new(depth, wavelength=zx, points=True)
+
+    def entropy2(self):
+        self._check()
+        v = self.spectrum.astype('d')
+        pi = v / numpy.add.reduce(numpy.fabs(v), axis=1)[:, numpy.newaxis]
+        return -numpy.add.reduce(pi * numpy.log2(pi), axis=1)
+
+    ## operators
+
+    __add__ = _binary(numpy.add, "Add operator.")
+    __radd__ = _binary(numpy.add, "Radd operator (right add).", reflected=True)
+    __sub__ = _binary(numpy.subtract, "Subtract operator.")
+    __rsub__ = _binary(numpy.subtract, "Rsub operator (right subtract).", reflected=True)
+    __mul__ = _binary(numpy.multiply, "Multiply operator")
+    __rmul__ = _binary(numpy.multiply, "Rmul operator (right multiply).", reflected=True)
+    __truediv__ = _binary(numpy.true_divide, "Division operator.")
+    __rtruediv__ = _binary(numpy.true_divide, "Rdiv operator (right division).", reflected=True)
+    __pow__ = _binary(numpy.power, "Power operator.")
+    __rpow__ = _binary(numpy.power, "Rpow operator (right power).", reflected=True)
+
+    __neg__ = _unary(numpy.negative, "Negative operator.")
+    __pos__ = _unary(numpy.positive, "Positive operator.")
+    __abs__ = _unary(numpy.abs, "Abs operator.")
+
+    __lt__ = _binary(numpy.less, "Operator less than.")
+    __le__ = _binary(numpy.less_equal, "Operator less than or equal.")
+    __eq__ = _binary(numpy.equal, "Operator equal.")
+    __ne__ = _binary(numpy.not_equal, "Operator not equal.")
+    __ge__ = _binary(numpy.greater_equal, "Operator greater than or equal.")
+    __gt__ = _binary(numpy.greater, "Operator greater than.")
+
+    ## conversions
+
+    def int(self):
+        return self._new(self.spectrum.astype('int'))
+
+    def float(self):
+        return self._new(self.spectrum.astype('float'))
+
+    def astype(self, t):
+        return self._new(self.spectrum.astype(t))
+
+    ## numpy functions
+
+    add = _binary(numpy.add, "Numpy function add.")
+    subtract = _binary(numpy.subtract, "Numpy function subtract.")
+    multiply = _binary(numpy.multiply, "Numpy function multiply.")
+    divide = _binary(numpy.divide, "Numpy function divide.")
+    power = _binary(numpy.power, "Numpy function power.")
+    arctan2 = _binary(numpy.arctan2, "Numpy function arctan2.")
+    hypot = _binary(numpy.hypot, "Numpy function hypot.")
+    greater = _binary(numpy.greater, "Numpy function greater.")
+    greater_equal = _binary(numpy.greater_equal, "Numpy function greater_equal.")
+    less = _binary(numpy.less, "Numpy function less.")
+    less_equal = _binary(numpy.less_equal, "Numpy function less_equal.")
+    not_equal = _binary(numpy.not_equal, "Numpy function not_equal.")
+    equal = _binary(numpy.equal, "Numpy function equal.")
+    maximum = _binary(numpy.maximum, "Numpy function maximum.")
+    minimum = _binary(numpy.minimum, "Numpy function minimum.")
+
+    log = _unary(numpy.log, "Numpy function log.")
+    negative = _unary(numpy.negative, "Numpy function negative.")
+    absolute = _unary(numpy.absolute, "Numpy function absolute.")
+    sign = _unary(numpy.sign, "Numpy function sign.")
+    exp = _unary(numpy.exp, "Numpy function exp with base e.")
+    exp2 = _unary(numpy.exp2, "Numpy function exp2 with base 2.")
+    log2 = _unary(numpy.log2, "Numpy function log2 with base 2.")
+    log10 = _unary(numpy.log10, "Numpy function log10 with base 10.")
+    sqrt = _unary(numpy.sqrt, "Numpy function square root.")
+    square = _unary(numpy.square, "Numpy function square.")
+    reciprocal = _unary(numpy.reciprocal, "Numpy function reciprocal.")
+    sin = _unary(numpy.sin, "Numpy function sin.")
+    cos = _unary(numpy.cos, "Numpy function cos.")
+    tan = _unary(numpy.tan, "Numpy function tan.")
+    arcsin = _unary(numpy.arcsin, "Numpy function arcsin.")
+    arccos = _unary(numpy.arccos, "Numpy function arccos.")
+    arctan = _unary(numpy.arctan, "Numpy function arctan.")
+    sinh = _unary(numpy.sinh, "Numpy function sinh.")
+    cosh = _unary(numpy.cosh, "Numpy function cosh.")
+    tanh = _unary(numpy.tanh, "Numpy function tanh.")
+    arcsinh = _unary(numpy.arcsinh, "Numpy function arcsinh.")
+    arccosh = _unary(numpy.arccosh, "Numpy function arccosh.")
+    arctanh = _unary(numpy.arctanh, "Numpy function arctanh.")
+    deg2rad = _unary(numpy.deg2rad, "Numpy function deg2rad.")
+    rad2deg = _unary(numpy.rad2deg, "Numpy function rad2deg.")
+    round = _unary(numpy.round, "Numpy function round.")
+    copy = _unary(numpy.copy, "Numpy function copy.")
+
+    def cumsum(self, *args):
+        self._check()
+        return self._new(numpy.cumsum(self.spectrum, axis=1))
+
+    def cumprod(self, *args):
+        self._check()
+        return self._new(numpy.cumprod(self.spectrum, axis=1))
+
+    def clip(self, a, b, *args):
+        return self._new(numpy.clip(self.spectrum, a, b))
+
+    mean = _reduce(numpy.mean, "Numpy function mean, per spectrum.")
+    all = _reduce(numpy.all, "Numpy function all, per spectrum.")
+    any = _reduce(numpy.any, "Numpy function any, per spectrum.")
+    min = _reduce(numpy.min, "Numpy function min, per spectrum.")
+    max = _reduce(numpy.max, "Numpy function max, per spectrum.")
+    prod = _reduce(numpy.prod, "Numpy function prod, per spectrum.")
+    std = _reduce(numpy.std, "Numpy function std, per spectrum.")
+    sum = _reduce(numpy.sum, "Numpy function sum, per spectrum.")
+    var = _reduce(numpy.var, "Numpy function var, per spectrum.")
+
+    ## distance measures, per spectrum
+
+    SA = _distance(_spectral_angle, "Spectral angle.")
+    normxcorr = _distance(_normxcorr, "Normalized cross-correlation.")
+    ED = _distance(_euclidean_distance, "Euclidean distance.")
+    ID = _distance(_intensity_difference, "Intensity difference.")
+    SID = _distance(_spectral_information_divergence, "Spectral Information Divergence.")
+    BC = _distance(_bray_curtis_distance, "Bray Curtis distance.")
+
+def _polyfit_matrix(w, n):
+    """Pseudo-inverse P (n+1, bands) of the Vandermonde matrix of w, so that
+P @ s are the polynomial coefficients of spectrum s. The columns are scaled
+to unit length first, as in numpy.polyfit."""
+    A = numpy.vander(w, n + 1)
+    scale = numpy.sqrt((A*A).sum(axis=0))
+    return numpy.linalg.pinv(A / scale) / scale[:, numpy.newaxis]
+
+def polyfit(w, s, n=1, full=False):
+    """Least squares polynomials of degree n through every spectrum in s,
+like numpy.polyfit(w, s[i], n) for all spectra at once.
+
+The design matrix is the same for all spectra, so its pseudo-inverse is
+computed once and applied with a single matrix multiply. Spectra with
+NaNs are fitted on their finite bands, grouped by NaN pattern; spectra
+with less than n+1 finite bands give NaN.
+
+Returns the coefficients (pixels, n+1), highest power first. If full is
+True, also returns the coefficient of determination R^2 and the RMS of
+the residuals (pixels,).
+"""
+    s = numpy.asarray(s, dtype='d')
+    w = numpy.asarray(w, dtype='d')
+    N, B = s.shape
+
+    coef = numpy.full((N, n + 1), numpy.nan)
+    valid = numpy.isfinite(s)
+    complete = valid.all(axis=1)
+
+    if complete.any():
+        coef[complete] = s[complete] @ _polyfit_matrix(w, n).T
+
+    incomplete = numpy.nonzero(~complete)[0]
+    if len(incomplete):
+        patterns, group = numpy.unique(valid[incomplete], axis=0, return_inverse=True)
+        for k, pattern in enumerate(patterns):
+            if pattern.sum() <= n:
+                continue
+            rows = incomplete[group.ravel() == k]
+            coef[rows] = s[rows][:, pattern] @ _polyfit_matrix(w[pattern], n).T
+
+    if not full:
+        return coef
+
+    residual = s - coef @ numpy.vander(w, n + 1).T
+    count = valid.sum(axis=1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = numpy.where(valid, s, 0.0).sum(axis=1) / count
+        ss_res = numpy.where(valid, residual**2, 0.0).sum(axis=1)
+        ss_tot = numpy.where(valid, (s - mean[:, numpy.newaxis])**2, 0.0).sum(axis=1)
+        r2 = 1 - ss_res / ss_tot
+        rms = numpy.sqrt(ss_res / count)
+    r2[numpy.isnan(coef[:, 0])] = numpy.nan
+    rms[numpy.isnan(coef[:, 0])] = numpy.nan
+
+    return coef, r2, rms
+
+def merge_moments(n, mean, m2, strip):
+    """Merge the count n, mean and sum of squared deviations m2 of every
+band with those of strip (pixels, bands), ignoring NaNs.
+
+Returns the updated (n, mean, m2), using the pairwise update of
+Chan et al."""
+    valid = ~numpy.isnan(strip)
+
+    n_strip = valid.sum(axis=0)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean_strip = numpy.where(valid, strip, 0.0).sum(axis=0) / n_strip
+        m2_strip = (numpy.where(valid, strip - mean_strip, 0.0)**2).sum(axis=0)
+
+        total = n + n_strip
+        delta = mean_strip - mean
+        update = n_strip > 0
+        mean = numpy.where(update, mean + delta * n_strip / total, mean)
+        m2 = numpy.where(update, m2 + m2_strip + delta**2 * n * n_strip / total, m2)
+
+    return total, mean, m2
@@ -24,6 +24,9 @@
 ##
 
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import envi2
 
 # Try to import from Pillow or PIL
@@ -32,59 +35,132 @@ try:
 except ImportError as errtext:
     import Image
 
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
 import stretch
 
 FILE_EXT = '.jpg'
 
+# tile size of tiled TIFFs
+TIFF_TILE = 256
+
+# default maximum number of processes, every process opens the image
+MAX_PROCESSES = 4
+
 def message(s):
     pass
 
+def save_tiff(fout, band, compression=None, tiled=False):
+    """Save an 8-bit band as TIFF.
+
+Tiled TIFFs are written with GDAL, Pillow cannot write tiles. Without
+GDAL the TIFF is written in strips. compression is None, 'deflate', 'lzw'
+or 'packbits'."""
+    if tiled and gdal is not None:
+        options = ['TILED=YES', 'BLOCKXSIZE=%d' % (TIFF_TILE,),
+                   'BLOCKYSIZE=%d' % (TIFF_TILE,)]
+        if compression:
+            options.append('COMPRESS=%s' % (compression.upper(),))
+        ds = gdal.GetDriverByName('GTiff').Create(fout, band.shape[1], band.shape[0],
+                                                  1, gdal.GDT_Byte, options=options)
+        ds.GetRasterBand(1).WriteArray(band)
+        ds = None
+    elif compression:
+        Image.fromarray(band).save(fout, 'TIFF', compression='tiff_' + compression.lower())
+    else:
+        Image.fromarray(band).save(fout, 'TIFF')
+
+def export_band(fin, i, fout, choice='JPEG', sort_wavelengths=False,
+                use_bbl=False, compression=None, tiled=False):
+    """Export band i of fin to fout plus the extension of the format.
+Returns (i, bytes read, seconds)."""
+    start = time.time()
+
+    im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
+
+    # straight from the memory map, no float64 copy of the band
+    one = im.get_band(i, copy=False)
+    if choice=='ENVI':
+        wavelength = None
+        if hasattr(im, 'wavelength'):
+            wavelength = [im.wavelength[i]]
+
+        band_names = None
+        if hasattr(im, 'band_names'):
+            band_names = [im.band_names[i]]
+
+        fwhm = None
+        if hasattr(im, 'fwhm'):
+            fwhm = [im.fwhm[i]]
+
+        im2 = envi2.New(fout, hdr=im, bands=1, bbl=None,
+                        band_names=band_names,
+                        wavelength=wavelength,
+                        fwhm=fwhm, default_bands=None)
+        im2[:,:,0] = one
+        del im2
+    else:
+        band = stretch.stddev_stretch(one)
+        if choice=='JPEG':
+            Image.fromarray(band).save(fout + '.jpg', 'JPEG', quality=100)
+        elif choice=='TIFF':
+            save_tiff(fout + '.tif', band, compression=compression, tiled=tiled)
+        elif choice=='PNG':
+            Image.fromarray(band).save(fout + '.png', 'PNG')
+
+    nbytes = one.size * one.itemsize
+    del im
+
+    return i, nbytes, time.time() - start
+
 def split(fin, choice='JPEG', sort_wavelengths=False, use_bbl=False,
+           compression=None, tiled=False, processes=None,
            message=message, progress=None):
+    """Split the image into one file per band.
+
+The bands are exported in parallel by a pool of processes, processes=None
+uses all CPUs up to MAX_PROCESSES. TIFFs can be compressed ('deflate', 'lzw' or 'packbits')
+and tiled. The throughput of every band is reported through message."""
     im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
+    bands = im.bands
+    del im
 
     fbase = os.path.splitext(fin)[0]
 
+    if processes is None:
+        processes = min(os.cpu_count() or 1, MAX_PROCESSES)
+    processes = max(1, min(processes, bands))
+
+    if tiled and choice=='TIFF' and gdal is None:
+        message('GDAL not available, TIFFs will not be tiled.')
+
     if progress:
         progress(0.0)
-    for i in range(im.bands):
-        if progress:
-            progress(i / float(im.bands))
-        fout = fbase + '%03d' % (i+1,) #+ FILE_EXT
 
-        one = im.get_band(i).astype('float64')
-        imout = Image.fromarray(stretch.stddev_stretch(one))
-        if choice=='JPEG':
-            imout.save(fout + '.jpg', 'JPEG', quality=100)
-        elif choice=='TIFF':
-            imout.save(fout + '.tif', 'TIFF')
-        elif choice=='PNG':
-            imout.save(fout + '.png', 'PNG')
-        elif choice=='ENVI':
-            wavelength = None
-            if hasattr(im, 'wavelength'):
-                wavelength = [im.wavelength[i]]
-
-            band_names = None
-            if hasattr(im, 'band_names'):
-                band_names = [im.band_names[i]]
-
-            fwhm = None
-            if hasattr(im, 'fwhm'):
-                fwhm = [im.fwhm[i]]
-
-            im2 = envi2.New(fout, hdr=im, bands=1, bbl=None,
-                            band_names=band_names,
-                            wavelength=wavelength,
-                            fwhm=fwhm, default_bands=None)
-            im2[:,:,0] = im[i]
-            del im2
+    start = time.time()
+    total = 0
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(export_band, fin, i, fbase + '%03d' % (i+1,), choice,
+                               sort_wavelengths, use_bbl, compression, tiled)
+                   for i in range(bands)]
+        for done, future in enumerate(as_completed(futures)):
+            i, nbytes, seconds = future.result()
+            total = total + nbytes
+            message('Band %d: %.1f MB in %.2f s, %.1f MB/s' %
+                    (i+1, nbytes / 1e6, seconds, nbytes / 1e6 / max(seconds, 1e-6)))
+            if progress:
+                progress(done / float(bands))
+
+    seconds = time.time() - start
+    message('Total: %.1f MB in %.2f s, %.1f MB/s' %
+            (total / 1e6, seconds, total / 1e6 / max(seconds, 1e-6)))
 
     if progress:
         progress(1.0)
 
-    del im
-
 if __name__ == '__main__':
 ##    print "Run this module using tkSplit!"
 
@@ -107,6 +183,12 @@ if __name__ == '__main__':
 
     parser.add_argument('-m', dest='mode', choices=('ENVI', 'JPEG', 'TIFF', 'PNG'),
                       help='output format: ENVI, JPEG (default), TIFF, PNG', default='JPEG')
+    parser.add_argument('-c', dest='compression', choices=('deflate', 'lzw', 'packbits'),
+                      help='TIFF compression (default none)')
+    parser.add_argument('-t', action='store_true', dest='tiled',
+                      help='tiled TIFF (requires GDAL)')
+    parser.add_argument('-p', dest='processes', type=int,
+                      help='number of processes (default number of CPUs, at most 4)')
 
 ##    parser.set_defaults(sort_wavelengths=False, use_bbl=False,
 ##                        mode='JPEG')
@@ -120,4 +202,8 @@ if __name__ == '__main__':
     split(options.input,
           choice=options.mode,
           sort_wavelengths=options.sort_wavelengths,
-          use_bbl=options.use_bbl)
+          use_bbl=options.use_bbl,
+          compression=options.compression,
+          tiled=options.tiled,
+          processes=options.processes,
+          message=print)
@@ -94,15 +94,9 @@ def subset(nameIn, nameOut,
                     fwhm=None, bbl=bbl,
                     interleave=output_format, data_type=data_type)
 
-    # Here we go!
-    if band_selection:
-##        if bands == 1:
-##            im2[...] = im[top:bottom, left:right, band_selection].squeeze()
-##        else:
-##            im2[...] = im[top:bottom, left:right, band_selection]
-        im2[...] = im[top:bottom, left:right, band_selection]
-    else:
-        im2[...] = im[top:bottom, left:right, :]
+    # Here we go! Block-wise, reading and writing in file order
+    envi2.copy_image(im, im2, top=top, bottom=bottom, left=left, right=right,
+                     bands=band_selection or None)
 
     # destroy resources
     del im2, im
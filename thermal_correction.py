@@ -27,43 +27,91 @@ import envi2
 
 import planck
 
-from pylab import *
-from scipy.optimize import leastsq
-##from numpy import array
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-const1 = 0
+import numpy
+
+# average reflectance at 5 micron is half that of the 2.5 micron
+# average reflectance at 5 micron is 0.15, emissivity = 0.85???
+SOLAR_FRACTION = 0.5
+EMISSIVITY = 0.85
 
 # blackbody curve, wavelength in microns
 def blackbody(wav, temp):
     c1 = 0.000001 # per micron!
     return c1 * planck.planck(wav * 1e-6, temp)
 
-# this models the solar radiation curve
-def model1(params, wav):
-    c0 = params
-    return c0 * blackbody(wav, planck.SOLAR_T)
-
-def residuals1(p, y, x):
-    return y - model1(p, x)
-
-# this models the solar curve + bb radiation from the object itself
-def model2(params, wav):
-    global const1
-    temp = params
-    # average reflectance at 5 micron is half that of the 2.5 micron
-    # average reflectance at 5 micron is 0.15, emissivity = 0.85???
-    return 0.5 * const1 * blackbody(wav, planck.SOLAR_T) + 0.85 * blackbody(wav, temp)
-#    return const1 * blackbody(wav, planck.SOLAR_T) + blackbody(wav, temp)
-
-def residuals2(p, y, x):
-    return y - model2(p, x)
+# derivative of the blackbody curve to the temperature
+def dblackbody(wav, temp):
+    c1 = 0.000001 # per micron!
+    return c1 * planck.dplanck_dT(wav * 1e-6, temp)
+
+def fit_solar(wav, y):
+    """Least squares scale c0 of the solar curve c0 * blackbody(wav, SOLAR_T)
+for every spectrum (row) of y. The model is linear in c0, so this is a
+closed form solution."""
+    solar = blackbody(wav, planck.SOLAR_T)
+    return y.dot(solar) / solar.dot(solar)
+
+def fit_temperature(wav, y, const1, temp=230.0, tol=1e-6, maxiter=50):
+    """Least squares temperature of the model
+
+    SOLAR_FRACTION * const1 * blackbody(wav, SOLAR_T) + EMISSIVITY * blackbody(wav, temp)
+
+for every spectrum (row) of y, with const1 the solar scale per spectrum.
+Gauss-Newton iterations run for all spectra at the same time, spectra
+stop iterating once their relative temperature step drops below tol.
+"""
+    y = y - SOLAR_FRACTION * const1[:, numpy.newaxis] * blackbody(wav, planck.SOLAR_T)
+    temp = numpy.full(len(y), temp, dtype='d')
+    active = numpy.arange(len(y))
+
+    with numpy.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        for iteration in range(maxiter):
+            if not len(active):
+                break
+            t = temp[active][:, numpy.newaxis]
+            r = y[active] - EMISSIVITY * blackbody(wav, t)
+            J = EMISSIVITY * dblackbody(wav, t)
+            step = (J * r).sum(axis=1) / (J * J).sum(axis=1)
+            step = numpy.nan_to_num(step)
+            # never more than halve or double the temperature in one step
+            t = t[:, 0]
+            step = step.clip(-0.5 * t, t)
+            temp[active] = t + step
+            active = active[numpy.fabs(step) > tol * t]
+
+    return temp
+
+def correct_strip(spec, wav, i1, i2, i3):
+    """Thermal correction of a block of spectra (pixels, bands).
+Returns the corrected spectra and the fitted (reflectance, temperature)."""
+    therm = numpy.full((len(spec), 2), numpy.nan)
+    out = numpy.full(spec.shape, numpy.nan)
+
+    # step 1: match solar curve
+    tspec = spec[:, i1:i2]
+    ok1 = numpy.isfinite(tspec).all(axis=1)
+    therm[ok1, 0] = fit_solar(wav[i1:i2], tspec[ok1])
+
+    # step 2: match thermal curve
+    tspec = spec[:, i3:]
+    ok2 = numpy.isfinite(tspec).all(axis=1)
+    const1 = numpy.where(ok1, therm[:, 0], 0.0)[ok2]
+    temp = fit_temperature(wav[i3:], tspec[ok2], const1)
+    therm[ok2, 1] = temp
+
+    # subtract thermal effect
+    out[ok2] = spec[ok2] - EMISSIVITY * blackbody(wav, temp[:, numpy.newaxis])
+
+    return out, therm
 
 def message(s):
     pass
 
 def thermal_correction(fin, fout, fthermal, sort_wavelengths=True, use_bbl=True,
-                       message=message, progress=None):
-    global const1
+                       threads=None, message=message, progress=None):
     im = envi2.Open(fin,
                     sort_wavelengths=True, use_bbl=use_bbl)
 
@@ -79,51 +127,33 @@ def thermal_correction(fin, fout, fthermal, sort_wavelengths=True, use_bbl=True,
                     wavelength=None, bbl=None,
                     interleave='bip')
 
-    wav = im.wavelength
+    wav = numpy.asarray(im.wavelength, dtype='d')
 
     i1 = wav.searchsorted(2.2)
     i2 = wav.searchsorted(2.5)
     i3 = wav.searchsorted(5.0)
 
-    twav1 = wav[i1:i2]
-    twav2 = wav[i3:]
+    if threads is None:
+        threads = os.cpu_count() or 1
+
+    def work(top, bottom):
+        spec = numpy.asarray(im[top:bottom, :, :], dtype='d').reshape((-1, im.bands))
+        out, t = correct_strip(spec, wav, i1, i2, i3)
+        im2[top:bottom, :, :] = out.reshape((bottom - top, im.samples, im.bands))
+        therm[top:bottom, :, :] = t.reshape((bottom - top, im.samples, 2))
+        return bottom - top
 
     if progress:
         progress(0.0)
 
-    for j in range(im.lines):
-        if progress:
-            progress(j / float(im.lines))
-        for i in range(im.samples):
-            spec = im.get_spectrum(j, i)
-
-            # step 1: match solar curve
-            tspec = spec[i1:i2]
-
-            if isfinite(tspec).all():
-                params = leastsq(residuals1, [0.1], args=(tspec, twav1))[0]
-
-                const1 = params
-
-                therm[j,i,0] = const1
-            else:
-                therm[j,i,0] = nan
-
-            # step 2: match thermal curve
-            tspec = spec[i3:]
-
-            if isfinite(tspec).all():
-                params = leastsq(residuals2, [230.0], args=(tspec, twav2))[0]
-
-                temp = params
-
-                therm[j,i,1] = temp
-
-                # subtract thermal effect
-                im2[j,i,:] = (spec - 0.85 * blackbody(wav, temp)) # / (const1 * blackbody(wav, planck.SOLAR_T))
-            else:
-                therm[j, i, 1] = nan
-                im2[j, i, :] = nan
+    # strips are independent, every strip reads and writes its own lines
+    done = 0
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        futures = [pool.submit(work, top, bottom) for top, bottom in im.strips()]
+        for future in as_completed(futures):
+            done = done + future.result()
+            if progress:
+                progress(done / float(im.lines))
 
     if progress:
         progress(1.0)
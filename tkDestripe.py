@@ -69,7 +69,15 @@ class Application(Frame):
         self.message("Out: " + self.nameOut.get())
         self.message("Running, please wait...")
         try:
-            if self.speed.get()=='fast':
+            if self.speed.get()=='stream':
+                destripe.strip_destripe(self.nameIn.get(), self.nameOut.get(),
+                      direction=self.direction.get(),
+                      mode=self.mode.get(),
+                      order=self.order.get(),
+                      sort_wavelengths=self.sortWav.get(),
+                      use_bbl=self.useBBL.get(), message=self.message,
+                      progress=self.progressBar)
+            elif self.speed.get()=='fast':
                 destripe.destripe(self.nameIn.get(), self.nameOut.get(),
                       direction=self.direction.get(),
                       mode=self.mode.get(),
@@ -198,6 +206,7 @@ class Application(Frame):
         Label(frame, text="Speed vs Mem: ").grid(row=2, column=0, sticky=W)
         Radiobutton(frame, variable=self.speed, value='slow', text='band-by-band').grid(row=2, column=1, sticky=W)
         Radiobutton(frame, variable=self.speed, value='fast', text='image at once').grid(row=2, column=2, sticky=W)
+        Radiobutton(frame, variable=self.speed, value='stream', text='streaming').grid(row=2, column=3, sticky=W)
         
         row = row + 1
 
@@ -70,6 +70,7 @@ class Application(Frame):
         self.message("Running, please wait...")
         try:
             meteosat.convert_meteosat(self.nameIn.get(), self.nameOut.get(),
+                           append=self.append.get(),
                            message=self.message)
             self.message("Completed!")
         except Exception as err:
@@ -120,6 +121,8 @@ class Application(Frame):
         self.nameIn = StringVar()
         self.nameIn.set(conf.get_option('pattern', ''))
         self.nameOut = StringVar()
+        self.append = IntVar()
+        self.append.set(0)
 
         row = 0
 
@@ -136,6 +139,8 @@ class Application(Frame):
         Entry(frame, textvariable=self.nameOut, width=30).grid(row=1, column=1, sticky=W+E)
         Button(frame, text='...', command=self.pick_output).grid(row=1, column=2, sticky=W)
 
+        Checkbutton(frame, text="Append to existing stack", variable=self.append).grid(row=2, column=1, sticky=W)
+
         row = row + 1
 
         # frame 2
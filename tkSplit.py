@@ -191,16 +191,18 @@ class Application(Frame):
         self.progressBar = ProgressBar(self)
         self.progressBar.grid(row=row, column=0, columnspan=3, sticky=W+E)
 
-root = Tk()
-app = Application(root)
-root.title(DESCRIPTION)
-# handle the X button
-root.protocol("WM_DELETE_WINDOW", root.quit)
-root.mainloop()
+# split.split() uses a process pool, the workers import this script too
+if __name__ == '__main__':
+    root = Tk()
+    app = Application(root)
+    root.title(DESCRIPTION)
+    # handle the X button
+    root.protocol("WM_DELETE_WINDOW", root.quit)
+    root.mainloop()
 
-conf.set_option('output-format', app.choice.get())
+    conf.set_option('output-format', app.choice.get())
 
-conf.set_option('use-bbl', app.useBBL.get())
-conf.set_option('sort-wavelength', app.sortWav.get())
+    conf.set_option('use-bbl', app.useBBL.get())
+    conf.set_option('sort-wavelength', app.sortWav.get())
 
-root.destroy()
+    root.destroy()
@@ -27,6 +27,8 @@
 ##
 
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
 import envi2
 import envi2.constants
 
@@ -273,7 +275,29 @@ def tokml(
     message=message,
     force=False,
     fbase=None,
+    tiled=False,
+    tilesize=256,
+    threads=None,
 ):
+    if tiled:
+        return superoverlay(
+            fin,
+            red=red,
+            green=green,
+            blue=blue,
+            stretch_mode=stretch_mode,
+            strip_edges=strip_edges,
+            strip_zeros=strip_zeros,
+            sort_wavelengths=sort_wavelengths,
+            use_bbl=use_bbl,
+            target=target,
+            message=message,
+            force=force,
+            fbase=fbase,
+            tilesize=tilesize,
+            threads=threads,
+        )
+
     im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
 
     if not fbase:
@@ -389,6 +413,367 @@ def tokml(
     del im
 
 
+# number of histogram bins for the percent stretch of a super-overlay
+HISTOGRAM_BINS = 65536
+
+
+def band_index(im, band):
+    """Band index of band, which is a wavelength if the image has wavelengths."""
+    if hasattr(im, "wavelength"):
+        return im.wavelength2index(band)
+    return int(band)
+
+
+def stretch_limits(im, bands, stretch_mode, lines=None, progress=None):
+    """Stretch limits (min, max) for every band in bands, for the whole image.
+
+The statistics are gathered from strips of lines, so the bands are never
+read in one go. The percent stretch uses a histogram of HISTOGRAM_BINS
+bins between the minimum and maximum, in a second pass.
+"""
+    if lines is None:
+        lines = envi2.constants.STRIP_BYTES // (8 * len(bands) * max(1, im.samples))
+    strips = list(im.strips(lines=lines))
+
+    n = numpy.zeros(len(bands))
+    s1 = numpy.zeros(len(bands))
+    s2 = numpy.zeros(len(bands))
+    mins = numpy.full(len(bands), numpy.inf)
+    maxs = numpy.full(len(bands), -numpy.inf)
+
+    for top, bottom in strips:
+        if progress:
+            progress(top / float(im.lines))
+        for k, i in enumerate(bands):
+            b = numpy.asarray(im[top:bottom, :, i], dtype="float64")
+            b = b[numpy.isfinite(b)]
+            if len(b):
+                n[k] += len(b)
+                s1[k] += b.sum()
+                s2[k] += (b * b).sum()
+                mins[k] = min(mins[k], b.min())
+                maxs[k] = max(maxs[k], b.max())
+
+    if stretch_mode == "NO":
+        return [(0.0, 255.0)] * len(bands)
+    elif stretch_mode == "MM":
+        return list(zip(mins, maxs))
+    elif stretch_mode == "SD":
+        m = s1 / n
+        sd = numpy.sqrt(s2 / n - m * m)
+        return list(zip(numpy.maximum(mins, m - 2 * sd), numpy.minimum(maxs, m + 2 * sd)))
+    elif stretch_mode != "1P":
+        raise ValueError
+
+    hists = numpy.zeros((len(bands), HISTOGRAM_BINS))
+    for top, bottom in strips:
+        if progress:
+            progress(top / float(im.lines))
+        for k, i in enumerate(bands):
+            if n[k]:
+                b = numpy.asarray(im[top:bottom, :, i], dtype="float64")
+                hists[k] += numpy.histogram(
+                    b[numpy.isfinite(b)], bins=HISTOGRAM_BINS, range=(mins[k], maxs[k])
+                )[0]
+
+    # same ranks as stretch.percent_stretch
+    limits = []
+    for k in range(len(bands)):
+        if not n[k]:
+            limits.append((0.0, 255.0))
+            continue
+        cum = hists[k].cumsum()
+        width = (maxs[k] - mins[k]) / HISTOGRAM_BINS
+        lo = cum.searchsorted(int(0.01 * n[k]), side="right")
+        hi = cum.searchsorted(int(0.99 * n[k]), side="right")
+        limits.append((mins[k] + lo * width, mins[k] + (hi + 1) * width))
+
+    return limits
+
+
+def render_tile(
+    im,
+    bands,
+    limits,
+    y0,
+    y1,
+    x0,
+    x1,
+    step,
+    stretch_mode=None,
+    strip_edges=False,
+    strip_zeros=False,
+):
+    """Render the window y0:y1, x0:x1 of the image, subsampled by step, as a
+PIL image. Classification images keep their palette."""
+    if im.header.file_type == envi2.constants.ENVI_Classification:
+        tile = Image.fromarray(numpy.ascontiguousarray(im[y0:y1:step, x0:x1:step, 0]))
+        palette = im.header.class_lookup
+        tile.putpalette(palette + (3 * 256 - len(palette)) * [0])
+        return tile
+
+    channels = []
+    nans = []
+    with numpy.errstate(invalid="ignore"):
+        for i, (min_, max_) in zip(bands, limits):
+            b = numpy.asarray(im[y0:y1:step, x0:x1:step, i], dtype="float64")
+            nans.append(numpy.isnan(b))
+            if stretch_mode == "NO":
+                channels.append(stretch.no_stretch(b))
+            else:
+                channels.append(stretch.custom_stretch(b, min_, max_))
+
+    ar, ag, ab = nans
+    if strip_edges:
+        alpha_raw = ~(ar | ag | ab)
+    else:
+        alpha_raw = ~(ar & ag & ab)
+
+    if strip_zeros:
+        r, g, b = channels
+        alpha_raw = alpha_raw & (r.astype(bool) | g.astype(bool) | b.astype(bool))
+
+    channels.append((alpha_raw * 255).astype("u1"))
+
+    return Image.merge("RGBA", [Image.fromarray(c) for c in channels])
+
+
+def write_kml_region(f, indent, north, south, east, west, min_lod, max_lod=-1):
+    region = """<Region>
+  <LatLonAltBox>
+    <north>%f</north>
+    <south>%f</south>
+    <east>%f</east>
+    <west>%f</west>
+  </LatLonAltBox>
+  <Lod>
+    <minLodPixels>%d</minLodPixels>
+    <maxLodPixels>%d</maxLodPixels>
+  </Lod>
+</Region>""" % (north, south, east, west, min_lod, max_lod)
+    for line in region.splitlines():
+        f.write(indent + line + "\n")
+
+
+def write_kml_tile(
+    kmlname, target, name, png, box, children, min_lod, child_lod, draw_order,
+    max_lod=-1,
+):
+    """Write the KML of one tile of a super-overlay.
+
+box is (north, south, east, west), children is a list of (kml, box).
+The tile is shown between min_lod and max_lod pixels, -1 is no limit."""
+    north, south, east, west = box
+    with open(kmlname, "w") as f:
+        f.write(
+            """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2" hint="target=%s">
+  <Document>
+    <name>%s</name>
+"""
+            % (target, name)
+        )
+        write_kml_region(f, "    ", north, south, east, west, min_lod, max_lod)
+        f.write(
+            """    <GroundOverlay>
+      <drawOrder>%d</drawOrder>
+      <Icon>
+        <href>%s</href>
+      </Icon>
+      <LatLonBox>
+        <north>%f</north>
+        <south>%f</south>
+        <east>%f</east>
+        <west>%f</west>
+      </LatLonBox>
+    </GroundOverlay>
+"""
+            % (draw_order, png, north, south, east, west)
+        )
+        for kml, (north, south, east, west) in children:
+            f.write("    <NetworkLink>\n      <name>%s</name>\n" % (kml,))
+            write_kml_region(f, "      ", north, south, east, west, child_lod)
+            f.write(
+                """      <Link>
+        <href>%s</href>
+        <viewRefreshMode>onRegion</viewRefreshMode>
+      </Link>
+    </NetworkLink>
+"""
+                % (kml,)
+            )
+        f.write("  </Document>\n</kml>\n")
+
+
+def superoverlay(
+    fin,
+    red=None,
+    green=None,
+    blue=None,
+    stretch_mode=None,
+    strip_edges=False,
+    strip_zeros=False,
+    sort_wavelengths=False,
+    use_bbl=False,
+    target=TARGET_MARS,
+    message=message,
+    force=False,
+    fbase=None,
+    tilesize=256,
+    threads=None,
+    progress=None,
+):
+    """Export the image as a KML super-overlay.
+
+A pyramid of tiles of tilesize pixels is written to the directory
+fbase_tiles, every level halving the resolution until the whole image
+fits in one tile. The tiles are linked by Region based NetworkLinks, so
+Google Earth only loads the tiles in view at the resolution needed.
+fbase.kml is the file to open.
+
+The stretch is computed once for the whole image. The tiles are rendered
+in a pool of threads, threads=None uses all CPUs.
+"""
+    im = envi2.Open(fin, sort_wavelengths=sort_wavelengths, use_bbl=use_bbl)
+
+    if not fbase:
+        fbase = os.path.splitext(fin)[0]
+    name = os.path.basename(fbase)
+
+    kmlname = fbase + ".kml"
+    if not force and os.path.exists(kmlname):
+        message("KML file exists. Skipped.")
+        return
+
+    box = get_bounding_box(im)
+    if box is None or (
+        hasattr(im.header, "map_info") and "utm" in im.header.map_info[0].lower()
+    ):
+        raise ValueError("Super-overlay needs a geographic bounding box")
+    north, west, south, east = box
+    dy = (north - south) / float(im.lines)
+    dx = (east - west) / float(im.samples)
+
+    if im.header.file_type == envi2.constants.ENVI_Classification:
+        bands = [0]
+        limits = None
+    else:
+        if stretch_mode not in ("NO", "MM", "1P", "SD"):
+            raise ValueError
+        bands = [band_index(im, red), band_index(im, green), band_index(im, blue)]
+        message("Red band=%d, Green band=%d, Blue band=%d" % tuple(bands))
+        message("Computing stretch...")
+        limits = stretch_limits(im, bands, stretch_mode)
+
+    tiledir = fbase + "_tiles"
+    os.makedirs(tiledir, exist_ok=True)
+
+    # level 0 is one tile for the whole image, every next level doubles
+    # the resolution up to the full resolution
+    levels = 0
+    while tilesize * 2**levels < max(im.lines, im.samples):
+        levels = levels + 1
+
+    def ntiles(level):
+        size = tilesize * 2 ** (levels - level)
+        return (im.lines + size - 1) // size, (im.samples + size - 1) // size
+
+    def window(level, ty, tx):
+        size = tilesize * 2 ** (levels - level)
+        y0, x0 = ty * size, tx * size
+        return y0, min(y0 + size, im.lines), x0, min(x0 + size, im.samples)
+
+    def tile_box(level, ty, tx):
+        y0, y1, x0, x1 = window(level, ty, tx)
+        return (north - y0 * dy, north - y1 * dy, west + x1 * dx, west + x0 * dx)
+
+    def tile_name(level, ty, tx):
+        return "%d_%d_%d" % (level, ty, tx)
+
+    def work(level, ty, tx):
+        y0, y1, x0, x1 = window(level, ty, tx)
+        tile = render_tile(
+            im, bands, limits, y0, y1, x0, x1, 2 ** (levels - level),
+            stretch_mode=stretch_mode, strip_edges=strip_edges,
+            strip_zeros=strip_zeros,
+        )
+        base = tile_name(level, ty, tx)
+        tile.save(os.path.join(tiledir, base + ".png"), "PNG")
+
+        children = []
+        if level < levels:
+            cy, cx = ntiles(level + 1)
+            for y in (2 * ty, 2 * ty + 1):
+                for x in (2 * tx, 2 * tx + 1):
+                    if y < cy and x < cx:
+                        children.append(
+                            (tile_name(level + 1, y, x) + ".kml", tile_box(level + 1, y, x))
+                        )
+
+        write_kml_tile(
+            os.path.join(tiledir, base + ".kml"), target, base, base + ".png",
+            tile_box(level, ty, tx), children,
+            0 if level == 0 else tilesize // 2, tilesize // 2, level,
+            # parents make way for their children when zooming in
+            -1 if level == levels else 4 * tilesize,
+        )
+
+    tiles = [
+        (level, ty, tx)
+        for level in range(levels + 1)
+        for ty in range(ntiles(level)[0])
+        for tx in range(ntiles(level)[1])
+    ]
+    message("Rendering %d tiles in %d levels..." % (len(tiles), levels + 1))
+
+    if threads is None:
+        threads = os.cpu_count() or 1
+    threads = max(1, threads)
+
+    if progress:
+        progress(0.0)
+
+    # at most 2 * threads tiles are in flight
+    done = 0
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = set()
+        todo = iter(tiles)
+        while True:
+            for tile in todo:
+                pending.add(pool.submit(work, *tile))
+                if len(pending) >= 2 * threads:
+                    break
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                future.result()
+                done = done + 1
+            if progress:
+                progress(done / float(len(tiles)))
+
+    with open(kmlname, "w") as f:
+        f.write(
+            """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2" hint="target=%s">
+  <NetworkLink>
+    <name>%s</name>
+    <Link>
+      <href>%s</href>
+    </Link>
+  </NetworkLink>
+</kml>
+"""
+            % (target, name, os.path.basename(tiledir) + "/" + tile_name(0, 0, 0) + ".kml")
+        )
+    message("Super-overlay KML file created")
+
+    if progress:
+        progress(1.0)
+
+    del im
+
+
 if __name__ == "__main__":
     ##    print "Run this module using tkToKML!"
     # command line version
@@ -458,6 +843,19 @@ if __name__ == "__main__":
         default="1P",
         help="stretch mode: NO (none), MM (min-max), 1P (1 percent, default), SD (2 standard deviation)",
     )
+    parser.add_argument(
+        "-T",
+        action="store_true",
+        dest="tiled",
+        help="tiled KML super-overlay for large images",
+    )
+    parser.add_argument(
+        "--tilesize",
+        dest="tilesize",
+        type=int,
+        default=256,
+        help="tile size of the super-overlay in pixels (default 256)",
+    )
     parser.add_argument(
         "-t",
         dest="target",
@@ -492,4 +890,6 @@ if __name__ == "__main__":
         target=options.target,
         force=options.force,
         fbase=options.output,
+        tiled=options.tiled,
+        tilesize=options.tilesize,
     )